@@ -4,17 +4,26 @@ Made by Andrej Pakhutin"""
 from configparser import ConfigParser
 from kadpy.kbattstats import KBattStats
 from kadpy.kbattlead import KBattLead
+from kadpy.kbattlifepo import KBattLiFePO
 from kadpy.kpowerutils import KPowerDeviceCommons
 
 
 class KBatteries:
-    """Wrapper class for providing aggregate data from all connected batteries"""
+    """Wrapper class for providing aggregate data from all connected batteries.
+    Batteries are organized in strings: ',' separates parallel strings and '+' joins batteries in series,
+    e.g. 'batteries = int1 + int2, ext1 + ext2' for an UPS with the internal and external packs.
+    Aggregates are computed once after each new sample and shared by all readers"""
     def __init__(self, dev_commons: KPowerDeviceCommons, config: ConfigParser, old_stats: dict | None) -> None:
         self.capacity_wh: int = 0  # total capacity for all connected batteries
         self.commons = dev_commons
         self.messages: list[str] = []
         self._batteries: list[KBattStats] = []
-        self._ids: list[str] = []  # valid battery ids for quick access
+        self._by_id: dict[str, KBattStats] = {}
+        self._ids: tuple[str, ...] = ()  # valid battery ids for quick access
+        self._strings: list[list[KBattStats]] = []  # series strings that are connected in parallel
+        # per sample cache. See _invalidate()
+        self._power_cache: tuple[int, float, int, int] | None = None
+        self._energy_to_cache: dict[float, float] = {}
 
         dev_sect_name = 'power.' + self.commons.dev_id
         dev_conf = config[dev_sect_name]
@@ -25,44 +34,116 @@ class KBatteries:
             old_stats_batdict = old_stats.get('batteries', None)
 
         if 'batteries' in dev_conf:
-            _ids = [ bname.strip() for bname in dev_conf['batteries'].split(',') ]
+            strings = [[bname.strip() for bname in s.split('+')] for s in dev_conf['batteries'].split(',')]
         else:
-            _ids = [ 'main' ]
-
-        for bid in _ids:
-            batt_sect_name = 'battery.' + bid
-            if batt_sect_name not in config:
-                self.messages.append(f'ERROR: battery section {batt_sect_name} is not found in config')
-                continue
-
-            batt_conf = config[batt_sect_name]
-            if 'type' not in batt_conf:
-                self.messages.append(f'ERROR: battery section "{batt_sect_name}" have no battery information')
-                continue
-
-            btype = batt_conf['type'].strip()
-
-            if old_stats_batdict is not None and bid not in old_stats_batdict:
-                self.messages.append(f'WARNING: stats file is missing battery "{bid}" section')
-
-            if btype == 'pb':
-                self._batteries.append(KBattLead(bid, dev_commons, config, old_stats_batdict))
-                self._ids.append(bid)
-            # elif bt == 'lifepo':
-            #         self.batteries.append(KBattLiFePO(bid, dev_defaults, config, old_stats_batteries))
-            else:
-                # KBattStats is a failsafe to be able to provide some basic services
-                #self._batteries.append(KBattStats(bid, dev_commons, config, old_stats_batteries))
-                self.messages.append(f'ERROR: config section "{batt_sect_name}" has invalid battery type')
-                continue
-
-            if self._batteries:
-                if self._batteries[-1].invalid:
-                    self.messages.extend(self._batteries[-1].messages)
-                else:
-                    self.capacity_wh += self._batteries[-1].capacity_wh
-
-        if old_stats is not None:  # purging our own info from old stats, while checking if there are extra data
+            strings = [[ 'main' ]]
+
+        for string in strings:
+            batts = []
+            for bid in string:
+                b = self._add_battery(bid, config, old_stats_batdict)
+                if b is not None:
+                    batts.append(b)
+
+            if batts:
+                self._strings.append(batts)
+
+        self._ids = tuple(b.id for b in self._batteries)
+        self._apply_topology()
+        self._purge_old_stats(old_stats)
+
+
+    ########################################
+    def _add_battery(self, bid: str, config: ConfigParser, old_stats_batdict: dict | None) -> KBattStats | None:
+        """Creates a battery object from its config section
+        :param bid: battery ID
+        :param config: ConfigParser: .ini file configuration
+        :param old_stats_batdict: dict: JSON 'batteries' dict from permastorage or None
+        :return: battery object or None if it is not possible
+        """
+        batt_sect_name = 'battery.' + bid
+        if batt_sect_name not in config:
+            self.messages.append(f'ERROR: battery section {batt_sect_name} is not found in config')
+            return None
+
+        if bid in self._by_id:
+            self.messages.append(f'ERROR: battery "{bid}" is listed more than once')
+            return None
+
+        batt_conf = config[batt_sect_name]
+        if 'type' not in batt_conf:
+            self.messages.append(f'ERROR: battery section "{batt_sect_name}" have no battery information')
+            return None
+
+        btype = batt_conf['type'].strip()
+
+        if old_stats_batdict is not None and bid not in old_stats_batdict:
+            self.messages.append(f'WARNING: stats file is missing battery "{bid}" section')
+
+        b: KBattStats
+        if btype == 'pb':
+            b = KBattLead(bid, self.commons, config, old_stats_batdict)
+        elif btype == 'lifepo':
+            b = KBattLiFePO(bid, self.commons, config, old_stats_batdict)
+        else:
+            # KBattStats is a failsafe to be able to provide some basic services
+            #self._batteries.append(KBattStats(bid, dev_commons, config, old_stats_batteries))
+            self.messages.append(f'ERROR: config section "{batt_sect_name}" has invalid battery type')
+            return None
+
+        self._batteries.append(b)
+        self._by_id[bid] = b
+        b.on_capacity_change = self._capacity_changed
+        if b.invalid:
+            self.messages.extend(b.messages)
+        else:
+            self.capacity_wh += b.capacity_wh
+
+        return b
+
+
+    ########################################
+    def _apply_topology(self) -> None:
+        """Sets each battery's share of the load, bank voltage and charging current from the strings layout.
+        Parallel strings share the current by their capacity. Batteries in series share the string's voltage"""
+        strings_v = [sum(b.v_nom for b in s) for s in self._strings]
+        if len(set(strings_v)) > 1:
+            self.messages.append(f'WARNING: parallel battery strings have different voltages: {strings_v}')
+
+        strings_ah = [min(b.capacity_ah_nom for b in s) for s in self._strings]  # the weakest one limits
+        total_ah = sum(strings_ah)
+
+        for string, string_v, string_ah in zip(self._strings, strings_v, strings_ah):
+            if total_ah > 0 and string_ah > 0:
+                current_share = string_ah / total_ah
+            else:  # broken config. At least don't crash
+                current_share = 1.0 / len(self._strings)
+
+            for b in string:
+                b.voltage_scale = b.v_nom / string_v if string_v > 0 else 1.0
+                b.load_share = current_share * b.voltage_scale
+                b.charging_speed_wh = int(b.charging_speed_wh * current_share)
+
+
+    ########################################
+    def _invalidate(self) -> None:
+        """Drops the aggregates cached since the last sample"""
+        self._power_cache = None
+        self._energy_to_cache.clear()
+
+
+    ########################################
+    def _capacity_changed(self, old_wh: int, new_wh: int) -> None:
+        """Called by a battery when its health check has changed its capacity. The cached aggregates are stale then"""
+        self.capacity_wh += new_wh - old_wh
+        self._invalidate()
+
+
+    ########################################
+    def _purge_old_stats(self, old_stats: dict | None) -> None:
+        """Purging our own info from old stats, while checking if there are extra data"""
+        if old_stats is not None:
+            old_stats_batdict = old_stats.get('batteries', None)
             if old_stats_batdict is not None:
                 for bid in old_stats_batdict.keys():
                     self.messages.append(f'NOTE: stats file has an extra batteries section: "{bid}"')
@@ -70,18 +151,39 @@ class KBatteries:
         # missing "batteries" section is not an error - it's a sign of a fresh new setup with no saved stats
 
 
+    ########################################
+    def merge_permastats(self, old_stats: dict | None) -> None:
+        """Merges saved stats loaded after the batteries were set up and have been working with a fresh data.
+        :param old_stats: dict: the whole device's saved stats or None
+        :return: None
+        """
+        if old_stats is None:
+            return
+
+        old_stats_batdict = old_stats.get('batteries', None)
+        if old_stats_batdict is not None:
+            for b in self._batteries:
+                if b.id not in old_stats_batdict:
+                    self.messages.append(f'WARNING: stats file is missing battery "{b.id}" section')
+                    continue
+
+                was_invalid = b.invalid
+                b.merge_saved_stats(old_stats_batdict)
+                if b.invalid and not was_invalid:
+                    self.messages.extend(b.messages)
+                    self.capacity_wh -= b.capacity_wh
+
+        self._invalidate()
+        self._purge_old_stats(old_stats)
+
+
     ########################################
     def __getitem__(self, _id: str) -> KBattStats | None:
         """Returns a battery object by its ID
         :param _id: battery name
         :return: KBattStats object or None
         """
-
-        for b in self._batteries:
-            if b.id == _id:
-                return b
-
-        return None
+        return self._by_id.get(_id)
 
 
     ########################################
@@ -96,10 +198,25 @@ class KBatteries:
     ########################################
     def process_upsc_data(self, upsc_data: dict) -> None:
         """Will process new upsc data"""
+        self._invalidate()
         for b in self._batteries:
             b.process_upsc_data(upsc_data)
 
 
+    ########################################
+    def is_steady(self) -> bool:
+        """True if all batteries can fast_forward() the last sample"""
+        return all(b.is_steady() for b in self._batteries)
+
+
+    ########################################
+    def fast_forward(self, count: int) -> None:
+        """Repeats the last processed sample count times. See KBattStats.fast_forward()"""
+        self._invalidate()
+        for b in self._batteries:
+            b.fast_forward(count)
+
+
     ########################################
     def get_permastats(self) -> dict:
         """Returns a copy of internal perma stats dictionary,
@@ -112,9 +229,23 @@ class KBatteries:
 
 
     ########################################
-    def get_list(self) -> list[str]:
-        """Returns a list of device-attached battery IDs"""
-        return self._ids.copy()
+    def get_list(self) -> tuple[str, ...]:
+        """Returns device-attached battery IDs"""
+        return self._ids
+
+
+    ########################################
+    def get_energy_to(self, charge: float) -> float:
+        """Returns the total energy batteries deliver from their current charge down to the given level.
+        See KBattStats.get_energy_to()
+        :param charge: float: target charge level in percents
+        :return: float: Wh
+        """
+        energy = self._energy_to_cache.get(charge)
+        if energy is None:
+            energy = self._energy_to_cache[charge] = sum(b.get_energy_to(charge) for b in self._batteries)
+
+        return energy
 
 
     ########################################
@@ -124,8 +255,11 @@ class KBatteries:
          - remaining Wh: int
          - remaining percentage: float
          - total capacity wh: int
-         - avg charging speed in Wh: int)
+         - total charging speed in Wh: int)
+         It is computed once per sample
          """
+        if self._power_cache is not None:
+            return self._power_cache
 
         if  len(self._batteries) == 0:
             return 0, 0.0, 0, -1
@@ -136,8 +270,8 @@ class KBatteries:
         for b in self._batteries:
             rwh += b.get_remaining_wh()
             cap += int(b.capacity_wh)
-            chspd += b.charging_speed_wh
+            chspd += b.charging_speed_wh  # already scaled by the string's share of current
 
-        return rwh, (0.0 if cap == 0 else round(100.0 * rwh / cap, 1)), \
-                cap, chspd // len(self._batteries)
+        self._power_cache = (rwh, (0.0 if cap == 0 else round(100.0 * rwh / cap, 1)), cap, chspd)
+        return self._power_cache
 
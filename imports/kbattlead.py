@@ -2,21 +2,18 @@
 The main feature is the KBattLead class that provides means to manage a Lead-Acid type battery.
 Made by Andrej Pakhutin"""
 
-import copy
+from bisect import bisect_right
 from configparser import ConfigParser, SectionProxy
 import kadpy.kbattstats as kbattstats
 import kadpy.kpowerutils as kpu
 from kadpy.kpowerutils import KPowerDeviceCommons
-import time
-from typing import Any, override
+from typing import Iterable, override
 
 # Lead-acid battery constants
 _volts_at_charge: list[float] = [
     #  0     10     20     30     40     50     60    70    80     90    100
     10.8, 11.51, 11.66, 11.81, 11.95, 12.05, 12.15, 12.3, 12.5, 12.75, 12.85]
 
-# volt lvl diff: 0->10 10->20 20->30 30->40 40->50 50->60 60->70 70->80 80->90 90->100
-_v_charge_diff: list[float] = [0.71, 0.15, 0.15, 0.14, 0.1, 0.1, 0.15, 0.2, 0.25, 0.1]
 _v_99: float = 12.80  # 99%. just in case
 _v_float: float = 13.5  # 'float' charge
 _v_boost: float = 14.1  # 'boost' charge
@@ -29,25 +26,102 @@ _CS_BOOST: int = 1  # when charging and V_batt < _v_boost still
 _CS_FLOAT: int = 2  # when charging and V_batt been around _v_boost (CC), but dropped to float (CV)
 
 
+
+# voltage -> charge lookup tables range (mV) for a single 12v element. Expanded if the curve goes beyond
+_LUT_V_LOW: int = 10_500
+_LUT_V_HIGH: int = 13_000
+
+
+########################################
+class KVoltageCurve:
+    """
+    Approximates battery charge level from the voltage of a single 12v element.
+    Charge is linear between the points of a curve that are set for each 10% from 0 to 100.
+    The conversion is done through the table with 1mV steps, precomputed from the curve on creation.
+    Use KVoltageCurve.get() to share the tables between the batteries of the same model.
+    """
+    _cache: dict[tuple[float, ...], 'KVoltageCurve'] = {}
+
+    def __init__(self, volts_at_charge: list[float], v_99: float | None = None) -> None:
+        """
+        :param volts_at_charge: list[float]: 11 increasing voltages for 0, 10, ... 100% charge
+        :param v_99: float: voltage above which it is 99%, just in case. None to skip this check
+        """
+        if len(volts_at_charge) != 11 or any(a >= b for a, b in zip(volts_at_charge, volts_at_charge[1:])):
+            raise ValueError('should be 11 increasing voltages for each 10% of charge')
+
+        self.volts_at_charge: tuple[float, ...] = tuple(volts_at_charge)
+        self._v_99: float = volts_at_charge[-1] if v_99 is None else v_99
+
+        # outside the table's range the charge is the same as on its edges: 0% and 100%
+        self._lut_low: int = min(_LUT_V_LOW, int(volts_at_charge[0] * 1000))
+        lut_high: int = max(_LUT_V_HIGH, int(volts_at_charge[-1] * 1000) + 1)
+        self._lut: list[float] = [self.exact(mv / 1000.0) for mv in range(self._lut_low, lut_high + 1)]
+
+    ########################################
+    @classmethod
+    def get(cls, volts_at_charge: list[float], v_99: float | None = None) -> 'KVoltageCurve':
+        """Returns the shared curve object, creating it on the 1st use"""
+        key = (*volts_at_charge, -1.0 if v_99 is None else v_99)
+        if key not in cls._cache:
+            cls._cache[key] = cls(volts_at_charge, v_99)
+
+        return cls._cache[key]
+
+    ########################################
+    def exact(self, v: float) -> float:
+        """
+        Calculates charge level directly from the curve. Used to fill the lookup table
+        :param v: float: voltage
+        :return: float: charge level in percents
+        """
+        vac = self.volts_at_charge
+        if v >= vac[-1]: return 100.0
+        if v >= self._v_99: return 99.0
+        if v <= vac[0]: return 0.0
+
+        i = bisect_right(vac, v) - 1
+        return round(10.0 * i + 10.0 * (v - vac[i]) / (vac[i + 1] - vac[i]), 1)
+
+    ########################################
+    def to_charge(self, v: float) -> float:
+        """
+        Converts voltage to charge level using the lookup table
+        :param v: float: voltage
+        :return: float: charge level in percents
+        """
+        i = round(v * 1000.0) - self._lut_low
+        if i < 0:
+            return self._lut[0]
+        if i >= len(self._lut):
+            return self._lut[-1]
+
+        return self._lut[i]
+
+    ########################################
+    def to_charge_many(self, volts: Iterable[float]) -> list[float]:
+        """
+        Converts a series of voltages in one go. E.g. for the historical data processing
+        :param volts: iterable of float: voltages
+        :return: list[float]: charge levels in percents, the same as to_charge() would give for each
+        """
+        lut = self._lut
+        low = self._lut_low
+        top = len(lut) - 1
+        return [lut[min(max(round(v * 1000.0) - low, 0), top)] for v in volts]
+
+
+_default_curve = KVoltageCurve.get(_volts_at_charge, _v_99)
+
+
 ########################################
 def _voltage_to_charge(v: float) -> float:
     """
-    Approximates battery charge level from the current voltage of a single 12v element
+    Approximates battery charge level from the current voltage of a single 12v element using default curve
     :param v: float: voltage
     :return: float: charge level in percents
     """
-    if v >= _volts_at_charge[-1]: return 100.0
-    if v >= _v_99: return 99.0
-    if v <= _volts_at_charge[0]: return 0.0
-    i = 1
-    while i < 9:
-        if v < _volts_at_charge[i]:
-            break
-        i += 1
-
-    i -= 1
-    charge = 10.0 * i
-    return round(charge + 10.0 * (v - _volts_at_charge[i]) / _v_charge_diff[i], 1)
+    return _default_curve.to_charge(v)
 
 
 ########################################
@@ -73,9 +147,17 @@ class KBattLead(kbattstats.KBattStats):
         self._last_v = -1.0  # last recorded voltage
         self._last_v_step_up_ts = 0.0  # timestamp of the last voltage change. Used on > float charge
         self._charge_state = _CS_NONE
-        self._pack_size: int = self.v_nom // 12
         self.charging_speed_wh = self.v_nom * dev_commons.charging_current
 
+        # battery model's voltage to charge curve
+        self._curve: KVoltageCurve = _default_curve
+        if 'volts_at_charge' in batt_conf:
+            try:
+                self._curve = KVoltageCurve.get([float(x) for x in batt_conf['volts_at_charge'].split(',')])
+            except ValueError as e:
+                self.invalid = True
+                self.messages.append(f'ERROR: {batt_conf_name}: invalid volts_at_charge: {e}')
+
         if self.invalid:
             return
 
@@ -100,11 +182,11 @@ class KBattLead(kbattstats.KBattStats):
                 self.charge = round(float(upsc_data['battery_charge']), 1)
                 return self.charge
 
-        v = float(upsc_data['battery_voltage']) / self._pack_size
+        v = self._element_voltage(upsc_data)
 
         if discharging:
             self._charge_state = _CS_NONE
-            self.charge = _voltage_to_charge(v)
+            self.charge = self._curve.to_charge(v)
             if v < self._last_v:
                 self._last_v = v
 
@@ -117,7 +199,7 @@ class KBattLead(kbattstats.KBattStats):
 
         if v > self._last_v:
             self._last_v = v
-            self._last_v_step_up_ts = time.time()
+            self._last_v_step_up_ts = self.commons.clock.now
 
         if self._charge_state == _CS_BOOST:
             if self._last_v > _v_float:  # we need to be creative in this voltage zone
@@ -129,7 +211,7 @@ class KBattLead(kbattstats.KBattStats):
 
                 # here, assume if battery has not gained > 0.2V (~5.5%) of charge
                 # for the time it should have had with 10Amp current - it is in float state already.
-                elif time.time() - self._last_v_step_up_ts > \
+                elif self.commons.clock.now - self._last_v_step_up_ts > \
                         self.capacity_ah_nom / self.commons.charging_current * 3600:
                     self._charge_state = _CS_FLOAT
 
@@ -146,14 +228,10 @@ class KBattLead(kbattstats.KBattStats):
 
 
     ########################################
+    @override
     def _init_for_new_sector(self, upsc_data: dict, discharging: bool, load: float,
                              v: float, charge: float) -> None:
-        self._charge_sector = int(charge / kpu.SECTOR_WIDTH)
-        self._charge_sector_start = charge
-        self._was_discharging = discharging
-        self._time_in_charge_sector = 0
-        self._load_avg = load
-        self._state_samples = 1
+        super()._init_for_new_sector(upsc_data, discharging, load, v, charge)
         self._charge_state = _CS_NONE
 
 
@@ -166,6 +244,7 @@ class KBattLead(kbattstats.KBattStats):
         :return: None
         """
         super().process_upsc_data(upsc_data)  # update common stuff
+        self._last_sample_used = False
 
         if self.invalid:
             return
@@ -173,126 +252,17 @@ class KBattLead(kbattstats.KBattStats):
         if 'battery_voltage' not in upsc_data:
             return
 
-        load = self.commons.last_load
+        load = self.commons.last_load * self.load_share
         discharging = self.commons.on_battery
-        v = float(upsc_data['battery_voltage']) / self._pack_size
+        v = self._element_voltage(upsc_data)
         charge = self._determine_charge(upsc_data, discharging)
 
-        if self._charge_sector == -1:
-            self._init_for_new_sector(upsc_data, discharging, load, v, charge)
-            return
-
-        charge_sector = int(charge / kpu.SECTOR_WIDTH)
-
-        # Are there state transitions? important rule: no direction change
-        # Jitter detection: may jolt up on discharge and down on a charge
-        if discharging == self._was_discharging \
-            and ( charge_sector == self._charge_sector
-                or ( discharging and charge_sector > self._charge_sector )
-                or ( not discharging and charge_sector < self._charge_sector)):
-            # let's say it's still the same
-            self.charge = charge
-            self._time_in_charge_sector += self.commons.sample_interval
-            self._load_avg, self._state_samples = kpu.update_avg_float(self._load_avg, load,
-                                                                              self._state_samples)
-            return
-
-        # Something changed.
-        # Check if we have enough time in a previous state to extrapolate if needed.
-        # We want a recorded charge range to be more than 70%+ of this sector width
-        ch_left: float
-        if self._was_discharging:  # want to operate on a previous sector's bound
-            ch_left = (self._charge_sector + 1) * kpu.SECTOR_WIDTH - self._charge_sector_start
-        else:
-            ch_left = self._charge_sector_start - self._charge_sector * kpu.SECTOR_WIDTH
-
-        if ch_left / kpu.SECTOR_WIDTH <= 0.5:  # are there less than 50%+ of sector width left unaccounted?
-            if ch_left > 0.0:  # need to extrapolate
-                self._time_in_charge_sector += int(self._time_in_charge_sector * ch_left / kpu.SECTOR_WIDTH)
-
-            # adding normalized. Week shift will be performed in avg_add if needed
-            if self._load_avg > 0.0:
-                self._weekly_avg_add('discharge_speed' if self._was_discharging else 'charge_speed',
-                             self._load_avg * self._time_in_charge_sector, self._charge_sector)
-
-        if not discharging and self._was_discharging:  # went OB->OL. Adding health stat
-            if self.charge >= 80.0:
-                self._pdata['health']['cycles'][0] += 1
-            elif self.charge >= 50.0:
-                self._pdata['health']['cycles'][1] += 1
-            else:
-                self._pdata['health']['cycles'][2] += 1
-
-        self._init_for_new_sector(upsc_data, discharging, load, v, charge)
-        self.charge = charge
+        self._last_sample_used = True
+        self._update_sectors(upsc_data, discharging, load, v, charge)
 
 
     ########################################
     @override
-    def get_battery_health(self) -> dict:
-        """Returns battery health information within a dict:
-        - "cycles": [<soft>,<norm>,<bad>] - (dis)charge cycles count for 100-80%, 80-50% and <50%.
-        - "status": "Whatever" - "OK" is OK.
-        - "tbf": <weeks before a failure> - -1 if no failure planned to happen.
-        - "wellness": <percent> - Computed amount of the actual capacity left.
-        This structure is a copy of a saved perma-stats battery element "health"
-        """
-        bdh: dict[str,Any] = self._pdata['health']
-
-        if self.invalid:
-            bdh['status'] = "Invalid setup!"
-            return bdh
-
-        dspeed_avg = 0.0
-        samples = 0
-        # Look at the last month worth of data max, to not spoil average too much
-        for week in range(min(4, len(self._pdata['weekly']['discharge_speed_avg']))):
-            for cs in range(1, kpu.CHARGE_STEPS):  # not counting <10% and 100% zones
-                v = self._pdata['weekly']['discharge_speed_avg'][week][cs]
-                if v > 0.0:
-                    dspeed_avg += v
-                    samples += 1
-
-            if samples > 2 * kpu.CHARGE_STEPS:  # count 2 weeks or more for better averaging
-                break
-
-        status = []
-        if samples >= 5:  # ensure there is some variety
-            dspeed_avg /= samples
-            wellness = round(dspeed_avg / self._ideal_sector_speed, 2)
-        else:
-            wellness = 1.0
-            # cycles: < nice >, < normal >, < worst >
-            wellness -= bdh['cycles'][0] / 6000.0  # Theoretically 6k is possible in a pampered conditions
-            wellness -= bdh['cycles'][1] / 3000.0  # more or less standard
-            wellness -= bdh['cycles'][2] / 500.0
-
-        if wellness >= 0.8:
-            status.append('OK (>80%)')
-            # wellness = 10 * round(10.0 * wellness)  #  Show 10% precision for higher vitality
-        else:
-            if wellness >= 0.5:  #  Show 5% precision for medium vitality
-                ws = wellness * 10.0
-                wi = int(ws)
-                if ws - wi >= 0.5:
-                    wi = wi * 10 + 5
-                else:
-                    wi = wi * 10
-                status.append(f'Aged: {wi}%')
-            else:  # full precision for end of life
-                if wellness < 0.0:
-                    wellness = 0.0
-
-                if wellness >= 0.2:
-                    status.append(f'Failing: {int(100.0 * wellness)}%')
-                else:
-                    status.append(f'Trash it')
-
-        bdh['status'] = ', '.join(status)
-        self.wellness = int(100.0 * wellness)
-        self.capacity_wh = int(self.capacity_ah_nom * self.v_nom * self.commons.power_factor * wellness)
-        bdh['wellness'] = self.wellness
-        return copy.deepcopy(bdh)
-
-
-
+    def is_steady(self) -> bool:
+        """Charge state may switch by the time passed while the voltage is high in the boost mode"""
+        return not (self._charge_state == _CS_BOOST and self._last_v > _v_float)
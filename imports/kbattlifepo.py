@@ -1,22 +1,180 @@
-import kbattstats
+"""kadpy.kbattlifepo: This module is a part of the hardware monitoring toolset from GitHub/kadavris/monitoring
+The main feature is the KBattLiFePO class that provides means to manage a LiFePO4 type battery.
+Made by Andrej Pakhutin"""
+
+from configparser import ConfigParser
+import kadpy.kbattstats as kbattstats
+from kadpy.kpowerutils import KPowerDeviceCommons
+from typing import Any, override
+
+# LiFePO4 battery constants for a single 12v element (4 cells in series)
+_v_full: float = 13.6  # 3.4v per cell. Reaching it on mains means the battery is full
+_v_cutoff: float = 11.6  # 2.9v per cell. Reaching it on battery means it is empty
+_charge_efficiency: float = 0.95  # part of the charging energy that is actually stored
+_max_gap: int = 5  # sample intervals. Longer gaps between samples are not integrated: no idea what was there
+_learn_min: float = 0.2  # full to empty runs that drained less than this part of capacity are not trusted
+
+
+########################################
+class KBattLiFePO(kbattstats.KBattStats):
+    """
+    Class for managing statistics for LiFePO4 battery types.
+    LiFePO4 voltage is almost flat over the most of the charge range, so voltage can't tell the charge level.
+    Instead, the energy going in and out is counted over the actual time passed between samples (coulomb counting).
+    Counting errors are reset when voltage reaches the full charge or low cutoff levels.
+    Energy drained on a full run between those two gives the real usable capacity.
+    """
+    def __init__(self, batt_id: str, dev_commons: KPowerDeviceCommons, config: ConfigParser,
+                 old_stats: dict | None) -> None:
+        super().__init__(batt_id, dev_commons, config, old_stats)
+
+        batt_conf_name = 'battery.' + batt_id
+        batt_conf = config[batt_conf_name]
+
+        self.charging_speed_wh = self.v_nom * dev_commons.charging_current
+
+        # coulomb counter
+        self._usable_wh: float = self._pdata['usable_wh']  # learned energy between anchors. 0 - use capacity_wh
+        self._energy_wh: float = self.charge / 100.0 * self._counter_wh  # stored right now
+        self._run_wh: float = 0.0  # drained since the last full anchor
+        self._run_valid: bool = False  # is there a clean full -> empty run going on?
+        self._last_ts: float = 0.0  # time of the last counted sample
+        self._counting: bool = False  # was the last sample counted? (or the device's charge report was used)
+
+        try:
+            self._v_full: float = batt_conf.getfloat('v_full', _v_full)
+            self._v_cutoff: float = batt_conf.getfloat('v_cutoff', _v_cutoff)
+        except ValueError as e:
+            self.invalid = True
+            self.messages.append(f'ERROR: {batt_conf_name}: invalid voltage level: {e}')
+            return
+
+        if self._v_cutoff >= self._v_full:
+            self.invalid = True
+            self.messages.append(f'ERROR: {batt_conf_name}: v_cutoff should be lower than v_full')
 
-class KBATTLIFEPO(kbattstats.KBattStats):
-    def __init__(self, save_file: str, dev_data: dict):
-        super().__init__(save_file, dev_data)
-        self.type: int = kbattstats.BT_LIFEPO
 
     ########################################
-    def get_charge_percent(self, data: dict) -> int:
+    @override
+    def _make_init_data(self) -> dict[str, Any]:
+        """Adds the learned usable energy to the perma stats: a clean full to empty run may take months to repeat"""
+        pd = super()._make_init_data()
+        pd['usable_wh'] = 0.0
+        return pd
+
+
+    ########################################
+    @override
+    def merge_saved_stats(self, saved_stats: dict) -> None:
+        """See KBattStats.merge_saved_stats(). Usable energy learned since the start is newer than the saved one"""
+        learned = self._usable_wh
+        super().merge_saved_stats(saved_stats)
+        if learned > 0.0:
+            self._pdata['usable_wh'] = learned
+
+        self._usable_wh = self._pdata['usable_wh']
+
+
+    ########################################
+    @property
+    def _counter_wh(self) -> float:
+        """Full scale of the counter: learned usable energy or the capacity from health estimation"""
+        return self._usable_wh if self._usable_wh > 0.0 else float(self.capacity_wh)
+
+
+    ########################################
+    def _determine_charge(self, upsc_data: dict, discharging: bool, load: float, v: float) -> float:
         """
-        Based on device's configuration will return batterg charge level as reported by device
-        or calculated by other means
-        :param data: dict: data collected from device interface
-        :return: int: charge level in percents
+        Updates the energy counter with the time passed since the previous sample and returns the charge level.
+        WARNING! Should be called once per sample because it records state changes internally!
+        :param upsc_data: dict: data collected from device interface
+        :param discharging: bool: True if discharging mode is detected in the current data packet
+        :param load: float: current load in Watts
+        :param v: float: voltage of a single 12v element
+        :return: float: charge level in percents
         """
-        return 100
+        now = self.commons.clock.now
+        dt = now - self._last_ts
+        self._last_ts = now
+        if dt <= 0.0 or dt > _max_gap * self.commons.sample_interval:
+            dt = 0.0
+
+        full_wh = self._counter_wh
+
+        if not self._calc_charge_data and 'battery_charge' in upsc_data:  # device knows better
+            self._counting = False
+            charge = round(float(upsc_data['battery_charge']), 1)
+            self._energy_wh = charge / 100.0 * full_wh
+            return charge
+
+        self._counting = True
+        if discharging:
+            drained = load * dt / 3600.0
+            self._energy_wh -= drained
+            self._run_wh += drained
+
+            if v <= self._v_cutoff:  # empty
+                if self._run_valid and self._run_wh >= _learn_min * self.capacity_wh:
+                    self._usable_wh = self._pdata['usable_wh'] = self._run_wh
+                    full_wh = self._usable_wh
+
+                self._run_valid = False
+                self._energy_wh = 0.0
+        else:
+            stored = self.charging_speed_wh * dt / 3600.0 * _charge_efficiency
+            if stored > 0.0:
+                self._energy_wh += stored
+                self._run_valid = False  # not a clean run anymore
+
+            if v >= self._v_full:  # full
+                self._energy_wh = full_wh
+                self._run_wh = 0.0
+                self._run_valid = True
+
+        self._energy_wh = min(max(self._energy_wh, 0.0), full_wh)
+        return round(100.0 * self._energy_wh / full_wh, 1) if full_wh > 0.0 else 0.0
 
 
     ########################################
-    def update_stats(self, data: dict) -> None:
+    @override
+    def process_upsc_data(self, upsc_data: dict) -> None:
+        """
+        Updates stats data breakdowns with new set from device
+        :param upsc_data: dict: device's current state
+        :return: None
+        """
+        super().process_upsc_data(upsc_data)  # update common stuff
+        self._last_sample_used = False
+
         if self.invalid:
             return
+
+        if 'battery_voltage' not in upsc_data:
+            return
+
+        load = self.commons.last_load * self.load_share
+        discharging = self.commons.on_battery
+        v = self._element_voltage(upsc_data)
+        charge = self._determine_charge(upsc_data, discharging, load, v)
+
+        self._last_sample_used = True
+        self._update_sectors(upsc_data, discharging, load, v, charge)
+        self.charge = charge
+
+
+    ########################################
+    @override
+    def is_steady(self) -> bool:
+        """The counter moves with every sample, unless the battery is full and on mains"""
+        if not self._counting or self.invalid:
+            return True
+
+        return not self.commons.on_battery and (self.charge >= 100.0 or self.charging_speed_wh <= 0)
+
+
+    ########################################
+    @override
+    def fast_forward(self, count: int) -> None:
+        super().fast_forward(count)
+        if count > 0 and self._last_sample_used:
+            self._last_ts = self.commons.clock.now  # the caller has moved the clock to the last repeated sample
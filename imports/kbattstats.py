@@ -8,8 +8,20 @@ import copy
 import kadpy.kpowerutils as kpu
 from kadpy.kpowerutils import KBatteryTypes
 from kadpy.kpowerutils import KPowerDeviceCommons
-import time
-from typing import Any, cast
+from types import MappingProxyType
+from typing import Any, Callable, Mapping, cast
+
+# wellness (part of nominal capacity left) thresholds for the health status
+_WELLNESS_AGED: float = 0.8
+_WELLNESS_FAILING: float = 0.5
+_WELLNESS_TRASH: float = 0.2
+# time before failure projection
+_TREND_WEEKS: int = 12  # how many last weeks of wellness to fit the trend into
+_TREND_MIN_WEEKS: int = 3  # less is not a trend yet
+_WEEK_MIN_SECTORS: int = 5  # sectors with discharge data needed to estimate week's wellness
+# discharge energy table
+_TABLE_WEEKS: int = 12  # how many last weeks of sector speeds are used
+_TABLE_HALF_LIFE: float = 4.0  # weeks. Older data weighs less, to follow the aging
 
 
 ########################################
@@ -39,11 +51,25 @@ class KBattStats:
         self.capacity_wh: int = int(self.capacity_ah_nom * self.v_nom * dev_commons.power_factor)
         self.charging_speed_wh: int = 0  # dummy value. Should be computed in a subclass
         self.wellness: int = 100  # Wear indicator. Percentage of nominal capacity remaining.
+        # place in the bank. Set by KBatteries from the series/parallel layout
+        self.load_share: float = 1.0  # part of the device's load this battery carries
+        self.voltage_scale: float = 1.0  # part of the reported bank voltage that is across this battery
+        # called with (old, new) when get_battery_health() changes capacity_wh. Set by KBatteries to drop its aggregates
+        self.on_capacity_change: Callable[[int, int], None] | None = None
 
         # private:
         self._calc_charge_data = batt_conf.getboolean('calc_charge_data', dev_commons.calc_charge_data)
         self._ideal_sector_speed: int = 3600 * self.capacity_wh // (kpu.CHARGE_STEPS - 1)
+        self._pack_size: int = max(1, self.v_nom // 12)  # number of 12v elements in series
         self._pdata: dict[str, Any]  # persistent data that may be saved into a file
+        # get_battery_health() result is memoized until its inputs change: weekly speeds, cycles or loaded data
+        self._health_dirty: bool = True
+        self._health_view: Mapping[str, Any] | None = None
+        self._health_wellness: float | None = None  # the view's wellness, to re-project tbf as time goes
+        # cumulative energy from 0% to each sector's start, learned from the discharge speeds. See _energy_table()
+        self._energy_cum: list[float] = []
+        self._energy_cum_dirty: bool = True
+        self._energy_cum_cap: int = -1  # capacity_wh the table was built with. Used for sectors without data
 
         # initial current states
         self._charge_sector: int = -1  # which charge percentage sector we are in (see CHARGE_STEPS)
@@ -52,10 +78,34 @@ class KBattStats:
         self._load_avg: float = 0.0  # avg load level at this charge level
         self._state_samples: int = 0  # how many times update have been called while in this sector
         self._was_discharging: bool = False  # is battery discharging?
+        self._last_sample_used: bool = False  # has the last sample reached _update_sectors()? See fast_forward()
+
+        # time before failure projection from the weekly wellness history
+        self._wellness_trend: kpu.KLinearTrend = kpu.KLinearTrend(_TREND_WEEKS)
+        self._trend_last_week: int = -1  # start_ts of the latest week in trend
 
         # prep a fallback data. Also used to match current config against loaded JSON
-        init_data: dict = {
-            'registered': [int(time.time()), time.asctime()],
+        self._pdata = self._make_init_data()
+
+        if saved_stats and (batt_id in saved_stats):  # is there are smth inside 'batteries': {} ?
+            self._load_saved_stats(saved_stats)
+
+        # add new week items to start with
+        self._weekly_shift()
+
+
+    ########################################
+    def _stats_changed(self) -> None:
+        """Marks the values computed from the perma stats as stale"""
+        self._health_dirty = True
+        self._energy_cum_dirty = True
+
+
+    ########################################
+    def _make_init_data(self) -> dict[str, Any]:
+        """Returns a fresh perma stats structure for this battery"""
+        return {
+            'registered': [int(self.commons.clock.now), self.commons.clock.asctime()],
             'type': str(self.type),
             'vnom': self.v_nom,
             'capacity_ah': self.capacity_ah_nom,
@@ -70,66 +120,102 @@ class KBattStats:
             'weekly': {
                 'start_ts': [],  # starting timestamp of the week
                 # charge and discharge speeds arrays. For initialization details see ._weekly_shift()
-                # Each week is a list with CHARGE_STEPS items with _avg ones holding time divided by avg load
-                # and _samples ones are the count of samples for continuous averaging
-                'discharge_speed_avg': [],
-                'discharge_speed_samples': [],
-                'charge_speed_avg': [],
-                'charge_speed_samples': [],
+                # Each week is a list with CHARGE_STEPS accumulators of sector time multiplied by avg load
+                'discharge_speed': [],
+                'charge_speed': [],
             }
         }
 
-        if saved_stats and (batt_id in saved_stats):  # is there are smth inside 'batteries': {} ?
-            my_old_stats = saved_stats[batt_id]
-            # validating
-            err_prefix = f'ERROR: {batt_id} old stats: '
-            warn_prefix = f'WARNING: {batt_id} old stats: '
-            discard_stats = False
-
-            m = kpu.validate_structure(init_data, my_old_stats, err_prefix)
-            if m:
-                self.invalid = True
-                self.messages.extend(m)
-
-            if 'messages' in my_old_stats and len(my_old_stats['messages']) > 0:  # Oh. That was already broken
-                for m in my_old_stats['messages']:
-                    if 'have OLD message' not in m and (m.startswith('ERROR') or m.startswith('WARNING')):
-                        self.invalid = m.startswith('ERROR')
-                        self.messages.append(err_prefix + "have OLD message: " + m)
-
-            t = int(time.time())
-            rt = my_old_stats['registered']
-            if (len(rt) != 2 or type(rt[0]) is not int
-                    or rt[0] < t - kpu.SECONDS_IN_YEAR or rt[0] >= t):
-                discard_stats = True
-                self.messages.append(warn_prefix + "registration time is suspicious: " + str(rt) )
-
-            w = my_old_stats['weekly']
-            wlen = len(w['start_ts'])
-            if (wlen != len(w['discharge_speed_avg'])
-                    or wlen != len(w['discharge_speed_samples'])
-                    or wlen != len(w['charge_speed_avg'])
-                    or wlen != len(w['charge_speed_samples'])):
+
+    ########################################
+    def _load_saved_stats(self, saved_stats: dict) -> bool:
+        """
+        Validates this battery's part of saved stats and adopts it as the current perma data if it is OK.
+        The battery's item is removed from saved_stats in any case.
+        :param saved_stats: dict: JSON 'batteries' dict from permastorage. Should have our ID inside
+        :return: bool: True if saved data were adopted
+        """
+        my_old_stats = saved_stats.pop(self.id)
+        # validating
+        err_prefix = f'ERROR: {self.id} old stats: '
+        warn_prefix = f'WARNING: {self.id} old stats: '
+        discard_stats = False
+
+        m = kpu.validate_structure(self._make_init_data(), my_old_stats, err_prefix)
+        if m:
+            self.invalid = True
+            self.messages.extend(m)
+
+        if 'messages' in my_old_stats and len(my_old_stats['messages']) > 0:  # Oh. That was already broken
+            for m in my_old_stats['messages']:
+                if 'have OLD message' not in m and (m.startswith('ERROR') or m.startswith('WARNING')):
+                    self.invalid = m.startswith('ERROR')
+                    self.messages.append(err_prefix + "have OLD message: " + m)
+
+        if self.invalid:  # no point in looking deeper into broken structure
+            return False
+
+        t = int(self.commons.clock.now)
+        rt = my_old_stats['registered']
+        if (len(rt) != 2 or type(rt[0]) is not int
+                or rt[0] < t - kpu.SECONDS_IN_YEAR or rt[0] >= t):
+            discard_stats = True
+            self.messages.append(warn_prefix + "registration time is suspicious: " + str(rt) )
+
+        w = my_old_stats['weekly']
+        wlen = len(w['start_ts'])
+        if wlen != len(w['discharge_speed']) or wlen != len(w['charge_speed']):
+            discard_stats = True
+            self.messages.append(warn_prefix + "weekly series lengths are inconsistent" )
+        else:
+            try:
+                for k in ['discharge_speed', 'charge_speed']:
+                    if any(len(week) != kpu.CHARGE_STEPS for week in w[k]):
+                        raise ValueError(f'{k} should have {kpu.CHARGE_STEPS} sectors a week')
+
+                    w[k] = [[kpu.KAccumulator.from_json(a) for a in week] for week in w[k]]
+            except (ValueError, TypeError) as e:
                 discard_stats = True
-                self.messages.append(warn_prefix + "weekly series lengths are inconsistent" )
+                self.messages.append(warn_prefix + str(e))
 
-            if kpu.bt_from_str(my_old_stats['type']) is not self.type:
-                self.invalid = True
-                self.messages.append(err_prefix + " battery type is not the same")
+        if kpu.bt_from_str(my_old_stats['type']) is not self.type:
+            self.invalid = True
+            self.messages.append(err_prefix + " battery type is not the same")
 
-            if self.invalid or discard_stats:  # init with a stub
-                del saved_stats[batt_id]
-                self._pdata = init_data
-                return
+        if self.invalid or discard_stats:  # keep the stub
+            return False
 
-            self._pdata = copy.deepcopy(my_old_stats)
-            del saved_stats[batt_id]
+        # it is removed from the parent dict already, so no copying needed
+        self._pdata = my_old_stats
+        self._stats_changed()
+        return True
 
-        else:  #  no saved data - performing initial setup
-            self._pdata = init_data
 
-        # add new week items to start with
-        self._weekly_shift()
+    ########################################
+    def merge_saved_stats(self, saved_stats: dict) -> None:
+        """
+        Merges saved stats that were loaded when this battery has been working with a fresh data for a while.
+        Saved data becomes the base and fresh counters are added on top of it.
+        :param saved_stats: dict: JSON 'batteries' dict from permastorage. Should have our ID inside
+        :return: None
+        """
+        fresh = self._pdata
+        if not self._load_saved_stats(saved_stats):
+            if self.invalid:  # old data made us invalid. Make it consistent with a regular init anyway
+                self._pdata = fresh
+            return
+
+        self._weekly_shift()  # saved data may be too old for the current week
+
+        for i in range(len(fresh['health']['cycles'])):
+            self._pdata['health']['cycles'][i] += fresh['health']['cycles'][i]
+        self._stats_changed()
+
+        fw = fresh['weekly']
+        w = self._pdata['weekly']
+        for k in ['discharge_speed', 'charge_speed']:
+            for sector in range(kpu.CHARGE_STEPS):
+                w[k][0][sector].merge(fw[k][0][sector])
 
 
     ########################################
@@ -138,7 +224,7 @@ class KBattStats:
         Shifts old weekly data towards the back of list and adds fresh (zeroes) items for a new week in the front
         :return: None
         """
-        t = int(time.time())
+        t = int(self.commons.clock.now)
         w = cast(dict[str, list[Any]], self._pdata['weekly'])  # to shut IDE up
 
         if len(w['start_ts']) > 0:
@@ -153,25 +239,26 @@ class KBattStats:
 
         # creating averages
         for k in ['discharge_speed', 'charge_speed']:
-            w[k + '_avg'].insert(0, [0.0 for _ in range(kpu.CHARGE_STEPS)])
-            w[k + '_samples'].insert(0, [0 for _ in range(kpu.CHARGE_STEPS)])
+            w[k].insert(0, [kpu.KAccumulator() for _ in range(kpu.CHARGE_STEPS)])
+
+        self._stats_changed()  # health and table look at the last weeks only
 
 
     ########################################
     def _weekly_avg_add(self, name: str, val: float, sector: int) -> None:
         """
-        Updates this week average value for a specific item pair: <name>_avg and <name>_samples
-        :param name: base name of the item
+        Updates this week average value for a specific item
+        :param name: name of the item
         :param val: value to add
         :param sector: charge percentage sector to use
         :return: None
         """
         w = cast(dict[str, list[Any]], self._pdata['weekly'])
-        if int(time.time()) - w['start_ts'][0] >= kpu.SECONDS_IN_A_WEEK:
+        if int(self.commons.clock.now) - w['start_ts'][0] >= kpu.SECONDS_IN_A_WEEK:
             self._weekly_shift()
 
-        w[name + '_avg'][0][sector], w[name + '_samples'][0][sector] = \
-            kpu.update_avg_float(w[name + '_avg'][0][sector], val, w[name + '_samples'][0][sector])
+        w[name][0][sector].add(val)
+        self._stats_changed()
 
 
     ########################################
@@ -184,6 +271,86 @@ class KBattStats:
         return { self.id: pd }
 
 
+    ########################################
+    def _init_for_new_sector(self, upsc_data: dict, discharging: bool, load: float,
+                             v: float, charge: float) -> None:
+        """Starts accounting for a new charge sector. Subclasses may reset their own state here too"""
+        self._charge_sector = int(charge / kpu.SECTOR_WIDTH)
+        self._charge_sector_start = charge
+        self._was_discharging = discharging
+        self._time_in_charge_sector = 0
+        self._load_avg = load
+        self._state_samples = 1
+
+
+    ########################################
+    def _element_voltage(self, upsc_data: dict) -> float:
+        """Voltage of a single 12v element of this battery from the bank voltage reported by device"""
+        return float(upsc_data['battery_voltage']) * self.voltage_scale / self._pack_size
+
+
+    ########################################
+    def _update_sectors(self, upsc_data: dict, discharging: bool, load: float, v: float, charge: float) -> None:
+        """
+        Tracks the time spent in charge sectors and adds the sector speeds and cycles into the stats.
+        Subclasses call it from process_upsc_data() when they have figured out the current charge
+        :param upsc_data: dict: device's current state
+        :param discharging: bool: True if running on battery
+        :param load: float: current load in Watts
+        :param v: float: voltage of a single 12v element
+        :param charge: float: current charge level
+        :return: None
+        """
+        if self._charge_sector == -1:
+            self._init_for_new_sector(upsc_data, discharging, load, v, charge)
+            return
+
+        charge_sector = int(charge / kpu.SECTOR_WIDTH)
+
+        # Are there state transitions? important rule: no direction change
+        # Jitter detection: may jolt up on discharge and down on a charge
+        if discharging == self._was_discharging \
+            and ( charge_sector == self._charge_sector
+                or ( discharging and charge_sector > self._charge_sector )
+                or ( not discharging and charge_sector < self._charge_sector)):
+            # let's say it's still the same
+            self.charge = charge
+            self._time_in_charge_sector += self.commons.sample_interval
+            self._load_avg, self._state_samples = kpu.update_avg_float(self._load_avg, load,
+                                                                              self._state_samples)
+            return
+
+        # Something changed.
+        # Check if we have enough time in a previous state to extrapolate if needed.
+        # We want a recorded charge range to be more than 70%+ of this sector width
+        ch_left: float
+        if self._was_discharging:  # want to operate on a previous sector's bound
+            ch_left = (self._charge_sector + 1) * kpu.SECTOR_WIDTH - self._charge_sector_start
+        else:
+            ch_left = self._charge_sector_start - self._charge_sector * kpu.SECTOR_WIDTH
+
+        if ch_left / kpu.SECTOR_WIDTH <= 0.5:  # are there less than 50%+ of sector width left unaccounted?
+            if ch_left > 0.0:  # need to extrapolate
+                self._time_in_charge_sector += int(self._time_in_charge_sector * ch_left / kpu.SECTOR_WIDTH)
+
+            # adding normalized. Week shift will be performed in avg_add if needed
+            if self._load_avg > 0.0:
+                self._weekly_avg_add('discharge_speed' if self._was_discharging else 'charge_speed',
+                             self._load_avg * self._time_in_charge_sector, self._charge_sector)
+
+        if not discharging and self._was_discharging:  # went OB->OL. Adding health stat
+            if self.charge >= 80.0:
+                self._pdata['health']['cycles'][0] += 1
+            elif self.charge >= 50.0:
+                self._pdata['health']['cycles'][1] += 1
+            else:
+                self._pdata['health']['cycles'][2] += 1
+            self._stats_changed()
+
+        self._init_for_new_sector(upsc_data, discharging, load, v, charge)
+        self.charge = charge
+
+
     ########################################
     def process_upsc_data(self, upsc_data: dict) -> None:
         """
@@ -196,16 +363,258 @@ class KBattStats:
 
 
     ########################################
-    def get_battery_health(self) -> dict:
-        """Abstract: overriding method should return battery health information
-        within a dict: {"cycles": [<soft>,<norm>,<bad>], "status": "Whatever", "tbf": <weeks berfore a failure>}
+    def is_steady(self) -> bool:
+        """Tells if repeating the last processed sample will not change the state in a time-dependent way.
+        I.e. fast_forward() can be used instead of calling process_upsc_data() again and again.
+        Subclasses with time-dependent logic should override this"""
+        return True
+
+
+    ########################################
+    def fast_forward(self, count: int) -> None:
+        """Does the same as count calls to process_upsc_data() with the last processed sample would do.
+        Should be called only if is_steady() is True. Then repeats are always staying
+        in the same charge sector, so only the sector's counters are updated here
+        :param count: int: number of repeated samples
+        :return: None
         """
-        return { "cycles": [0,0,0], "status": "This is a stub!", "tbf": -1, "wellness": 100 }
+        if count <= 0 or not self._last_sample_used:
+            return
+
+        load = self.commons.last_load * self.load_share
+        self._time_in_charge_sector += self.commons.sample_interval * count
+        self._load_avg += (load - self._load_avg) * count / (self._state_samples + count)
+        self._state_samples += count
+
+
+    ########################################
+    def _week_wellness(self, week: int) -> float | None:
+        """
+        Estimates wellness from a single week's discharge speeds
+        :param week: int: index in the weekly data
+        :return: float: part of the nominal capacity left or None if there is too little data
+        """
+        speeds = [a.mean for a in self._pdata['weekly']['discharge_speed'][week][1:] if a.mean > 0.0]
+        if len(speeds) < _WEEK_MIN_SECTORS:
+            return None
+
+        return sum(speeds) / len(speeds) / self._ideal_sector_speed
+
+
+    ########################################
+    def _update_wellness_trend(self) -> None:
+        """
+        Feeds the completed weeks' wellness into the trend.
+        Normally it is a single new week after a week shift. The whole window is re-read in one pass
+        on the first call or when the weekly data was replaced, e.g. by loading the saved stats.
+        :return: None
+        """
+        start_ts = self._pdata['weekly']['start_ts']
+        if len(start_ts) < 2 or start_ts[1] == self._trend_last_week:  # nothing new completed
+            return
+
+        if len(start_ts) > 2 and start_ts[2] == self._trend_last_week:
+            weeks: list[int] | range = [1]
+        else:
+            weeks = range(min(len(start_ts) - 1, _TREND_WEEKS), 0, -1)  # oldest first
+
+        origin = self._pdata['registered'][0]  # keep x small
+        points = []
+        for week in weeks:
+            w = self._week_wellness(week)
+            if w is not None:
+                points.append(((start_ts[week] - origin) / kpu.SECONDS_IN_A_WEEK, w))
+
+        if len(weeks) == 1:
+            for x, y in points:
+                self._wellness_trend.add(x, y)
+        else:
+            self._wellness_trend.reset(points)
+
+        self._trend_last_week = start_ts[1]
+
+
+    ########################################
+    def _weeks_before_failure(self, wellness: float) -> int:
+        """
+        Projects the weekly wellness trend to the next threshold down
+        :param wellness: float: current wellness
+        :return: int: weeks from now. 0 if it is the end already, -1 if there is no decline or not enough data
+        """
+        self._update_wellness_trend()
+        if wellness < _WELLNESS_TRASH:
+            return 0
+
+        trend = self._wellness_trend
+        if len(trend) < _TREND_MIN_WEEKS or trend.slope >= 0.0:
+            return -1
+
+        x = trend.x_at(_WELLNESS_FAILING if wellness >= _WELLNESS_FAILING else _WELLNESS_TRASH)
+        now = (self.commons.clock.now - self._pdata['registered'][0]) / kpu.SECONDS_IN_A_WEEK
+        return max(0, int(x - now))
+
+
+    ########################################
+    def get_battery_health(self) -> Mapping[str, Any]:
+        """Returns battery health information within a read-only dict:
+        - "cycles": (<soft>,<norm>,<bad>) - (dis)charge cycles count for 100-80%, 80-50% and <50%.
+        - "status": "Whatever" - "OK" is OK.
+        - "tbf": <weeks before a failure> - -1 if no failure planned to happen.
+          It is the projection of the weekly wellness trend to the next threshold down: "Failing" or "Trash it".
+        - "wellness": <percent> - Computed amount of the actual capacity left.
+        This structure is a snapshot of a saved perma-stats battery element "health".
+        It is recalculated only if weekly stats or cycles have changed since the last call,
+        except for "tbf": it counts down with the clock, so it is re-projected each time
+        """
+        if not self._health_dirty and self._health_view is not None:
+            if self._health_wellness is not None:
+                tbf = self._weeks_before_failure(self._health_wellness)
+                if tbf != self._health_view['tbf']:
+                    self._pdata['health']['tbf'] = tbf
+                    self._health_view = MappingProxyType(dict(self._health_view, tbf=tbf))
+
+            return self._health_view
+
+        self._health_dirty = False
+        bdh: dict[str,Any] = self._pdata['health']
+
+        if self.invalid:
+            bdh['status'] = "Invalid setup!"
+            self._health_wellness = None
+            self._health_view = MappingProxyType(dict(bdh, cycles=tuple(bdh['cycles'])))
+            return self._health_view
+
+        dspeed_avg = 0.0
+        samples = 0
+        # Look at the last month worth of data max, to not spoil average too much
+        for week in range(min(4, len(self._pdata['weekly']['discharge_speed']))):
+            for cs in range(1, kpu.CHARGE_STEPS):  # not counting <10% and 100% zones
+                v = self._pdata['weekly']['discharge_speed'][week][cs].mean
+                if v > 0.0:
+                    dspeed_avg += v
+                    samples += 1
+
+            if samples > 2 * kpu.CHARGE_STEPS:  # count 2 weeks or more for better averaging
+                break
+
+        status = []
+        if samples >= 5:  # ensure there is some variety
+            dspeed_avg /= samples
+            wellness = round(dspeed_avg / self._ideal_sector_speed, 2)
+        else:
+            wellness = 1.0
+            # cycles: < nice >, < normal >, < worst >
+            wellness -= bdh['cycles'][0] / 6000.0  # Theoretically 6k is possible in a pampered conditions
+            wellness -= bdh['cycles'][1] / 3000.0  # more or less standard
+            wellness -= bdh['cycles'][2] / 500.0
+
+        if wellness >= _WELLNESS_AGED:
+            status.append('OK (>80%)')
+            # wellness = 10 * round(10.0 * wellness)  #  Show 10% precision for higher vitality
+        else:
+            if wellness >= _WELLNESS_FAILING:  #  Show 5% precision for medium vitality
+                ws = wellness * 10.0
+                wi = int(ws)
+                if ws - wi >= 0.5:
+                    wi = wi * 10 + 5
+                else:
+                    wi = wi * 10
+                status.append(f'Aged: {wi}%')
+            else:  # full precision for end of life
+                if wellness < 0.0:
+                    wellness = 0.0
+
+                if wellness >= _WELLNESS_TRASH:
+                    status.append(f'Failing: {int(100.0 * wellness)}%')
+                else:
+                    status.append(f'Trash it')
+
+        bdh['status'] = ', '.join(status)
+        self.wellness = int(100.0 * wellness)
+        old_capacity = self.capacity_wh
+        self.capacity_wh = int(self.capacity_ah_nom * self.v_nom * self.commons.power_factor * wellness)
+        if self.capacity_wh != old_capacity and self.on_capacity_change is not None:
+            self.on_capacity_change(old_capacity, self.capacity_wh)
+
+        bdh['wellness'] = self.wellness
+        bdh['tbf'] = self._weeks_before_failure(wellness)
+        self._health_wellness = wellness
+        self._health_view = MappingProxyType(dict(bdh, cycles=tuple(bdh['cycles'])))
+        return self._health_view
+
+
+    ########################################
+    def _energy_table(self) -> list[float]:
+        """
+        Returns the cumulative energy table: Wh stored from 0% up to the start of each charge sector.
+        The last item is the full charge. Each sector's energy is the discharge speed learned for it,
+        averaged over the last weeks with the older ones fading. Sectors without data get an even share
+        of capacity_wh. The table is rebuilt only after the stats or capacity have changed.
+        :return: list[float]: CHARGE_STEPS items
+        """
+        if not self._energy_cum_dirty and self._energy_cum_cap == self.capacity_wh:
+            return self._energy_cum
+
+        sums = [0.0] * kpu.CHARGE_STEPS
+        weights = [0.0] * kpu.CHARGE_STEPS
+        for week, speeds in enumerate(self._pdata['weekly']['discharge_speed'][:_TABLE_WEEKS]):
+            fade = 0.5 ** (week / _TABLE_HALF_LIFE)
+            for cs, acc in enumerate(speeds):
+                if acc.count > 0.0 and acc.mean > 0.0:
+                    sums[cs] += acc.mean * acc.count * fade
+                    weights[cs] += acc.count * fade
+
+        even_share = self.capacity_wh / (kpu.CHARGE_STEPS - 1)
+        cum = [0.0]
+        for cs in range(kpu.CHARGE_STEPS - 1):  # the last sector is 100% exactly: no width
+            cum.append(cum[-1] + (sums[cs] / weights[cs] / 3600.0 if weights[cs] > 0.0 else even_share))
+
+        self._energy_cum = cum
+        self._energy_cum_dirty = False
+        self._energy_cum_cap = self.capacity_wh
+        return cum
+
+
+    ########################################
+    def get_energy_at(self, charge: float) -> float:
+        """
+        Returns energy stored at the charge level, according to the learned sector table
+        :param charge: float: charge level in percents
+        :return: float: Wh
+        """
+        cum = self._energy_table()
+        charge = min(max(charge, 0.0), 100.0)
+        cs = min(int(charge / kpu.SECTOR_WIDTH), kpu.CHARGE_STEPS - 2)
+        return cum[cs] + (cum[cs + 1] - cum[cs]) * (charge - cs * kpu.SECTOR_WIDTH) / kpu.SECTOR_WIDTH
+
+
+    ########################################
+    def get_energy_to(self, charge: float) -> float:
+        """
+        Returns energy the battery delivers from the current charge level down to the given one
+        :param charge: float: target charge level in percents
+        :return: float: Wh. Negative if target is above the current charge
+        """
+        return self.get_energy_at(self.charge) - self.get_energy_at(charge)
+
+
+    ########################################
+    def get_seconds_to(self, charge: float, load: float) -> int:
+        """
+        Returns how long it takes to discharge down to the given level with a constant load
+        :param charge: float: target charge level in percents
+        :param load: float: Watts
+        :return: int: seconds. -1 if there is no load
+        """
+        if load <= 0.0:
+            return -1
+
+        return max(0, int(self.get_energy_to(charge) * 3600.0 / load))
 
 
     ########################################
     def get_remaining_wh(self) -> int:
         """Returns battery remaining capacity in Wh:
-        :return int: remaining Wh. Uses computed wellness to provide realistic data"""
+        :return int: remaining Wh. Uses learned sector energy table to provide realistic data"""
 
-        return int(self.charge / 100.0 * self.capacity_wh)
+        return round(self.get_energy_at(self.charge))
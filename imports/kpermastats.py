@@ -0,0 +1,140 @@
+"""kadpy.kpermastats: This module is a part of the hardware monitoring toolset from GitHub/kadavris/monitoring.
+Permanent statistics file format versioning.
+Each saved file carries the 'schema_version' item. On load the data is brought up to SCHEMA_VERSION
+by applying registered migrations one by one, so the format changes will not reset the collected history.
+To change the format: bump SCHEMA_VERSION and register a migration from the previous version.
+Made by Andrej Pakhutin"""
+
+from typing import Any, Callable
+
+SCHEMA_VERSION: int = 3  # current format of the saved stats
+
+# from_version -> function that converts the whole file's data from_version -> from_version + 1 in-place.
+# The function returns a list of messages. Any ERROR message or exception means that migration has failed.
+_MIGRATIONS: dict[int, Callable[[dict[str, Any]], list[str]]] = {}
+
+
+########################################
+def register_migration(from_version: int) -> Callable:
+    """Decorator for the migration functions. See _MIGRATIONS"""
+    def decorator(func: Callable[[dict[str, Any]], list[str]]) -> Callable[[dict[str, Any]], list[str]]:
+        if from_version in _MIGRATIONS:
+            raise ValueError(f'Duplicate permastats migration from version {from_version}')
+
+        _MIGRATIONS[from_version] = func
+        return func
+
+    return decorator
+
+
+########################################
+def get_version(stats: dict[str, Any]) -> int:
+    """Returns schema version of the stats data. Files made before versioning have no mark and are version 0"""
+    ver = stats.get('schema_version', 0)
+    if type(ver) is not int:
+        return -1
+
+    return ver
+
+
+########################################
+def migrate(stats: dict[str, Any], msg_prefix: str = '') -> tuple[int, list[str]]:
+    """Brings the loaded stats data to the current SCHEMA_VERSION in-place.
+    :param stats: dict: the whole device's stats file content
+    :param msg_prefix: str: message prefix in reports
+    :return: tuple(int, list[str]): (original version or -1 if migration is impossible, messages)
+    """
+    if msg_prefix and not msg_prefix[-1].isspace():
+        msg_prefix += ' '
+
+    start_ver = get_version(stats)
+    if start_ver < 0:
+        return -1, [f'WARNING: {msg_prefix}has invalid schema_version']
+
+    if start_ver > SCHEMA_VERSION:
+        return -1, [f'WARNING: {msg_prefix}schema_version {start_ver} is newer than supported {SCHEMA_VERSION}']
+
+    messages: list[str] = []
+    ver = start_ver
+    while ver < SCHEMA_VERSION:
+        if ver not in _MIGRATIONS:
+            messages.append(f'WARNING: {msg_prefix}no migration from schema_version {ver}')
+            return -1, messages
+
+        try:
+            m = _MIGRATIONS[ver](stats)
+        except Exception as e:
+            messages.append(f'WARNING: {msg_prefix}migration from schema_version {ver} failed: {e}')
+            return -1, messages
+
+        messages.extend(msg_prefix + s for s in m)
+        if any(s.startswith('ERROR') for s in m):
+            return -1, messages
+
+        ver += 1
+        stats['schema_version'] = ver
+
+    return start_ver, messages
+
+
+########################################
+# Migrations. Keep them self-contained: no constants or code from the other modules,
+# as those may change later, while the old formats are fixed for good.
+########################################
+@register_migration(0)
+def _migrate_0_to_1(stats: dict[str, Any]) -> list[str]:
+    """Pre-versioning files. Battery settings had 'batt_' prefix and some items were added later"""
+    stats.setdefault('messages', [])
+    stats.setdefault('ups', {})
+    if 'ts' in stats:
+        stats.setdefault('started', stats['ts'])
+
+    batteries = stats.get('batteries', {})
+    if not isinstance(batteries, dict):
+        return ['ERROR: "batteries" item is not a dict']
+
+    for bdata in batteries.values():
+        if not isinstance(bdata, dict):
+            continue
+
+        for old, new in [('batt_type', 'type'), ('batt_vnom', 'vnom'), ('batt_cap', 'capacity_ah')]:
+            if old in bdata:
+                bdata.setdefault(new, bdata.pop(old))
+
+        bdata.setdefault('health', {'cycles': [0, 0, 0], 'status': 'OK', 'tbf': -1, 'wellness': 100})
+
+    return []
+
+
+########################################
+@register_migration(1)
+def _migrate_1_to_2(stats: dict[str, Any]) -> list[str]:
+    """(avg, samples) list pairs are replaced by the accumulators, saved as [mean, m2, count] lists.
+    The spread of old data is unknown, so m2 is zero"""
+    def pairs_to_acc(avg: list, samples: list) -> list[list[float]]:
+        if len(avg) != len(samples):
+            raise ValueError('avg and samples lists lengths differ')
+        return [[float(a), 0.0, float(n)] for a, n in zip(avg, samples)]
+
+    stats['hourly_load'] = pairs_to_acc(stats.pop('hourly_load_avg'), stats.pop('hourly_load_samples'))
+
+    for bdata in stats.get('batteries', {}).values():
+        if not isinstance(bdata, dict) or 'weekly' not in bdata:
+            continue
+
+        w = bdata['weekly']
+        for k in ['discharge_speed', 'charge_speed']:
+            w[k] = [pairs_to_acc(a, n) for a, n in zip(w.pop(k + '_avg'), w.pop(k + '_samples'))]
+
+    return []
+
+
+########################################
+@register_migration(2)
+def _migrate_2_to_3(stats: dict[str, Any]) -> list[str]:
+    """LiFePO4 batteries keep the learned usable energy. Not learned yet is 0.0"""
+    for bdata in stats.get('batteries', {}).values():
+        if isinstance(bdata, dict) and str(bdata.get('type', '')).lower().removeprefix('bt_') == 'lifepo':
+            bdata.setdefault('usable_wh', 0.0)
+
+    return []
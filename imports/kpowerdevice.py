@@ -12,15 +12,25 @@ Author: Andrej Pakhutin
 
 import copy
 import json
+import math
 import os
 import re
-import time
+import threading
 from configparser import ConfigParser
-from typing import Any, cast
+from typing import Any, Mapping, Sequence, cast
 from kadpy.kbatteries import KBatteries
+import kadpy.kpermastats as kperma
 import kadpy.kpowerutils as kpu
 from kadpy.kpowerutils import KPowerUnits
-from kadpy.kpowerutils import KPowerDeviceCommons
+from kadpy.kpowerutils import KClock, KPowerDeviceCommons
+
+# Battery runtime prediction tunables
+_LOAD_EWMA_TAU: float = 600.0  # seconds. Time constant of the recent load average
+_PROFILE_BLEND_TAU: float = 1800.0  # seconds. How fast the expected load moves from the recent avg to hourly profile
+_RUNTIME_STEP: int = 300  # seconds. Forward integration step
+_RUNTIME_HORIZON: int = 12 * 3600  # seconds. Prediction is cut here. Also reported when there is no load at all
+_RUNTIME_BAND_SIGMAS: float = 1.0  # confidence band width in standard deviations of the recent load
+_HOURLY_LOAD_HALF_LIFE: int = 30  # days. Older hourly load profile data is fading out to follow the usage changes
 
 
 class KPowerDevice:
@@ -29,7 +39,8 @@ class KPowerDevice:
     that will be absolutely ridiculous on screen, like negative power or times.
     That way it is easier for me to catch up on problems, instead on sifting through unfriendly journalctl output"""
 
-    def __init__(self, device_id: str, config: ConfigParser) -> None:
+    def __init__(self, device_id: str, config: ConfigParser, lazy_stats: bool = False,
+                 clock: KClock | None = None) -> None:
         """Initializes the power device object by reading relevant .ini configuration parameters
          for specific device.
          In the .ini the [power.<device_id>] section must exist.
@@ -38,6 +49,12 @@ class KPowerDevice:
         :type device_id: str
         :param config: A configuration parser object having .ini file loaded.
         :type config: ConfigParser
+        :param lazy_stats: Start with fresh counters and load the saved stats file in background.
+          Saved data is merged with whatever was collected meanwhile on one of the next process_upsc_data() calls.
+        :type lazy_stats: bool
+        :param clock: Time source shared with batteries. Default is the real time.
+          Replays and tests use KSimClock to run on their own time.
+        :type clock: KClock | None
         """
         # init the bare minimum first in case of severe errors
         self.id: str = device_id
@@ -50,6 +67,9 @@ class KPowerDevice:
 
         # properties based on config values
         self.commons = KPowerDeviceCommons(device_id)
+        if clock is not None:
+            self.commons.clock = clock
+            clock.tick()
 
         try:
             # batteries charging current (Amps) for estimations
@@ -76,8 +96,10 @@ class KPowerDevice:
 
         self.bulk_report: list[str] = []  # upsc attributes that will be posted in the main topic in bulk
         self.in_blackout: bool = False  # we have been on battery for more than 1 status check cycle
-        self.next_stats_save: float = time.time()
+        self.next_stats_save: float = self.commons.clock.now
         self.load_samples: list[int] = [0]  # load levels for the last hour
+        self.load_ewma: float = 0.0  # exponentially weighted recent load average
+        self.load_ewvar: float = 0.0  # and its variance
         self.log_items: list[str] = []  # list of items that will be put on log
         self.one_to_one: list[str] = []  # upsc attribute -> topic for putting out most important entities
         self.power_rating: int  # normalized to Watts
@@ -87,6 +109,13 @@ class KPowerDevice:
         # private:
         self._load_to_w: float  # reported load to Watts conversion factor
         self._load_zero: float = 0.0  # for devices that cannot precisely report load less than this value
+        self._load_ewma_alpha: float  # recent load average smoothing factor. depends on sample_interval
+        # hourly load accumulators half-life in samples: each hour slot gets 3600 / sample_interval samples a day
+        self._hourly_load_half_life: float = _HOURLY_LOAD_HALF_LIFE * 86400 / max(1, self.commons.sample_interval)
+        self._load_ewma_started: bool = False
+        self._stats_loader: threading.Thread | None = None  # background stats file reader if lazy_stats is used
+        self._stats_loaded: tuple[dict[str, Any] | None, list[str], int, bool] | None = None  # its result
+        self._stats_migrated: bool = False  # saved stats were converted from an older format and should be rewritten
 
         # permanent storage data
         self._storage_path = dev_sect.get('perma_storage', '')
@@ -95,7 +124,16 @@ class KPowerDevice:
         else:
             self._file_name = os.path.join(self._storage_path, 'mqtt-power.' + device_id + '.json')
 
-        self._pdata: dict[str, Any] = self.prepare_permastats()
+        self._pdata: dict[str, Any]
+        if lazy_stats and self._file_name != '':
+            self._pdata = self._make_init_data()
+            self._stats_loader = threading.Thread(target=self._stats_loader_run, daemon=True,
+                                                  name='stats-' + device_id)
+            self._stats_loader.start()
+            # there is nothing worth saving for a while
+            self.next_stats_save = self.commons.clock.now + 600
+        else:
+            self._pdata = self.prepare_permastats()
 
         # -------------------------------
         if 'load_reported_as' in dev_sect:
@@ -167,6 +205,9 @@ class KPowerDevice:
         else:
             self.standard_v = 230.0
 
+        # -------------------------------
+        self._load_ewma_alpha = 1.0 - math.exp(-max(1, self.commons.sample_interval) / _LOAD_EWMA_TAU)
+
         # -------------------------------
         for report_items in ['one_to_one', 'bulk_report', 'log_items']:
             if report_items in dev_sect:
@@ -188,6 +229,10 @@ class KPowerDevice:
 
         self._weekly_shift()  # add new week items to start with
 
+        if self._stats_migrated and self.init_errors == 0:
+            self._stats_migrated = False
+            self.stats_file_save()
+
     ########################################
     def _update_hourly_load(self, load: int) -> None:
         """
@@ -195,10 +240,7 @@ class KPowerDevice:
         :param load: int: load in Watts
         :return: None
         """
-        hour = time.localtime().tm_hour
-        avg = self._pdata['hourly_load_avg']
-        samp = self._pdata['hourly_load_samples']
-        avg[hour], samp[hour] = kpu.update_avg_int(avg[hour], load, samp[hour])
+        self._pdata['hourly_load'][self.commons.clock.hour].add(load)
 
         # update local stats for tha last hour
         lsamp = self.load_samples
@@ -207,13 +249,24 @@ class KPowerDevice:
             lsamp.pop()
         lsamp.insert(0, load)
 
+        # recent load trend for the runtime predictions
+        if not self._load_ewma_started:
+            self._load_ewma_started = True
+            self.load_ewma = float(load)
+            self.load_ewvar = 0.0
+        else:
+            diff = load - self.load_ewma
+            incr = self._load_ewma_alpha * diff
+            self.load_ewma += incr
+            self.load_ewvar = (1.0 - self._load_ewma_alpha) * (self.load_ewvar + diff * incr)
+
     ########################################
     def _weekly_shift(self) -> None:
         """
         Shifts old weekly data towards the back of list and adds fresh (zeroes) items for a new week in the front
         :return: None
         """
-        t = int(time.time())
+        t = int(self.commons.clock.now)
         w = cast(dict[str, list[Any]], self._pdata['weekly'])  # to shut IDE up
 
         if len(w['start_ts']) > 0:
@@ -240,13 +293,11 @@ class KPowerDevice:
         return to_ret
 
     ########################################
-    def prepare_permastats(self) -> dict[str, Any]:
-        """Will try to load old stats file and minimally validate it.
-        :return: if loaded OK, then saved JSON content as dict, in all other cases - bare initializer
-        """
-        # prep a fallback data. Also used to match current config against loaded JSON
-        t = int(time.time())
-        init_data: dict = {  # Init for a new set if there was no saved dada or it is invalid
+    def _make_init_data(self) -> dict[str, Any]:
+        """Returns an initializer for a new stats set. Also used to match current config against loaded JSON"""
+        t = int(self.commons.clock.now)
+        return {  # Init for a new set if there was no saved dada or it is invalid
+            'schema_version': kperma.SCHEMA_VERSION,
             'dev_id': self.id,
             'messages': [],  # if we want to save some thoughts for meatbags
             'ts': t,  # current timestamp
@@ -255,8 +306,7 @@ class KPowerDevice:
 
             # We'll use this for more precise prognostic calculations in blackout
             # hourly_load is 24-element per-hour load average of device
-            'hourly_load_avg': [0] * 24,
-            'hourly_load_samples': [0] * 24,
+            'hourly_load': [kpu.KAccumulator(self._hourly_load_half_life) for _ in range(24)],
             # there will be up to WEEKS_IN_A_YEAR sub-arrays for each of the elements inside 'weekly' key
             # for the last year. we'll initialize only the 1st element for starters
             'weekly': {
@@ -267,6 +317,16 @@ class KPowerDevice:
             },
         }
 
+    ########################################
+    def _read_permastats(self) -> tuple[dict[str, Any] | None, list[str], int, bool]:
+        """Will try to load old stats file, bring it to the current format and minimally validate it.
+        Does not touch the object's state, so it is safe to run in a separate thread.
+        :return: tuple(saved JSON content as dict or None if absent or invalid, messages, number of warnings,
+          was it migrated from an older format?)
+        """
+        messages: list[str] = []
+        warnings = 0
+        init_data = self._make_init_data()
         saved_stats: dict[str, Any] | None
 
         try:
@@ -276,30 +336,108 @@ class KPowerDevice:
             saved_stats = None
 
         invalid = False
+        migrated = False
         if saved_stats:
+            from_ver, m = kperma.migrate(saved_stats, 'stats file')
+            messages.extend(m)
+            if from_ver < 0:
+                return None, messages, warnings + 1, False
+
+            migrated = from_ver != kperma.SCHEMA_VERSION
+
             # validating
             m = kpu.validate_structure(init_data, saved_stats, 'WARNING: stats file')
             if len(m) > 0:
                 invalid = True
-                self._messages.extend(m)
-                self.init_warnings += 1
+                messages.extend(m)
+                warnings += 1
 
             if len(saved_stats['messages']) > 0:  # Oh. That was already broken
                 for m in saved_stats['messages']:
                     if m.startswith('ERROR') or m.startswith('WARNING'):
                         invalid = True
-                        self._messages.append('WARNING: stats file have message: ' + m)
-                        self.init_warnings += 1
+                        messages.append('WARNING: stats file have message: ' + m)
+                        warnings += 1
 
             if self.id != saved_stats['dev_id']:
-                self._messages.append('WARNING: stats file is from different device ID')
+                messages.append('WARNING: stats file is from different device ID')
                 invalid = True
-                self.init_warnings += 1
+                warnings += 1
 
             if not invalid:
-                return saved_stats
+                try:
+                    if len(saved_stats['hourly_load']) != 24:
+                        raise ValueError('hourly_load should have 24 items')
 
-        return init_data
+                    saved_stats['hourly_load'] = [kpu.KAccumulator.from_json(a, self._hourly_load_half_life)
+                                                  for a in saved_stats['hourly_load']]
+                except ValueError as e:
+                    messages.append('WARNING: stats file have invalid data: ' + str(e))
+                    invalid = True
+                    warnings += 1
+
+            if not invalid:
+                if migrated:
+                    messages.append(f'NOTE: stats file is migrated from schema_version {from_ver}')
+                return saved_stats, messages, warnings, migrated
+
+        return None, messages, warnings, False
+
+    ########################################
+    def prepare_permastats(self) -> dict[str, Any]:
+        """Will try to load old stats file and minimally validate it.
+        :return: if loaded OK, then saved JSON content as dict, in all other cases - bare initializer
+        """
+        saved_stats, messages, warnings, self._stats_migrated = self._read_permastats()
+        self._messages.extend(messages)
+        self.init_warnings += warnings
+
+        if saved_stats is None:
+            return self._make_init_data()
+
+        return saved_stats
+
+    ########################################
+    def _stats_loader_run(self) -> None:
+        """Background thread body for the lazy stats loading"""
+        self._stats_loaded = self._read_permastats()
+
+    ########################################
+    def _merge_permastats(self) -> None:
+        """Waits for the background loader and merges saved stats with the data collected since the start.
+        Saved data becomes the base and fresh counters are added on top of it.
+        :return: None
+        """
+        if self._stats_loader is None:
+            return
+
+        self._stats_loader.join()
+        self._stats_loader = None
+        saved_stats, messages, warnings, migrated = cast(tuple[dict[str, Any] | None, list[str], int, bool],
+                                                         self._stats_loaded)
+        self._stats_loaded = None
+
+        self._messages.extend(messages)
+        self.init_warnings += warnings
+
+        if saved_stats is None:
+            return
+
+        fresh = self._pdata
+        self._pdata = saved_stats
+        self._weekly_shift()  # saved data may be too old for the current week
+
+        w = self._pdata['weekly']
+        w['blackouts_count'][0] += fresh['weekly']['blackouts_count'][0]
+        w['blackouts_time'][0] += fresh['weekly']['blackouts_time'][0]
+
+        for hour in range(24):
+            self._pdata['hourly_load'][hour].merge(fresh['hourly_load'][hour])
+
+        self.batteries.merge_permastats(self._pdata)
+
+        if migrated:
+            self.stats_file_save()
 
     ########################################
     def stats_file_save(self) -> bool:
@@ -310,6 +448,9 @@ class KPowerDevice:
         if not self._storage_path or not os.path.exists(self._storage_path):
             return False
 
+        if self._stats_loader is not None:  # do not overwrite the old data with the fresh-only set
+            self._merge_permastats()
+
         bakfile = self._file_name + '.bak'
         if os.path.exists(self._file_name):
             if os.path.exists(bakfile):
@@ -326,7 +467,7 @@ class KPowerDevice:
                 return False
 
         try:
-            self._pdata['ts'] = int(time.time())
+            self._pdata['ts'] = int(self.commons.clock.time())
             to_save = copy.deepcopy(self._pdata)
             to_save.update(self.batteries.get_permastats())
             to_save['messages'] = []
@@ -335,7 +476,7 @@ class KPowerDevice:
                     to_save['messages'].append(m)
 
             with open(self._file_name, mode='w', encoding='utf-8') as outfile:
-                json.dump(to_save, outfile, indent=2)
+                json.dump(to_save, outfile, indent=2, default=kpu.json_default)
             return True
         except Exception as e:
             self._messages.append("ERROR saving statistics: " + str(e))
@@ -350,13 +491,24 @@ class KPowerDevice:
         return False
 
     ########################################
-    def process_upsc_data(self, upsc_data: dict) -> None:
-        """Will process new upsc data"""
-        self.commons.last_load = int(upsc_data['ups_load'])
-        if self.commons.last_load == 0.0 and self._load_zero > 0.0:
+    def process_upsc_data(self, upsc_data: dict, ts: float | None = None) -> None:
+        """Will process new upsc data
+        :param upsc_data: dict: upsc items with '.' replaced by '_'
+        :param ts: float: the sample's time, if it is not now
+        """
+        if self._stats_loader is not None and not self._stats_loader.is_alive():
+            self._merge_permastats()
+
+        now = self.commons.clock.tick(ts)  # the time of this sample for everyone
+
+        load = float(upsc_data['ups_load'])
+        if load == 0.0 and self._load_zero > 0.0:
             self.commons.last_load = int(self._load_zero)
         else:
-            self.commons.last_load = int(self.commons.last_load * self._load_to_w)
+            self.commons.last_load = int(load * self._load_to_w)
+
+        if now - self._pdata['weekly']['start_ts'][0] >= kpu.SECONDS_IN_A_WEEK:
+            self._weekly_shift()
 
         self._update_hourly_load(self.commons.last_load)
 
@@ -374,6 +526,91 @@ class KPowerDevice:
 
         self.batteries.process_upsc_data(upsc_data)
 
+    ########################################
+    def fast_forward(self, count: int, ts: float | None = None) -> bool:
+        """Does the same as count more calls of process_upsc_data() with the last processed sample would do,
+        but without going through all the logic each time. Used for long steady stretches of historical data.
+        The whole run should be inside the same hour and the same week of the weekly stats.
+        :param count: int: number of repeated samples
+        :param ts: float: time of the last repeated sample. Default is now
+        :return: bool: False if the state is not steady. Then samples should be processed one by one
+        """
+        if count <= 0:
+            return True
+
+        if not self._load_ewma_started or self._stats_loader is not None or not self.batteries.is_steady():
+            return False
+
+        if self.commons.clock.tick(ts) - self._pdata['weekly']['start_ts'][0] >= kpu.SECONDS_IN_A_WEEK:
+            self._weekly_shift()
+
+        load = self.commons.last_load
+        self._pdata['hourly_load'][self.commons.clock.hour].add_repeated(load, count)
+
+        lsamp = self.load_samples
+        maxnum = 3600 // self.commons.sample_interval
+        lsamp[:0] = [load] * min(count, maxnum + 1)
+        del lsamp[maxnum + 1:]
+
+        # closed form of count EWMA steps with the same value
+        keep = (1.0 - self._load_ewma_alpha) ** count
+        diff = load - self.load_ewma
+        self.load_ewvar = keep * (self.load_ewvar + diff * diff * (1.0 - keep))
+        self.load_ewma = load - diff * keep
+
+        if self.commons.on_battery:
+            self._pdata['weekly']['blackouts_time'][0] += self.commons.sample_interval * count
+
+        self.batteries.fast_forward(count)
+        return True
+
+    ########################################
+    def process_samples(self, batch: Mapping[str, Sequence[Any]]) -> int:
+        """Processes a batch of samples, e.g. from a buffering device or a log, with the same result as
+        calling process_upsc_data() for each one in turn. Runs of identical samples within the same hour
+        and week are passed to fast_forward() instead, so steady stretches cost next to nothing.
+        :param batch: columns of equal length: 'ts' - timestamps in chronological order,
+          and upsc items with '.' replaced by '_' (ups_load, ups_status, battery_voltage, ...).
+          None value means that the item is missing in the sample
+        :return: int: number of samples that were fast-forwarded
+        """
+        ts_col = batch['ts']
+        names = [k for k in batch if k != 'ts']
+        cols = [batch[k] for k in names]
+        if any(len(c) != len(ts_col) for c in cols):
+            raise ValueError('batch columns lengths differ')
+
+        fast_forwarded = 0
+        run_key: tuple | None = None
+        run_data: dict[str, Any] = {}
+        run_ts: list[float] = []  # repeats of run_data, not processed yet
+        run_end = 0.0  # the run is broken at the hour end or the week shift, whichever comes first
+
+        def flush() -> int:
+            if not run_ts:
+                return 0
+            if self.fast_forward(len(run_ts), run_ts[-1]):
+                return len(run_ts)
+            for t in run_ts:
+                self.process_upsc_data(run_data, t)
+            return 0
+
+        for i, ts in enumerate(ts_col):
+            key = tuple(c[i] for c in cols)
+            if key == run_key and ts < run_end:
+                run_ts.append(ts)
+                continue
+
+            fast_forwarded += flush()
+            run_ts = []
+            run_key = key
+            run_data = {k: v for k, v in zip(names, key) if v is not None}
+            self.process_upsc_data(run_data, ts)
+            run_end = min(ts + self.commons.clock.to_hour_end,
+                          self._pdata['weekly']['start_ts'][0] + kpu.SECONDS_IN_A_WEEK)
+
+        return fast_forwarded + flush()
+
     ########################################
     @property
     def power_load(self) -> int:
@@ -381,28 +618,82 @@ class KPowerDevice:
         return int(self.commons.last_load)
 
     ########################################
-    def get_battery_runtime(self) -> tuple[int, int, int, int, int]:
+    def _expected_load_steps(self) -> list[tuple[int, float]]:
+        """Prepares the forecast of load for the prediction horizon.
+        The recent load average is dominating right now and then blends into the hourly load profile.
+        Steps are cut at the hour boundaries, so the profile slot is constant within each.
+
+        :return: list of (step length in seconds, expected load in Watts)
+        """
+        hourly = self._pdata['hourly_load']
+        hour = self.commons.clock.hour
+        to_hour_end = math.ceil(self.commons.clock.to_hour_end)
+
+        steps = []
+        t = 0
+        while t < _RUNTIME_HORIZON:
+            step = min(_RUNTIME_STEP, to_hour_end)
+            profile = hourly[hour].mean if hourly[hour].count > 0.0 else self.load_ewma
+            w = math.exp(-(t + step / 2) / _PROFILE_BLEND_TAU)
+            steps.append((step, w * self.load_ewma + (1.0 - w) * profile))
+
+            t += step
+            to_hour_end -= step
+            if to_hour_end <= 0:
+                to_hour_end = 3600
+                hour = (hour + 1) % 24
+
+        return steps
+
+    ########################################
+    @staticmethod
+    def _integrate_runtime(steps: list[tuple[int, float]], budget_wsec: float, load_shift: float = 0.0) -> int:
+        """Finds out how long it takes to spend the energy budget with the expected load
+        :param steps: list of (seconds, Watts) from _expected_load_steps()
+        :param budget_wsec: energy to spend in Watt*seconds
+        :param load_shift: Watts to add to each step's load (for confidence band)
+        :return: int: seconds. _RUNTIME_HORIZON if not spent in time
+        """
+        if budget_wsec <= 0.0:
+            return 0
+
+        t = 0
+        for step, load in steps:
+            load = max(0.0, load + load_shift)
+            spent = step * load
+            if spent >= budget_wsec:
+                return int(t + budget_wsec / load)
+
+            budget_wsec -= spent
+            t += step
+
+        return _RUNTIME_HORIZON
+
+    ########################################
+    def get_battery_runtime(self) -> tuple[int, int, int, int, int, int, int]:
         """Return battery remaining capacity and runtimes information.
+        Runtimes are predicted by integrating the expected load forward in time:
+        the recent load average blended into the hourly load profile for the coming hours.
         Negative values used to denote re-charge times to a specific percentage.
+        If the batteries are not charging, -_RUNTIME_HORIZON is reported for them, as the level is not reached in time.
 
-        :return tuple: remaining Wh, seconds to 80%, seconds to 50%, seconds to 10%, seconds to 100%
+        :return tuple: remaining Wh, seconds to 80%, seconds to 50%, seconds to 10%, seconds to 100%,
+            seconds to 10% for the pessimistic and optimistic ends of confidence band
         """
-        def prc_to_secs(prc_threshold: int) -> int:
-            if rem_percent >= prc_threshold:
-                return int(prc_per_wsec * (rem_percent - prc_threshold) // self.commons.last_load)
+        def prc_to_secs(prc_threshold: int, load_shift: float = 0.0) -> int:
+            if rem_percent >= prc_threshold:  # energy is taken from the batteries' learned discharge tables
+                return self._integrate_runtime(steps, 3600 * self.batteries.get_energy_to(prc_threshold),
+                                               load_shift)
             else:  # return negative seconds to recharge to this point
-                return (rem_wh - (prc_threshold * prc_per_wh)) // chrg_spd_wh * 3600
-
-        rem_wh, rem_percent, total_cap_wh, chrg_spd_wh = \
-            self.batteries.get_remaining_power()
-        prc_per_wsec = 3600 * total_cap_wh // 100  # 1% of capacity in Watts/seconds
+                if chrg_spd_wh <= 0:
+                    return -_RUNTIME_HORIZON
+                # the same tables are used for the energy that is missing: it is negative when the level is above
+                return int(min(0.0, self.batteries.get_energy_to(prc_threshold)) * 3600 // chrg_spd_wh)
 
-        if self.commons.last_load == 0:  # we may want to return numbers high enough to not cause robot panic
-            # todo: Use self.load_samples to approx if load==zero or these DONT differ significantly
-            #       from the .last_load
-            return rem_wh, 4200, 4200, 4200, 4200
+        rem_wh, rem_percent, _, chrg_spd_wh = self.batteries.get_remaining_power()
 
-        prc_per_wh = total_cap_wh // 100
+        steps = self._expected_load_steps()
+        band = _RUNTIME_BAND_SIGMAS * math.sqrt(self.load_ewvar)
 
-        return rem_wh, prc_to_secs(80), prc_to_secs(50),\
-            prc_to_secs(10), prc_to_secs(100)
+        return rem_wh, prc_to_secs(80), prc_to_secs(50), prc_to_secs(10), prc_to_secs(100), \
+            prc_to_secs(10, band), prc_to_secs(10, -band)
@@ -0,0 +1,177 @@
+"""kadpy.kpowerreplay: This module is a part of the hardware monitoring toolset from GitHub/kadavris/monitoring.
+The main feature is the KPowerReplay class: rebuilds power device's permanent statistics
+by feeding the historical samples log (see 'log_samples' .ini option) through KPowerDevice and batteries.
+Made by Andrej Pakhutin"""
+
+from configparser import ConfigParser
+import gzip
+import os
+import re
+import time
+from typing import Iterable, Iterator, TextIO
+from kadpy.kpowerdevice import KPowerDevice
+from kadpy.kpowerutils import KSimClock
+
+# items that are used by the stats processing. Everything else in the log is ignored
+_ITEMS = ('ups_load', 'ups_status', 'battery_voltage', 'battery_charge')
+# log line: "YYYY-MM-DD HH:MM:SS{ JSON }". Both full bulk report and log_items subset are supported
+_LINE_RE = re.compile(r'(\d{4}-\d\d-\d\d \d\d):(\d\d):(\d\d)\s*\{')
+# picking items directly is a lot faster than the full JSON parsing of the huge bulk report lines
+_ITEM_RE = re.compile(r'"(' + '|'.join(_ITEMS) + r')":\s*"?([^",}]*)')
+_BATCH_SIZE: int = 4096  # samples passed to KPowerDevice at once
+
+
+########################################
+def open_log(path: str) -> TextIO:
+    """Opens a plain or gzip-compressed samples log"""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode='rt', encoding='utf-8', errors='replace')
+
+    return open(path, mode='r', encoding='utf-8', errors='replace')
+
+
+########################################
+class KPowerReplay:
+    """Feeds the samples log through a fresh KPowerDevice running on the samples' time and saves rebuilt stats.
+    Samples are passed in batches to KPowerDevice.process_samples(), so the long steady stretches are fast-forwarded.
+    """
+    def __init__(self, dev_id: str, config: ConfigParser, out_dir: str) -> None:
+        """
+        :param dev_id: str: device ID. The [power.<dev_id>] section should exist in config
+        :param config: ConfigParser: .ini file configuration. It is altered for the replay needs
+        :param out_dir: str: where to put the rebuilt stats file. Existing stats file there will be loaded
+        """
+        self.dev_id = dev_id
+        self.device: KPowerDevice | None = None  # created on the 1st sample to start at its time
+        self.clock = KSimClock()
+        self.messages: list[str] = []
+
+        # counters
+        self.lines: int = 0
+        self.skipped: int = 0  # unusable lines
+        self.processed: int = 0  # samples that were processed one by one
+        self.fast_forwarded: int = 0
+
+        # private:
+        self._config = config
+        dev_sect = config['power.' + dev_id]
+        dev_sect['perma_storage'] = out_dir
+        # loads in the log are already normalized to Watts
+        dev_sect['load_reported_as'] = 'w'
+        dev_sect['load_zero'] = '0w'
+
+        self._hour_key: str = ''  # cached local hour start for the quick time parsing
+        self._hour_ts: float = 0.0
+        self._last_ts: float = -1.0
+        # samples waiting to be passed to KPowerDevice.process_samples()
+        self._batch: dict[str, list] = {k: [] for k in ('ts',) + _ITEMS}
+
+    ########################################
+    def parse_line(self, line: str) -> tuple[float, str, dict[str, str]] | None:
+        """Parses a single log line
+        :param line: str: log line
+        :return: tuple(timestamp, local hour string, dict of the stats-related items) or None if not usable
+        """
+        m = _LINE_RE.match(line)
+        if not m:
+            return None
+
+        hour = m.group(1)
+        if hour != self._hour_key:
+            try:
+                self._hour_ts = time.mktime(time.strptime(hour, '%Y-%m-%d %H'))
+            except ValueError:
+                return None
+            self._hour_key = hour
+
+        data = {k: v.strip() for k, v in _ITEM_RE.findall(line, m.end() - 1)}
+        if 'ups_load' not in data or 'ups_status' not in data:
+            return None
+
+        return self._hour_ts + int(m.group(2)) * 60 + int(m.group(3)), hour, data
+
+    ########################################
+    def _flush_batch(self) -> None:
+        """Processes the samples collected so far"""
+        batch = self._batch
+        count = len(batch['ts'])
+        if count == 0:
+            return
+
+        if self.device is None:
+            self.clock.set(batch['ts'][0])
+            self.device = KPowerDevice(self.dev_id, self._config, clock=self.clock)
+
+        ff = self.device.process_samples(batch)
+        self.fast_forwarded += ff
+        self.processed += count - ff
+        for col in batch.values():
+            col.clear()
+
+    ########################################
+    def feed(self, lines: Iterable[str]) -> None:
+        """Replays log lines. Can be called several times to continue with the next log part
+        :param lines: iterable of log lines in chronological order
+        :return: None
+        """
+        def parsed() -> Iterator[tuple[float, dict[str, str]]]:
+            for line in lines:
+                self.lines += 1
+                rec = self.parse_line(line)
+                if rec is None:
+                    self.skipped += 1
+                    continue
+
+                yield rec[0], rec[2]
+
+        self.feed_samples(parsed())
+
+    ########################################
+    def feed_samples(self, samples: Iterable[tuple[float, dict[str, str]]]) -> None:
+        """Replays already parsed samples. See parse_line()
+        :param samples: iterable of (timestamp, stats-related items) in chronological order
+        :return: None
+        """
+        batch = self._batch
+        ts_col = batch['ts']
+        item_cols = [(k, batch[k]) for k in _ITEMS]
+        for ts, data in samples:
+            if ts <= self._last_ts:  # out of order
+                self.skipped += 1
+                continue
+
+            self._last_ts = ts
+            ts_col.append(ts)
+            for k, col in item_cols:
+                col.append(data.get(k))
+
+            if len(ts_col) >= _BATCH_SIZE:
+                self._flush_batch()
+
+    ########################################
+    def feed_file(self, path: str) -> None:
+        """Replays a whole log file, possibly gzipped"""
+        with open_log(path) as f:
+            self.feed(f)
+
+    ########################################
+    def finish(self) -> bool:
+        """Processes the leftovers and saves the rebuilt stats
+        :return: bool: success
+        """
+        self._flush_batch()
+        if self.device is None:
+            self.messages.append('ERROR: no usable samples found')
+            return False
+
+        ok = self.device.stats_file_save()
+
+        self.messages.extend(self.device.collect_messages())
+        return ok
+
+    ########################################
+    @property
+    def stats_file(self) -> str:
+        """Path of the rebuilt stats file"""
+        return os.path.join(self._config['power.' + self.dev_id]['perma_storage'],
+                            'mqtt-power.' + self.dev_id + '.json')
@@ -0,0 +1,155 @@
+"""kadpy.kpowersite: This module is a part of the hardware monitoring toolset from GitHub/kadavris/monitoring.
+The main feature is the KPowerSite class: a virtual device aggregating several power devices
+that feed the same load (e.g. multiple UPSes in a rack).
+Made by Andrej Pakhutin"""
+
+from configparser import ConfigParser
+from typing import Any
+from kadpy.kpowerdevice import KPowerDevice, _RUNTIME_HORIZON
+
+# charge levels of the KPowerDevice.get_battery_runtime() items. [0] is remaining Wh itself
+_runtime_levels: tuple[int, ...] = (0, 80, 50, 10, 100, 10, 10)
+_central_item: int = 3  # seconds to 10%
+_band_items: tuple[int, ...] = (5, 6)  # confidence band of the _central_item
+
+
+########################################
+class KPowerSite:
+    """Aggregates the state of the member KPowerDevice objects.
+    Totals are maintained incrementally: each member update replaces only its own contribution,
+    so there is no need to re-poll or re-sum all devices on every sample.
+    """
+    def __init__(self, site_id: str, config: ConfigParser) -> None:
+        """
+        :param site_id: str: site name. The [site.<site_id>] section should exist in config
+        :param config: ConfigParser: .ini file configuration
+        """
+        self.id = site_id
+        self.members: list[str] = []
+        self.messages: list[str] = []
+        self.updated: bool = False  # was there any member update since the last get_report()?
+
+        # totals
+        self.load: int = 0  # Watts
+        self.remaining_wh: int = 0
+        self.capacity_wh: int = 0
+        self.on_battery: int = 0  # number of members running on battery
+
+        # private:
+        self._state: dict[str, tuple[int, int, int, int]] = {}  # dev_id -> (load, rem wh, cap wh, on battery)
+        self._runtimes: dict[str, tuple[int, ...]] = {}  # dev_id -> last runtimes tuple
+        self._energies: dict[str, tuple[float, ...]] = {}  # dev_id -> Wh down to each of the _runtime_levels
+        self._cached_runtimes: tuple[list[int], list[int]] | None = None  # (pooled, worst). None if stale
+
+        site_sect = config['site.' + site_id]
+        if 'members' in site_sect:
+            self.members = [m.strip() for m in site_sect['members'].split(',') if m.strip() != '']
+
+        if len(self.members) == 0:
+            self.messages.append(f'ERROR: site "{site_id}" has no members defined')
+
+    ########################################
+    def update_member(self, dev: KPowerDevice, runtimes: tuple[int, ...]) -> None:
+        """Updates totals with the fresh state of a member device.
+        :param dev: KPowerDevice: member device that has processed its latest sample
+        :param runtimes: tuple: result of dev.get_battery_runtime() for this sample
+        :return: None
+        """
+        if dev.id not in self.members:
+            return
+
+        rem_wh, _, cap_wh, _ = dev.batteries.get_remaining_power()
+        new = (dev.commons.last_load, rem_wh, cap_wh, int(dev.commons.on_battery))
+        old = self._state.get(dev.id, (0, 0, 0, 0))
+
+        self.load += new[0] - old[0]
+        self.remaining_wh += new[1] - old[1]
+        self.capacity_wh += new[2] - old[2]
+        self.on_battery += new[3] - old[3]
+
+        self._state[dev.id] = new
+        self._runtimes[dev.id] = runtimes
+        self._energies[dev.id] = tuple(dev.batteries.get_energy_to(level) if i > 0 else 0.0
+                                       for i, level in enumerate(_runtime_levels[:len(runtimes)]))
+        self._cached_runtimes = None
+        self.updated = True
+
+    ########################################
+    def remove_member(self, dev_id: str) -> None:
+        """Drops member's contribution. E.g. when device failed to initialize
+        :param dev_id: str: device ID
+        :return: None
+        """
+        if dev_id in self.members:
+            self.members.remove(dev_id)
+
+        old = self._state.pop(dev_id, None)
+        if old is not None:
+            self.load -= old[0]
+            self.remaining_wh -= old[1]
+            self.capacity_wh -= old[2]
+            self.on_battery -= old[3]
+            self._runtimes.pop(dev_id)
+            self._energies.pop(dev_id)
+            self._cached_runtimes = None
+
+    ########################################
+    def get_runtimes(self) -> tuple[list[int], list[int]]:
+        """Combines members' runtimes. Both lists have the same layout as KPowerDevice.get_battery_runtime()
+        - pooled: total energy members' batteries have above a threshold over the total load.
+          That is how long the site runs if the load is re-distributed between survivors,
+          so idle members count with all of their energy too.
+          The confidence band items are the pooled central one, scaled like the members' band on average.
+          Values are cut at the same prediction horizon as the members' ones.
+          If any member is below a threshold (negative, recharge time), the worst value is used instead.
+        - worst: element-wise minimum over members. The first member to reach a threshold decides.
+        :return: tuple(pooled, worst)
+        """
+        if self._cached_runtimes is not None:
+            return self._cached_runtimes
+
+        if len(self._runtimes) == 0:
+            self._cached_runtimes = ([], [])
+            return self._cached_runtimes
+
+        width = min(len(r) for r in self._runtimes.values())
+        worst = [min(r[i] for r in self._runtimes.values()) for i in range(width)]
+        pooled = worst.copy()
+        pooled[0] = self.remaining_wh
+
+        if self.load > 0:
+            for i in range(1, width):
+                if worst[i] < 0 or i in _band_items:
+                    continue
+
+                energy = sum(e[i] for e in self._energies.values())  # Wh
+                pooled[i] = min(int(energy * 3600 // self.load), _RUNTIME_HORIZON)
+
+            # the band is known to members in Watts of the load variation only.
+            # Using their load-weighted band to central runtimes ratio
+            central = sum(r[_central_item] * self._state[d][0] for d, r in self._runtimes.items())
+            for i in _band_items:
+                if i < width and worst[i] >= 0 and central > 0:
+                    band = sum(r[i] * self._state[d][0] for d, r in self._runtimes.items())
+                    pooled[i] = min(int(pooled[_central_item] * band / central), _RUNTIME_HORIZON)
+
+        self._cached_runtimes = (pooled, worst)
+        return self._cached_runtimes
+
+    ########################################
+    def get_report(self) -> dict[str, Any]:
+        """Returns site's aggregate data, ready to be JSON-packed and clears the .updated flag"""
+        pooled, worst = self.get_runtimes()
+        self.updated = False
+
+        return {
+            'members': self.members.copy(),
+            'reporting': len(self._state),  # how many of members have reported already
+            'load': self.load,
+            'remaining_wh': self.remaining_wh,
+            'capacity_wh': self.capacity_wh,
+            'battery_charge': 0.0 if self.capacity_wh == 0 else round(100.0 * self.remaining_wh / self.capacity_wh, 1),
+            'on_battery': self.on_battery,
+            'runtimes': pooled,
+            'runtimes_worst': worst,
+        }
@@ -2,9 +2,12 @@
 Miscellaneous utilities for dealing with electricity-related things.
 Made by Andrej Pakhutin"""
 
+from collections import deque
 from configparser import SectionProxy
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
+import time
+from typing import Any, Iterable
 
 # time constants for relaxed estimations of a week-based accounting
 SECONDS_IN_A_WEEK: int = 604_800
@@ -19,6 +22,80 @@ WEEKS_IN_A_YEAR: int = 52
 SECTOR_WIDTH: int = 5
 CHARGE_STEPS: int = 100 // SECTOR_WIDTH + 1
 
+########################################
+class KClock:
+    """
+    Time source for the power classes. The time is read once per sample with tick(),
+    then all components use the same .now and .hour, instead of asking the system each time.
+    """
+    __slots__ = ('now', '_hour', '_hour_start')
+
+    def __init__(self) -> None:
+        self.now: float = 0.0  # time of the current sample
+        self._hour: int = 0  # local hour of .now. Cached, as it is the same for the whole hour
+        self._hour_start: float = 1.0  # empty cache range
+        self.tick()
+
+    def time(self) -> float:
+        """Current time from the source. Does not change .now"""
+        return time.time()
+
+    def tick(self, at: float | None = None) -> float:
+        """Reads the source's time as the current sample's
+        :param at: float: the sample's own time if it is known, e.g. for the buffered or logged data
+        """
+        self.now = self.time() if at is None else at
+        return self.now
+
+    def _check_hour(self) -> None:
+        if not self._hour_start <= self.now < self._hour_start + 3600.0:
+            lt = time.localtime(self.now)
+            self._hour = lt.tm_hour
+            self._hour_start = self.now - self.now % 1.0 - lt.tm_min * 60 - lt.tm_sec
+
+    @property
+    def hour(self) -> int:
+        """Local hour of .now"""
+        self._check_hour()
+        return self._hour
+
+    @property
+    def to_hour_end(self) -> float:
+        """Seconds left from .now to the end of local hour"""
+        self._check_hour()
+        return self._hour_start + 3600.0 - self.now
+
+    def asctime(self) -> str:
+        """Local time of .now for humans"""
+        return time.asctime(time.localtime(self.now))
+
+
+########################################
+class KSimClock(KClock):
+    """Deterministic time source for replays, simulations and tests. Time moves only when told to"""
+    __slots__ = ('_source',)
+
+    def __init__(self, start: float = 0.0) -> None:
+        self._source: float = start
+        super().__init__()
+
+    def time(self) -> float:
+        return self._source
+
+    def tick(self, at: float | None = None) -> float:
+        if at is not None:  # samples' time is the simulated time
+            self._source = at
+        return super().tick(at)
+
+    def set(self, ts: float) -> None:
+        """Moves the time to ts and makes it current"""
+        self._source = ts
+        self.tick()
+
+    def advance(self, seconds: float) -> None:
+        self.set(self._source + seconds)
+
+
 ########################################
 @dataclass
 class KPowerDeviceCommons:
@@ -34,6 +111,7 @@ class KPowerDeviceCommons:
     on_battery: bool = False
     power_factor: float = -1.0  # dev's invertor power factor. used in battery runtime calculations
     sample_interval: int = -1
+    clock: KClock = field(default_factory=KClock)  # ticked once per sample by the device
 
 
 ########################################
@@ -144,15 +222,199 @@ def config_parse_power_option(csect: SectionProxy, name: str,
 
 
 ########################################
-def update_avg_int(old_avg: int, to_add: int, old_samples: int) -> tuple[int, int]:
-    """update and return tuple: (avg, samples) for integer avg value"""
-    return (old_avg * old_samples + to_add) // (old_samples + 1), old_samples + 1
+def update_avg_float(old_avg: float, to_add: float, old_samples: int) -> tuple[float, int]:
+    """update and return tuple: (avg, samples) for float avg value"""
+    return old_avg + (to_add - old_avg) / (old_samples + 1), old_samples + 1
 
 
 ########################################
-def update_avg_float(old_avg: float, to_add: float, old_samples: int) -> tuple[float, int]:
-    """update and return tuple: (avg, samples) for float avg value"""
-    return (old_avg * old_samples + to_add) / (old_samples + 1), old_samples + 1
+class KAccumulator:
+    """Streaming weighted mean and variance (West's variant of Welford's algorithm).
+    Does not lose precision with the sample count growing, the way avg * samples recomputation does.
+    With half_life > 0 the older samples are exponentially fading: their weight is halved
+    after half_life of newer sample weight is added (usually it is the number of samples).
+    Saved into permastats JSON as a [mean, m2, count] list. See json_default()
+    """
+    __slots__ = ('mean', 'm2', 'count', 'half_life')
+
+    def __init__(self, half_life: float = 0.0) -> None:
+        self.mean: float = 0.0
+        self.m2: float = 0.0  # sum of squared differences from the mean
+        self.count: float = 0.0  # total weight of samples. Not an integer when decaying
+        self.half_life: float = half_life  # not saved, as it is the matter of configuration
+
+    ########################################
+    def __repr__(self) -> str:
+        return f'KAccumulator(mean={self.mean}, m2={self.m2}, count={self.count})'
+
+    ########################################
+    def add(self, value: float, weight: float = 1.0) -> None:
+        """Adds a new sample"""
+        if self.half_life > 0.0:
+            fade = 0.5 ** (weight / self.half_life)
+            self.count *= fade
+            self.m2 *= fade
+
+        new_count = self.count + weight
+        delta = value - self.mean
+        incr = delta * weight / new_count
+        self.mean += incr
+        self.m2 += self.count * delta * incr
+        self.count = new_count
+
+    ########################################
+    def add_repeated(self, value: float, count: int) -> None:
+        """The same as calling add(value) count times, just faster.
+        Mean and count are exact. With decay m2 is a close approximation"""
+        if count <= 0:
+            return
+
+        if self.half_life > 0.0:
+            fade_one = 0.5 ** (1.0 / self.half_life)
+            fade = fade_one ** count
+            self.count *= fade
+            self.m2 *= fade
+            weight = (1.0 - fade) / (1.0 - fade_one)  # sum of new samples' weights, faded as they go
+        else:
+            weight = float(count)
+
+        new_count = self.count + weight
+        delta = value - self.mean
+        self.mean += delta * weight / new_count
+        self.m2 += self.count * delta * delta * weight / new_count
+        self.count = new_count
+
+    ########################################
+    def merge(self, other: 'KAccumulator') -> None:
+        """Adds other accumulator's samples into this one. Decay is not applied"""
+        count = self.count + other.count
+        if count == 0.0:
+            return
+
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+
+    ########################################
+    @property
+    def variance(self) -> float:
+        """Population variance of the samples"""
+        return self.m2 / self.count if self.count > 0.0 else 0.0
+
+    ########################################
+    @property
+    def stddev(self) -> float:
+        return self.variance ** 0.5
+
+    ########################################
+    def to_json(self) -> list[float]:
+        """Returns the state as a JSON-ready list"""
+        return [self.mean, self.m2, self.count]
+
+    ########################################
+    @classmethod
+    def from_json(cls, data: Any, half_life: float = 0.0) -> 'KAccumulator':
+        """Restores the state saved with to_json(). Raises ValueError if data is invalid"""
+        if (not isinstance(data, list) or len(data) != 3
+                or any(type(v) not in (int, float) for v in data)
+                or data[1] < 0 or data[2] < 0):
+            raise ValueError(f'invalid accumulator data: {data}')
+
+        acc = cls(half_life)
+        acc.mean, acc.m2, acc.count = float(data[0]), float(data[1]), float(data[2])
+        return acc
+
+
+########################################
+class KLinearTrend:
+    """Least squares fit of y = intercept + slope * x over the sliding window of the last points.
+    Keeps running sums, so adding a point and dropping the oldest one is O(1) regardless of the window size.
+    Keep x values small, e.g. relative to some start, or the sums will lose precision.
+    """
+    __slots__ = ('window', '_points', '_sx', '_sy', '_sxx', '_sxy')
+
+    def __init__(self, window: int) -> None:
+        self.window: int = max(2, window)  # max number of points in fit
+        self._points: deque[tuple[float, float]] = deque(maxlen=self.window)
+        self._sx: float = 0.0
+        self._sy: float = 0.0
+        self._sxx: float = 0.0
+        self._sxy: float = 0.0
+
+    ########################################
+    def __len__(self) -> int:
+        return len(self._points)
+
+    ########################################
+    def add(self, x: float, y: float) -> None:
+        """Adds a new point, dropping the oldest one if the window is full"""
+        if len(self._points) >= self.window:
+            ox, oy = self._points.popleft()
+            self._sx -= ox
+            self._sy -= oy
+            self._sxx -= ox * ox
+            self._sxy -= ox * oy
+
+        self._points.append((x, y))
+        self._sx += x
+        self._sy += y
+        self._sxx += x * x
+        self._sxy += x * y
+
+    ########################################
+    def reset(self, points: Iterable[tuple[float, float]]) -> None:
+        """Rebuilds the fit from scratch in one pass. Only the last window of points is used"""
+        self._points = deque(points, maxlen=self.window)
+
+        xs = [p[0] for p in self._points]
+        self._sx = sum(xs)
+        self._sy = sum(p[1] for p in self._points)
+        self._sxx = sum(x * x for x in xs)
+        self._sxy = sum(x * y for x, y in self._points)
+
+    ########################################
+    @property
+    def slope(self) -> float:
+        """Trend's slope: y change per 1 of x. 0 if there is not enough data"""
+        n = len(self._points)
+        denom = n * self._sxx - self._sx * self._sx
+        if n < 2 or denom <= 1e-12 * n * self._sxx:  # the same x everywhere
+            return 0.0
+
+        return (n * self._sxy - self._sx * self._sy) / denom
+
+    ########################################
+    @property
+    def intercept(self) -> float:
+        n = len(self._points)
+        if n == 0:
+            return 0.0
+
+        return (self._sy - self.slope * self._sx) / n
+
+    ########################################
+    def value_at(self, x: float) -> float:
+        """Projected y for x"""
+        return self.intercept + self.slope * x
+
+    ########################################
+    def x_at(self, y: float) -> float | None:
+        """Where the trend crosses y. None if it is flat"""
+        slope = self.slope
+        if slope == 0.0:
+            return None
+
+        return (y - self.intercept) / slope
+
+
+########################################
+def json_default(obj: Any) -> Any:
+    """json.dump() default hook for the objects that are saved in permastats"""
+    if isinstance(obj, KAccumulator):
+        return obj.to_json()
+
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
 
 
 ########################################
@@ -0,0 +1,251 @@
+"""kadpy.ksmarthistory: This module is a part of the hardware monitoring toolset from GitHub/kadavris/monitoring.
+Local history of the storage drives' S.M.A.R.T. attributes and growth-rate checks over it.
+The failing drive is rarely seen by thresholds in time. It is the counters that start to move:
+reallocated sectors growing by a handful a day or pending sectors climbing.
+Values are kept in SQLite, downsampled into the hourly and daily buckets. Each kind is a ring of fixed size
+per drive and attribute: the slot is the bucket number modulo the ring size, so appending is a single upsert
+and the file does not grow over time.
+Made by Andrej Pakhutin"""
+
+import re
+import sqlite3
+import time
+
+HOUR: int = 3600
+DAY: int = 24 * HOUR
+
+_SCHEMA_VERSION: int = 1
+
+_window_units: dict[str, int] = { 's': 1, 'm': 60, 'h': HOUR, 'd': DAY, 'w': 7 * DAY }
+
+
+########################################
+def parse_window(spec: str) -> int:
+    """Converts a time window like '90m', '12h', '1d', '2w' or plain seconds into seconds
+    :param spec: str: number with an optional s/m/h/d/w unit suffix
+    :return: int: seconds
+    """
+    m = re.fullmatch(r'\s*(\d+)\s*([smhdw]?)\s*', spec.lower())
+    if not m or int(m.group(1)) == 0:
+        raise ValueError(f'invalid time window "{spec}"')
+
+    return int(m.group(1)) * _window_units[m.group(2) or 's']
+
+
+########################################
+def window_to_str(seconds: float) -> str:
+    """The reverse of parse_window(): the largest unit that fits evenly"""
+    seconds = int(seconds)
+    for unit in ('w', 'd', 'h', 'm'):
+        if seconds % _window_units[unit] == 0:
+            return str(seconds // _window_units[unit]) + unit
+
+    return str(seconds) + 's'
+
+
+########################################
+def parse_growth_rules(spec: str) -> list[tuple[str, float, int]]:
+    """Parses the growth limits list: 'attribute: limit/window, ...'. E.g. '5: 8/1d, 197: 1/1d, media_errors: 1/7d'
+    means a warning when the attribute 5 has grown by 8 or more in a day and so on.
+    The same attribute may be listed for several windows.
+    :param spec: str: rules list, comma or newline separated
+    :return: list of (attribute, limit, window in seconds)
+    """
+    rules = []
+    for item in re.split(r'[,\n]', spec):
+        if item.strip() == '':
+            continue
+
+        m = re.fullmatch(r'\s*(\w+)\s*:\s*([\d.]+)\s*/\s*(\w+)\s*', item)
+        if not m:
+            raise ValueError(f'invalid growth rule "{item.strip()}"')
+
+        limit = float(m.group(2))
+        if limit <= 0:
+            raise ValueError(f'growth limit should be positive in "{item.strip()}"')
+
+        rules.append((m.group(1), limit, parse_window(m.group(3))))
+
+    return rules
+
+
+########################################
+class KSmartHistory:
+    """
+    Attributes history storage. Attributes are named by strings: ATA ids as '5', '197',
+    NVMe health log keys as they are: 'media_errors'.
+    Drives are named by the caller, better by something that follows the drive: WWID or model + serial.
+    """
+    def __init__(self, path: str, hours: int = 7 * 24, days: int = 2 * 365) -> None:
+        """
+        :param path: str: database file. ':memory:' is for tests
+        :param hours: int: how many hourly buckets to keep
+        :param days: int: how many daily buckets to keep
+        """
+        if hours < 1 or days < 1:
+            raise ValueError('history ring sizes should be positive')
+
+        # bucket length -> ring size
+        self._rings: dict[int, int] = { HOUR: hours, DAY: days }
+
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA synchronous = NORMAL')  # losing the last bucket on a crash is fine
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS history (
+                drive TEXT NOT NULL, attr TEXT NOT NULL, period INTEGER NOT NULL, slot INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,  -- start of the bucket, unix time
+                first REAL NOT NULL, last REAL NOT NULL, lo REAL NOT NULL, hi REAL NOT NULL,
+                PRIMARY KEY (drive, attr, period, slot)
+            ) WITHOUT ROWID;
+        ''')
+
+        ver = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if ver == 0:
+            self._db.execute(f'PRAGMA user_version = {_SCHEMA_VERSION}')
+        elif ver != _SCHEMA_VERSION:
+            self._db.close()
+            raise ValueError(f'{path}: history schema version {ver} is not supported')
+
+        self._db.commit()
+
+
+    ########################################
+    def close(self) -> None:
+        self._db.close()
+
+
+    ########################################
+    def append(self, drive: str, values: dict[str, float], ts: float | None = None) -> None:
+        """Records the current values of the drive's attributes
+        :param drive: str: drive id
+        :param values: dict: attribute -> value
+        :param ts: float: time of the reading. Now by default
+        :return: None
+        """
+        if not values:
+            return
+
+        if ts is None:
+            ts = time.time()
+
+        rows = []
+        for period, size in self._rings.items():
+            bucket = int(ts) // period
+            for attr, v in values.items():
+                rows.append((drive, attr, period, bucket % size, bucket * period, v, v, v, v))
+
+        # a row of the same slot is either the current bucket or the one that has gone out of the ring
+        self._db.executemany('''
+            INSERT INTO history (drive, attr, period, slot, bucket, first, last, lo, hi)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (drive, attr, period, slot) DO UPDATE SET
+                first = CASE WHEN bucket = excluded.bucket THEN first ELSE excluded.first END,
+                lo = CASE WHEN bucket = excluded.bucket THEN min(lo, excluded.lo) ELSE excluded.lo END,
+                hi = CASE WHEN bucket = excluded.bucket THEN max(hi, excluded.hi) ELSE excluded.hi END,
+                last = excluded.last,
+                bucket = excluded.bucket
+        ''', rows)
+        self._db.commit()
+
+
+    ########################################
+    def _period_for(self, window: float) -> int:
+        """Hourly buckets if the window fits in their ring, daily otherwise"""
+        return HOUR if window <= self._rings[HOUR] * HOUR else DAY
+
+
+    ########################################
+    def series(self, drive: str, attr: str, period: int = HOUR,
+               now: float | None = None) -> list[tuple[int, float, float, float, float]]:
+        """The downsampled history, oldest first
+        :param drive: str: drive id
+        :param attr: str: attribute
+        :param period: int: HOUR or DAY
+        :param now: float: the current time. Buckets that are older than the ring are skipped
+        :return: list of (bucket start time, first, last, min, max)
+        """
+        if period not in self._rings:
+            raise ValueError(f'no history with {period} seconds buckets')
+
+        if now is None:
+            now = time.time()
+
+        oldest = (int(now) // period - self._rings[period] + 1) * period
+        return self._db.execute('''
+            SELECT bucket, first, last, lo, hi FROM history
+            WHERE drive = ? AND attr = ? AND period = ? AND bucket >= ? ORDER BY bucket
+        ''', (drive, attr, period, oldest)).fetchall()
+
+
+    ########################################
+    def growth(self, drive: str, attr: str, window: float, now: float | None = None) -> tuple[float, float] | None:
+        """How much the attribute has changed over the last window seconds.
+        The base is the last value of the latest bucket that ended before the window started,
+        so the change may cover up to a bucket more than the window.
+        If the history is shorter than the window, the very first value recorded is the base,
+        so a young history still tells about the fast growth.
+        :param drive: str: drive id
+        :param attr: str: attribute
+        :param window: float: seconds
+        :param now: float: the current time
+        :return: tuple(change, seconds actually covered) or None if there is no history
+        """
+        if now is None:
+            now = time.time()
+
+        period = self._period_for(window)
+        rows = self.series(drive, attr, period, now)
+        if not rows:
+            return None
+
+        start = now - window
+        base, base_ts = rows[0][1], rows[0][0]
+        for bucket, _, last, _, _ in rows:
+            if bucket + period > start:
+                break
+
+            base, base_ts = last, bucket + period
+
+        return rows[-1][2] - base, now - base_ts
+
+
+    ########################################
+    def check_growth(self, drive: str, rules: list[tuple[str, float, int]], now: float | None = None) -> list[str]:
+        """Checks the attributes growth against the limits
+        :param drive: str: drive id
+        :param rules: list: see parse_growth_rules()
+        :param now: float: the current time
+        :return: list[str]: a message for each limit reached
+        """
+        messages = []
+        for attr, limit, window in rules:
+            g = self.growth(drive, attr, window, now)
+            if g is not None and g[0] >= limit:
+                covered = window if g[1] >= window else max(HOUR, g[1] - g[1] % HOUR)
+                messages.append(f'Attribute {attr} grew by {g[0]:g} in {window_to_str(covered)}'
+                                f' (limit: {limit:g}/{window_to_str(window)})')
+
+        return messages
+
+
+    ########################################
+    def trends(self, drive: str, attrs: list[str], windows: list[int], now: float | None = None) -> dict[str, dict]:
+        """Changes of the attributes over several windows, for the reports
+        :param drive: str: drive id
+        :param attrs: list[str]: attributes
+        :param windows: list[int]: seconds
+        :param now: float: the current time
+        :return: dict: attribute -> { window as '1d' and such: change }. Attributes without history are skipped
+        """
+        ret = {}
+        for attr in attrs:
+            changes = {}
+            for window in windows:
+                g = self.growth(drive, attr, window, now)
+                if g is not None:
+                    changes[window_to_str(window)] = g[0]
+
+            if changes:
+                ret[attr] = changes
+
+        return ret
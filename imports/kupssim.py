@@ -0,0 +1,381 @@
+"""kadpy.kupssim: This module is a part of the hardware monitoring toolset from GitHub/kadavris/monitoring.
+Synthetic UPS with a battery bank, load profile and blackouts, running on a virtual clock.
+It produces upsc-like data for testing the stats code on years of operation without waiting for real blackouts.
+See hardware/power/testing/ups-simulator for the fake upsd/upsc and benchmark runs.
+Made by Andrej Pakhutin"""
+
+from bisect import bisect_right
+from configparser import SectionProxy
+import math
+import random
+import time
+from typing import Iterator
+from kadpy.kpowerutils import SECONDS_IN_YEAR
+
+# Resting voltage of a single 12v element at 0%, 10%, ... 100% charge. This is the simulated "truth",
+# deliberately kept apart from the battery classes' own settings
+_SIM_CURVES: dict[str, list[float]] = {
+    'pb': [10.8, 11.51, 11.66, 11.81, 11.95, 12.05, 12.15, 12.3, 12.5, 12.75, 12.85],
+    'lifepo': [10.0, 12.5, 12.9, 13.0, 13.05, 13.1, 13.15, 13.2, 13.25, 13.3, 13.4],
+}
+# element voltage on mains: (charging starts at, charging ends at, when full)
+_SIM_CHARGE_V: dict[str, tuple[float, float, float]] = {
+    'pb': (13.2, 14.1, 13.5),  # bulk/absorption then float
+    'lifepo': (13.3, 13.55, 13.65),
+}
+# UPS shuts down when element voltage under load drops to this
+_SIM_CUTOFF: dict[str, float] = {'pb': 10.5, 'lifepo': 11.6}
+_SIM_TYPE_NAMES: dict[str, str] = {'pb': 'PbAc', 'lifepo': 'LiFePO4'}
+
+_R_ELEMENT: float = 0.012  # Ohm. Internal resistance of a new 12v element
+_CHARGE_EFFICIENCY: float = 0.9
+_TAPER_SOC: float = 0.9  # charging current goes down linearly above this state of charge
+_MIN_HEALTH: float = 0.05
+
+
+########################################
+class KSimBattery:
+    """Battery bank model: state of charge, voltage sag under load, ageing by time and by cycles"""
+    def __init__(self, chem: str = 'pb', vnom: int = 48, capacity_ah: float = 100.0, age_years: float = 0.0,
+                 fade_per_year: float = 0.05, fade_per_cycle: float = 0.0005) -> None:
+        """
+        :param chem: str: 'pb' or 'lifepo'
+        :param vnom: int: nominal voltage. Multiple of 12
+        :param capacity_ah: float: nominal capacity
+        :param age_years: float: starting age
+        :param fade_per_year: float: part of the capacity lost each year of life
+        :param fade_per_cycle: float: part of the capacity lost with each full equivalent discharge
+        """
+        if chem not in _SIM_CURVES:
+            raise ValueError(f'unknown battery chemistry: {chem}')
+
+        if vnom < 12 or vnom % 12 != 0:
+            raise ValueError(f'vnom should be a multiple of 12: {vnom}')
+
+        self.chem = chem
+        self.vnom = vnom
+        self.capacity_ah = capacity_ah
+        self.age_years = age_years
+        self.fade_per_year = fade_per_year
+        self.fade_per_cycle = fade_per_cycle
+        self.cycles: float = 0.0  # full equivalent discharges
+        self.soc: float = 1.0  # state of charge 0..1
+
+        self._elements: int = vnom // 12
+        self._curve = _SIM_CURVES[chem]
+
+    ########################################
+    @property
+    def health(self) -> float:
+        """Part of the nominal capacity that is left"""
+        return max(_MIN_HEALTH, 1.0 - self.fade_per_year * self.age_years - self.fade_per_cycle * self.cycles)
+
+    ########################################
+    @property
+    def capacity_wh(self) -> float:
+        return self.vnom * self.capacity_ah * self.health
+
+    ########################################
+    def _rest_voltage(self) -> float:
+        """Resting voltage of a single element for the current state of charge"""
+        pos = min(max(self.soc, 0.0), 1.0) * 10.0
+        i = min(int(pos), 9)
+        return self._curve[i] + (self._curve[i + 1] - self._curve[i]) * (pos - i)
+
+    ########################################
+    def element_voltage(self, load_w: float, on_battery: bool) -> float:
+        """Voltage of a single 12v element
+        :param load_w: float: load in Watts
+        :param on_battery: bool: discharging or being charged
+        """
+        if on_battery:
+            current = load_w / self.vnom
+            return self._rest_voltage() - current * _R_ELEMENT / self.health
+
+        v_start, v_end, v_full = _SIM_CHARGE_V[self.chem]
+        if self.soc >= 1.0:
+            return v_full
+
+        return v_start + (v_end - v_start) * self.soc
+
+    ########################################
+    def is_empty(self, load_w: float) -> bool:
+        return self.soc <= 0.0 or self.element_voltage(load_w, True) <= _SIM_CUTOFF[self.chem]
+
+    ########################################
+    def step(self, dt: float, load_w: float, on_battery: bool, charging_current: float,
+             mains: bool | None = None) -> None:
+        """Advances the battery state by dt seconds
+        :param dt: float: seconds
+        :param load_w: float: load in Watts. Used when on battery
+        :param on_battery: bool: the battery is feeding the load
+        :param charging_current: float: Amps of the device's charger
+        :param mains: bool: is there power to charge from. Default is not on_battery.
+                      Neither is the case when UPS has shut down in a blackout: the battery is left as it is
+        """
+        if mains is None:
+            mains = not on_battery
+
+        cap = self.capacity_wh
+        if on_battery:
+            drained = load_w * dt / 3600.0
+            self.soc -= drained / cap
+            self.cycles += drained / (self.vnom * self.capacity_ah)
+        elif mains and self.soc < 1.0:
+            taper = 1.0 if self.soc < _TAPER_SOC else max(0.05, (1.0 - self.soc) / (1.0 - _TAPER_SOC))
+            self.soc += self.vnom * charging_current * taper * _CHARGE_EFFICIENCY * dt / 3600.0 / cap
+
+        self.soc = min(max(self.soc, 0.0), 1.0)
+        self.age_years += dt / SECONDS_IN_YEAR
+
+
+########################################
+class KSimLoad:
+    """Daily load profile: base load with a sine swing peaking at the given hour, plus random noise"""
+    def __init__(self, base_w: float, swing_w: float = 0.0, peak_hour: float = 20.0, noise_w: float = 0.0,
+                 rng: random.Random | None = None) -> None:
+        self.base_w = base_w
+        self.swing_w = swing_w
+        self.peak_hour = peak_hour
+        self.noise_w = noise_w
+        self._rng = rng if rng is not None else random.Random()
+
+    ########################################
+    def at(self, ts: float) -> float:
+        """Load in Watts at the time"""
+        tm = time.localtime(ts)
+        hour = tm.tm_hour + tm.tm_min / 60.0
+        load = self.base_w + self.swing_w * math.cos((hour - self.peak_hour) * math.pi / 12.0)
+        if self.noise_w > 0.0:
+            load += self._rng.gauss(0.0, self.noise_w)
+
+        return max(0.0, load)
+
+
+########################################
+class KSimBlackouts:
+    """Blackouts schedule: fixed list plus random ones with the given monthly rate and mean duration"""
+    def __init__(self, fixed: list[tuple[float, float]] | None = None, per_month: float = 0.0,
+                 mean_minutes: float = 30.0, start: float = 0.0, rng: random.Random | None = None) -> None:
+        """
+        :param fixed: list of (start timestamp, duration seconds)
+        :param per_month: float: random blackouts rate
+        :param mean_minutes: float: random blackouts mean duration
+        :param start: float: time to start the random ones from
+        """
+        self._fixed = sorted(fixed or [])
+        self._fixed_starts = [b[0] for b in self._fixed]
+        self._rate = per_month / (30 * 86400.0)  # per second
+        self._mean_minutes = mean_minutes
+        self._rng = rng if rng is not None else random.Random()
+        self._next: tuple[float, float] = (math.inf, math.inf)
+        if self._rate > 0.0:
+            self._schedule_random(start)
+
+    ########################################
+    def _schedule_random(self, after: float) -> None:
+        begin = after + self._rng.expovariate(self._rate)
+        self._next = (begin, begin + self._rng.expovariate(1.0 / (self._mean_minutes * 60.0)))
+
+    ########################################
+    def is_on(self, ts: float) -> bool:
+        """Is there a blackout at the time. Random ones expect non-decreasing ts"""
+        i = bisect_right(self._fixed_starts, ts) - 1
+        if i >= 0 and ts < self._fixed[i][0] + self._fixed[i][1]:
+            return True
+
+        while ts >= self._next[1]:
+            self._schedule_random(self._next[1])
+
+        return ts >= self._next[0]
+
+
+########################################
+class KUPSSim:
+    """Simulated UPS. Call advance() to move its virtual clock, then report() to get upsc-like data"""
+    def __init__(self, ups_id: str, battery: KSimBattery, load: KSimLoad, blackouts: KSimBlackouts,
+                 power_rating_w: int = 2000, charging_current: float = 10.0, start: float | None = None,
+                 step: float = 30.0, rng: random.Random | None = None) -> None:
+        """
+        :param ups_id: str: device name as upsc knows it
+        :param power_rating_w: int: load is reported in percents of this
+        :param charging_current: float: Amps
+        :param start: float: virtual clock start. Default is now
+        :param step: float: the longest integration step in seconds
+        """
+        self.id = ups_id
+        self.battery = battery
+        self.load = load
+        self.blackouts = blackouts
+        self.power_rating_w = power_rating_w
+        self.charging_current = charging_current
+        self.step = step
+        self.now: float = time.time() if start is None else start
+        self.load_w: float = load.at(self.now)
+        self.on_battery: bool = False
+        self.off: bool = False  # shut down by the empty battery until the mains are back
+
+        self._rng = rng if rng is not None else random.Random()
+
+    ########################################
+    @staticmethod
+    def from_config(ups_id: str, conf: SectionProxy, start: float | None = None) -> 'KUPSSim':
+        """Makes a simulator from an .ini section. See the testing/ups-simulator.sample.ini
+        :raise ValueError: on invalid settings
+        """
+        seed = conf.get('seed', None)
+        rng = random.Random(seed)
+        if start is None:
+            start = time.time()
+
+        fixed = []
+        for item in conf.get('blackouts', '').split(','):
+            if item.strip():
+                hours, minutes = item.split(':')
+                fixed.append((start + float(hours) * 3600.0, float(minutes) * 60.0))
+
+        battery = KSimBattery(conf.get('type', 'pb'), conf.getint('vnom', 48), conf.getfloat('capacity_ah', 100.0),
+                              conf.getfloat('age_years', 0.0), conf.getfloat('fade_per_year', 0.05),
+                              conf.getfloat('fade_per_cycle', 0.0005))
+        load = KSimLoad(conf.getfloat('load_w', 400.0), conf.getfloat('load_swing_w', 0.0),
+                        conf.getfloat('peak_hour', 20.0), conf.getfloat('load_noise_w', 0.0), rng)
+        blackouts = KSimBlackouts(fixed, conf.getfloat('blackouts_per_month', 0.0),
+                                  conf.getfloat('blackout_minutes', 30.0), start, rng)
+
+        return KUPSSim(ups_id, battery, load, blackouts, conf.getint('power_rating_w', 2000),
+                       conf.getfloat('charging_current', 10.0), start, conf.getfloat('step', 30.0), rng)
+
+    ########################################
+    def advance(self, seconds: float) -> None:
+        """Moves the virtual clock forward, integrating the battery state in steps"""
+        end = self.now + seconds
+        while self.now < end:
+            dt = min(self.step, end - self.now)
+            self.battery.step(dt, self.load_w, self.on_battery and not self.off, self.charging_current,
+                              not self.on_battery)
+            self.now += dt
+            self.load_w = self.load.at(self.now)
+
+            mains = not self.blackouts.is_on(self.now)
+            if mains:
+                self.off = False
+            elif not self.off and self.battery.is_empty(self.load_w):
+                self.off = True
+
+            self.on_battery = not mains
+
+    ########################################
+    def report(self) -> dict[str, str] | None:
+        """upsc-like data for the current moment. None if UPS is shut down"""
+        if self.off:
+            return None
+
+        bat = self.battery
+        v = bat.element_voltage(self.load_w, self.on_battery) * (bat.vnom // 12)
+        load_prc = min(100, round(100.0 * self.load_w / self.power_rating_w))
+        runtime = int(bat.soc * bat.capacity_wh * 3600.0 / self.load_w) if self.load_w > 0.0 else 86400
+
+        if self.on_battery:
+            status = 'OB DISCHRG'
+            if bat.soc < 0.2:
+                status += ' LB'
+            in_v = 0.0
+            in_f = 0.0
+        else:
+            status = 'OL' if bat.soc >= 1.0 else 'OL CHRG'
+            in_v = 230.0 + self._rng.gauss(0.0, 2.0)
+            in_f = 50.0 + self._rng.gauss(0.0, 0.05)
+
+        return {
+            'battery.charge': str(round(100.0 * bat.soc)),
+            'battery.runtime': str(runtime),
+            'battery.type': _SIM_TYPE_NAMES[bat.chem],
+            'battery.voltage': f'{v:.1f}',
+            'battery.voltage.nominal': str(bat.vnom),
+            'device.mfr': 'kadpy',
+            'device.model': 'UPS simulator',
+            'device.type': 'ups',
+            'input.frequency': f'{in_f:.1f}',
+            'input.voltage': f'{in_v:.1f}',
+            'output.frequency': '50.0',
+            'output.voltage': '230.0',
+            'ups.load': str(load_prc),
+            'ups.realpower.nominal': str(self.power_rating_w),
+            'ups.status': status,
+        }
+
+    ########################################
+    def samples(self, interval: float, seconds: float) -> Iterator[tuple[float, dict[str, str]]]:
+        """Runs the simulation, producing samples in the KPowerReplay.feed_samples() format.
+        Loads are converted to Watts. Samples are skipped while UPS is shut down
+        :param interval: float: seconds between samples
+        :param seconds: float: how long to run
+        """
+        end = self.now + seconds
+        while self.now + interval <= end:
+            self.advance(interval)
+            rep = self.report()
+            if rep is None:
+                continue
+
+            yield self.now, {
+                'ups_load': str(round(int(rep['ups.load']) * self.power_rating_w / 100.0)),
+                'ups_status': rep['ups.status'],
+                'battery_voltage': rep['battery.voltage'],
+                'battery_charge': rep['battery.charge'],
+            }
+
+
+########################################
+def format_upsc(report: dict[str, str]) -> str:
+    """Formats the report the way upsc does"""
+    return ''.join(f'{k}: {v}\n' for k, v in sorted(report.items()))
+
+
+########################################
+def nut_command(sims: dict[str, KUPSSim], line: str) -> tuple[str, bool]:
+    """Answers a single NUT network protocol command, as upsd does. Only the read-only part is supported
+    :param sims: dict: simulators by UPS name
+    :param line: str: command line
+    :return: tuple(reply text with the trailing newline, bool: close the connection)
+    """
+    words = line.split()
+    cmd = ' '.join(words[:2]).upper()
+
+    if cmd == 'LIST UPS':
+        return ('BEGIN LIST UPS\n' + ''.join(f'UPS {u} "Simulated UPS"\n' for u in sims)
+                + 'END LIST UPS\n'), False
+
+    if cmd in ('LIST VAR', 'GET VAR') and len(words) >= 3:
+        sim = sims.get(words[2], None)
+        if sim is None:
+            return 'ERR UNKNOWN-UPS\n', False
+
+        rep = sim.report()
+        if rep is None:
+            return 'ERR DATA-STALE\n', False
+
+        if cmd == 'GET VAR':
+            if len(words) < 4 or words[3] not in rep:
+                return 'ERR VAR-NOT-SUPPORTED\n', False
+            return f'VAR {sim.id} {words[3]} "{rep[words[3]]}"\n', False
+
+        return (f'BEGIN LIST VAR {sim.id}\n' + ''.join(f'VAR {sim.id} {k} "{v}"\n' for k, v in sorted(rep.items()))
+                + f'END LIST VAR {sim.id}\n'), False
+
+    if not words:
+        return 'ERR UNKNOWN-COMMAND\n', False
+
+    first = words[0].upper()
+    if first in ('USERNAME', 'PASSWORD'):
+        return 'OK\n', False
+    if first == 'STARTTLS':
+        return 'ERR FEATURE-NOT-CONFIGURED\n', False
+    if first == 'VER':
+        return 'kadpy UPS simulator\n', False
+    if first == 'NETVER':
+        return '1.3\n', False
+    if first == 'LOGOUT':
+        return 'OK Goodbye\n', True
+
+    return 'ERR UNKNOWN-COMMAND\n', False
@@ -132,6 +132,81 @@ class TestKBatteries(unittest.TestCase):
 
         self._perform_good_battery_defs_checks(conf_init, 2)
 
+        conf_init[self.tpl_dev_section]['batteries'] = 'bat1, bat2, bat3'
+        conf_init['battery.bat3'] = {'type': 'lifepo', 'vnom': '48', 'capacity_ah': '200'}
+
+        self._perform_good_battery_defs_checks(conf_init, 3)
+
+
+    ################################################
+    def test_index_and_cache(self):
+        """Batteries are looked up by ID and aggregates are computed once per sample"""
+        conf_init = copy.deepcopy( self.tpl_config )
+        conf_init[self.tpl_dev_section]['batteries'] = 'bat1, bat2, bat1'
+        conf_init['battery.bat1'] = {'type': 'pb', 'vnom': '48', 'capacity_ah': '100'}
+        conf_init['battery.bat2'] = {'type': 'pb', 'vnom': '48', 'capacity_ah': '300'}
+        conf = ConfigParser()
+        conf.read_dict(conf_init)
+
+        kb = KBatteries(make_commons(self.tpl_dev_id), conf, None)
+        self.assertEqual(1, len(kb.messages), kb.messages)  # duplicate ID
+        self.assertEqual(('bat1', 'bat2'), kb.get_list())
+        self.assertEqual('bat2', kb['bat2'].id)
+        self.assertIsNone(kb['nope'])
+
+        rp = kb.get_remaining_power()
+        self.assertIs(rp, kb.get_remaining_power())
+        kb.process_upsc_data({'battery_voltage': '50.0'})
+        self.assertIsNot(rp, kb.get_remaining_power())
+
+        # a health check in the middle of the sample shrinks the capacity: the aggregates are stale then
+        rp = kb.get_remaining_power()
+        energy = kb.get_energy_to(10.0)
+        b2 = kb['bat2']
+        b2._pdata['health']['cycles'][2] = 250
+        b2._health_dirty = True
+        b2.get_battery_health()
+        self.assertEqual(50, b2.wellness)
+        self.assertEqual(kb['bat1'].capacity_wh + b2.capacity_wh, kb.capacity_wh)
+        self.assertEqual(kb.capacity_wh, kb.get_remaining_power()[2])
+        self.assertLess(kb.get_remaining_power()[0], rp[0])
+        self.assertEqual(sum(kb[i].get_energy_to(10.0) for i in kb.get_list()), kb.get_energy_to(10.0))
+        self.assertNotEqual(energy, kb.get_energy_to(10.0))
+
+
+    ################################################
+    def test_topology(self):
+        """Series/parallel strings split the load, voltage and charging current"""
+        conf_init = copy.deepcopy( self.tpl_config )
+        conf_init[self.tpl_dev_section]['batteries'] = 'b1 + b2, b3'
+        conf_init['battery.b1'] = {'type': 'pb', 'vnom': '24', 'capacity_ah': '100'}
+        conf_init['battery.b2'] = {'type': 'pb', 'vnom': '24', 'capacity_ah': '100'}
+        conf_init['battery.b3'] = {'type': 'pb', 'vnom': '48', 'capacity_ah': '50'}
+        conf = ConfigParser()
+        conf.read_dict(conf_init)
+
+        kb = KBatteries(make_commons(self.tpl_dev_id), conf, None)
+        self.assertEqual(0, len(kb.messages), kb.messages)
+        b1, b3 = kb['b1'], kb['b3']
+        self.assertEqual(0.5, b1.voltage_scale)
+        self.assertEqual(1.0, b3.voltage_scale)
+        self.assertAlmostEqual(1.0 / 3, b1.load_share)
+        self.assertAlmostEqual(1.0, sum(kb[i].load_share for i in kb.get_list()))
+        # 12A are split 2:1 between strings
+        self.assertEqual(24 * 8, b1.charging_speed_wh)
+        self.assertEqual(48 * 4, b3.charging_speed_wh)
+        self.assertEqual(2 * 24 * 8 + 48 * 4, kb.get_remaining_power()[3])
+
+        # 48v bank reading: each 24v pack has 2 elements at 12.5v
+        self.assertEqual(12.5, b1._element_voltage({'battery_voltage': '50.0'}))
+
+        conf_init['battery.b3']['vnom'] = '36'
+        conf = ConfigParser()
+        conf.read_dict(conf_init)
+        kb = KBatteries(make_commons(self.tpl_dev_id), conf, None)
+        self.assertEqual(1, len(kb.messages), kb.messages)
+        self.assertTrue(kb.messages[0].startswith('WARNING'))
+
 
 ########################################
 if __name__ == '__main__':
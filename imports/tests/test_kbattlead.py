@@ -6,7 +6,7 @@ import unittest
 from configparser import ConfigParser
 from typing import Any
 import imports.kpowerutils as kpu
-from imports.kbattlead import KBattLead, _volts_at_charge, _voltage_to_charge, _v_fatal, \
+from imports.kbattlead import KBattLead, KVoltageCurve, _volts_at_charge, _voltage_to_charge, _v_fatal, \
                        _v_float, _v_boost, _CS_NONE, _CS_BOOST, _CS_FLOAT
 
 # test range: used in a sector traverse checking
@@ -94,6 +94,44 @@ class TestKBattLead(unittest.TestCase):
             self.assertEqual(p[1], _voltage_to_charge(p[0]), f'{p[0]}V -> {p[1]}%: ')
 
 
+    ########################################
+    def test_voltage_curve(self):
+        """Test of the KVoltageCurve lookup table against direct calculation"""
+        curve = KVoltageCurve.get(_volts_at_charge, 12.8)
+        self.assertIs( curve, KVoltageCurve.get(list(_volts_at_charge), 12.8) )  # shared
+
+        volts = [mv / 1000.0 for mv in range(10_000, 13_500)]
+        charges = curve.to_charge_many(volts)
+        for v, ch in zip(volts, charges):
+            self.assertEqual( curve.exact(v), ch, f'{v}V' )
+            self.assertEqual( ch, curve.to_charge(v), f'{v}V' )
+
+        # every 10% segment is used. 12.78V is in 90-100% one
+        self.assertEqual( 93.0, curve.to_charge(12.78) )
+        # upsc reports are 0.1V precise and divided by pack size, making it a bit off the mV grid
+        self.assertEqual( curve.exact(12.3), curve.to_charge(49.2 / 4) )
+
+        for bad in [_volts_at_charge[:-1], list(reversed(_volts_at_charge))]:
+            with self.assertRaises(ValueError):
+                KVoltageCurve(bad)
+
+
+    ########################################
+    def test_voltage_curve_config(self):
+        """Custom battery model's curve from .ini"""
+        self.tpl_config_battery['volts_at_charge'] = '11.0,11.2,11.4,11.6,11.8,12.0,12.2,12.4,12.6,12.8,13.2'
+        kb = self._make_class()
+        self.assertFalse( kb.invalid, kb.messages )
+        self.assertEqual( 50.0, kb._curve.to_charge(12.0) )
+        self.assertEqual( 95.0, kb._curve.to_charge(13.0) )  # above the default table range
+        self.assertEqual( 100.0, kb._curve.to_charge(13.5) )
+
+        self.tpl_config_battery['volts_at_charge'] = '11.0,11.2,oops'
+        kb = self._make_class()
+        self.assertTrue( kb.invalid )
+        self.assertIn( 'volts_at_charge', kb.messages[0] )
+
+
     ########################################
     def _make_class(self, saved_stats: dict | None = None) -> KBattLead:
         """A helper to get all things pre-initialized for the majority of tests"""
@@ -135,10 +173,8 @@ class TestKBattLead(unittest.TestCase):
                 },
                 'weekly': {
                     'start_ts': [123],
-                    'discharge_speed_avg': [[0.5] * kpu.CHARGE_STEPS],
-                    'discharge_speed_samples': [[1] * kpu.CHARGE_STEPS],
-                    'charge_speed_avg': [[1.0] * kpu.CHARGE_STEPS],
-                    'charge_speed_samples': [[1] * kpu.CHARGE_STEPS],
+                    'discharge_speed': [[[0.5, 0.0, 1]] * kpu.CHARGE_STEPS],
+                    'charge_speed': [[[1.0, 0.0, 1]] * kpu.CHARGE_STEPS],
                 },
             },
         }
@@ -340,8 +376,8 @@ class TestKBattLead(unittest.TestCase):
         self.assertEqual(kb._charge_sector, _test_range[tr_index][0])
         # make sure there was no update of a partial sector
         for k in ['discharge_speed', 'charge_speed']:
-            self.assertEqual(w[k + '_avg'][0][sector],0.0)
-            self.assertEqual(w[k + '_samples'][0][sector], 0)
+            self.assertEqual(w[k][0][sector].mean,0.0)
+            self.assertEqual(w[k][0][sector].count, 0)
 
 
     ########################################
@@ -382,8 +418,8 @@ class TestKBattLead(unittest.TestCase):
 
         self.assertEqual(count, kb._state_samples)
         for k in ['discharge_speed', 'charge_speed']:  # should be no stats recorded
-            self.assertEqual(0.0, w[k + '_avg'][0][prev_sector])
-            self.assertEqual(0, w[k + '_samples'][0][prev_sector])
+            self.assertEqual(0.0, w[k][0][prev_sector].mean)
+            self.assertEqual(0, w[k][0][prev_sector].count)
 
         # transit to a final sector
         prev_sector = kb._charge_sector
@@ -394,13 +430,13 @@ class TestKBattLead(unittest.TestCase):
         self.assertEqual(kb._charge_sector, _test_range[tr_index][0])
 
         # make sure there have been update of a full sector
-        self.assertEqual(0.0, w['charge_speed_avg'][0][prev_sector])
-        self.assertEqual(0, w['charge_speed_samples'][0][prev_sector])
+        self.assertEqual(0.0, w['charge_speed'][0][prev_sector].mean)
+        self.assertEqual(0, w['charge_speed'][0][prev_sector].count)
 
         # due to approximation of timings, there will be a slight difference
         self.assertAlmostEqual(float(kb.commons.last_load) * count * kb.commons.sample_interval /
-                         w['discharge_speed_avg'][0][prev_sector], 1.0, 1)
-        self.assertEqual(1, w['discharge_speed_samples'][0][prev_sector])
+                         w['discharge_speed'][0][prev_sector].mean, 1.0, 1)
+        self.assertEqual(1, w['discharge_speed'][0][prev_sector].count)
 
 
     ########################################
@@ -439,8 +475,8 @@ class TestKBattLead(unittest.TestCase):
         self.assertEqual(_test_range[tr_index][7], kb._charge_sector)
         self.assertFalse(kb._was_discharging)
         # got initial OB records
-        self.assertNotEqual(w['discharge_speed_avg'][0][prev_sector], 0.0)
-        self.assertNotEqual(w['discharge_speed_samples'][0][prev_sector], 0)
+        self.assertNotEqual(w['discharge_speed'][0][prev_sector].mean, 0.0)
+        self.assertNotEqual(w['discharge_speed'][0][prev_sector].count, 0)
 
         # 2nd update with full range
         v = _test_range[tr_index][2]
@@ -449,8 +485,8 @@ class TestKBattLead(unittest.TestCase):
         prev_sector = kb._charge_sector
 
         # no record at this time
-        self.assertEqual(w['charge_speed_avg'][0][kb._charge_sector], 0.0)
-        self.assertEqual(w['charge_speed_samples'][0][kb._charge_sector], 0)
+        self.assertEqual(w['charge_speed'][0][kb._charge_sector].mean, 0.0)
+        self.assertEqual(w['charge_speed'][0][kb._charge_sector].count, 0)
 
         # finally get back to OB again
         kb.commons.on_battery = True
@@ -460,8 +496,8 @@ class TestKBattLead(unittest.TestCase):
 
         self.assertEqual(_test_range[tr_index][0], kb._charge_sector)
         self.assertTrue(kb._was_discharging)
-        self.assertNotEqual(w['charge_speed_avg'][0][prev_sector], 0.0)
-        self.assertNotEqual(w['charge_speed_samples'][0][prev_sector], 0)
+        self.assertNotEqual(w['charge_speed'][0][prev_sector].mean, 0.0)
+        self.assertNotEqual(w['charge_speed'][0][prev_sector].count, 0)
 
 
     ########################################
@@ -486,18 +522,22 @@ class TestKBattLead(unittest.TestCase):
 
         pd = kb._pdata
         pd['health']['cycles'] = [150, 100, 50]  # 1-150/6000-100/3000-50/500 == 0.84
+        kb._health_dirty = True  # changed behind its back
         bdh = kb.get_battery_health()
         self.assertIn('OK', bdh['status'])
 
         pd['health']['cycles'] = [250, 200, 80]  # 1-250/6000-200/3000-80/500 == 0.73
+        kb._health_dirty = True
         bdh = kb.get_battery_health()
         self.assertIn('Aged', bdh['status'])
 
         pd['health']['cycles'] = [500, 500, 150]  # 1-500/6000-500/3000-150/500 == 0.45
+        kb._health_dirty = True
         bdh = kb.get_battery_health()
         self.assertIn('Fail', bdh['status'])
 
         pd['health']['cycles'] = [800, 800, 250]  # 1-800/6000-800/3000-250/500 == 0.1
+        kb._health_dirty = True
         bdh = kb.get_battery_health()
         self.assertIn('Trash', bdh['status'])
 
@@ -508,11 +548,12 @@ class TestKBattLead(unittest.TestCase):
         pd['health']['cycles'] = [300, 200, 10]  # 1-300/6000-200/3000-10/500 == 0.86
         for week in range(2):
             # set 0% and 100% slot to a very low value that should be ignored
-            kb._pdata['weekly']['discharge_speed_avg'][week][0] = 1
-            kb._pdata['weekly']['discharge_speed_avg'][week][kpu.CHARGE_STEPS - 1] = 1
+            kb._pdata['weekly']['discharge_speed'][week][0].mean = 1
+            kb._pdata['weekly']['discharge_speed'][week][kpu.CHARGE_STEPS - 1].mean = 1
             for cs in range(1, kpu.CHARGE_STEPS - 1, 2 * (kpu.CHARGE_STEPS - 2) // 10):  # fill at least 10 slots
-                kb._pdata['weekly']['discharge_speed_avg'][week][cs] = kb._ideal_sector_speed
+                kb._pdata['weekly']['discharge_speed'][week][cs].mean = kb._ideal_sector_speed
 
+        kb._health_dirty = True
         bdh = kb.get_battery_health()
         self.assertIn('OK', bdh['status'])
 
@@ -520,20 +561,111 @@ class TestKBattLead(unittest.TestCase):
         isp = kb._ideal_sector_speed // 100
         for week in range(2):
             for cs in range(1, kpu.CHARGE_STEPS - 1, 2 * (kpu.CHARGE_STEPS - 2) // 10):  # fill at least 10 slots
-                kb._pdata['weekly']['discharge_speed_avg'][week][cs] = isp * 75
+                kb._pdata['weekly']['discharge_speed'][week][cs].mean = isp * 75
 
+        kb._health_dirty = True
         bdh = kb.get_battery_health()
         self.assertIn('Aged', bdh['status'])
 
         # setting speeds to 38%
         for week in range(2):
             for cs in range(1, kpu.CHARGE_STEPS - 1, 2 * (kpu.CHARGE_STEPS - 2) // 10):  # fill at least 10 slots
-                kb._pdata['weekly']['discharge_speed_avg'][week][cs] = isp * 38
+                kb._pdata['weekly']['discharge_speed'][week][cs].mean = isp * 38
 
+        kb._health_dirty = True
         bdh = kb.get_battery_health()
         self.assertIn('Fail', bdh['status'])
 
 
+    ########################################
+    def test_battery_health_cached(self):
+        """get_battery_health() is recalculated only after the stats change"""
+        comm = kpu.KPowerDeviceCommons(self.tpl_dev_id)
+        comm.power_factor = 0.8
+        comm.sample_interval = 30
+
+        conf_init = copy.deepcopy(self.tpl_config)
+        conf_init['battery.' + self.tpl_batt_id] = self.tpl_config_battery
+        conf = ConfigParser()
+        conf.read_dict(conf_init)
+
+        kb = KBattLead(self.tpl_batt_id, comm, conf, None)
+        bdh = kb.get_battery_health()
+        self.assertIs(bdh, kb.get_battery_health())
+        with self.assertRaises(TypeError):
+            bdh['status'] = 'Hacked'
+        self.assertEqual((0, 0, 0), bdh['cycles'])
+
+        kb._pdata['health']['cycles'][2] = 400  # not seen until something marks the data as changed
+        self.assertIs(bdh, kb.get_battery_health())
+
+        kb._weekly_avg_add('discharge_speed', 1000.0, 3)
+        bdh2 = kb.get_battery_health()
+        self.assertIsNot(bdh, bdh2)
+        self.assertEqual((0, 0, 400), bdh2['cycles'])
+        self.assertIn('Trash', bdh2['status'])
+        self.assertIn('OK', bdh['status'])  # the old snapshot is not affected
+
+
+    ########################################
+    def test_time_before_failure(self):
+        """tbf is projected from the weekly wellness trend"""
+        kb = self._make_class()
+        self.assertEqual(-1, kb.get_battery_health()['tbf'])  # no history
+
+        now = int(time.time())
+        weeks = 8
+        pd = kb._pdata
+        pd['registered'][0] = now - weeks * kpu.SECONDS_IN_A_WEEK
+        w = pd['weekly']
+        w['start_ts'] = [now - i * kpu.SECONDS_IN_A_WEEK for i in range(weeks)]
+        w['charge_speed'] = [[kpu.KAccumulator() for _ in range(kpu.CHARGE_STEPS)] for _ in range(weeks)]
+        w['discharge_speed'] = []
+        for i in range(weeks):  # losing 4% a week, 0.6 now
+            week = [kpu.KAccumulator() for _ in range(kpu.CHARGE_STEPS)]
+            for cs in range(1, kpu.CHARGE_STEPS):
+                week[cs].add(kb._ideal_sector_speed * (0.6 + 0.04 * i))
+            w['discharge_speed'].append(week)
+
+        kb._health_dirty = True
+        bdh = kb.get_battery_health()
+        self.assertIn('Aged', bdh['status'])
+        self.assertAlmostEqual(-0.04, kb._wellness_trend.slope, 6)
+        self.assertEqual(weeks - 1, len(kb._wellness_trend))
+        self.assertIn(bdh['tbf'], [2, 3])  # 0.6 -> 0.5 in 2.5 weeks
+        self.assertIs(bdh, kb.get_battery_health())
+
+        # nothing has changed in the stats, but the time goes and the failure comes closer
+        clock = kb.commons.clock
+        sample_ts = clock.now
+        clock.tick(sample_ts + kpu.SECONDS_IN_A_WEEK)
+        self.assertEqual(bdh['tbf'] - 1, kb.get_battery_health()['tbf'])
+        self.assertEqual(bdh['tbf'] - 1, kb._pdata['health']['tbf'])
+        clock.tick(sample_ts + 4 * kpu.SECONDS_IN_A_WEEK)
+        self.assertEqual(0, kb.get_battery_health()['tbf'])
+        self.assertEqual(bdh['wellness'], kb.get_battery_health()['wellness'])
+        clock.tick(sample_ts)
+
+        # a week later the current one is completed. It is added to the trend without re-reading the rest
+        kb._wellness_trend.add(-100.0, 1.0)  # marker that will be lost on the full rebuild
+        w['start_ts'][0] -= kpu.SECONDS_IN_A_WEEK + 1  # pretend the current week is over
+        kb._weekly_shift()
+
+        kb.get_battery_health()
+        self.assertEqual(w['start_ts'][1], kb._trend_last_week)
+        self.assertEqual(weeks + 1, len(kb._wellness_trend))  # + marker
+        self.assertIn((-100.0, 1.0), kb._wellness_trend._points)
+        self.assertAlmostEqual(0.6, kb._wellness_trend._points[-1][1], 6)
+
+        # improving battery is not going to fail
+        for i, week in enumerate(w['discharge_speed']):
+            for cs in range(1, kpu.CHARGE_STEPS):
+                week[cs].mean = kb._ideal_sector_speed * (0.9 - 0.01 * i)
+        kb._trend_last_week = -1
+        kb._health_dirty = True
+        self.assertEqual(-1, kb.get_battery_health()['tbf'])
+
+
 ########################################
 if __name__ == '_main_':
     unittest.main()
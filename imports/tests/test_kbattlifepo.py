@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""Unit tests for kbattlifepo.py"""
+import copy
+import json
+import time
+import unittest
+from configparser import ConfigParser
+from typing import Any
+import imports.kpowerutils as kpu
+from imports.kbattlifepo import KBattLiFePO
+
+
+################################################
+def make_commons(dev_id: str) -> kpu.KPowerDeviceCommons:
+    comm = kpu.KPowerDeviceCommons(dev_id)
+    comm.charging_current = 10
+    comm.last_load = 1
+    comm.on_battery = False
+    comm.power_factor = 0.8
+    comm.sample_interval = 36
+    comm.clock = kpu.KSimClock(time.time())
+    return comm
+
+
+########################################
+class TestKBattLiFePO(unittest.TestCase):
+    """Test the KBattLiFePO class. Base class KBattStats tests are in the separate module."""
+
+    def setUp(self):
+        self.tpl_dev_id: str = 'lfp'
+        self.tpl_config: dict[str, Any] = {  # template .ini
+            'DEFAULT': {
+                'sample_interval': '36',
+            },
+            'power.' + self.tpl_dev_id: {
+                'calc_charge_data': 'yes',
+                'charging_current': '10',
+                'power_factor': '0.8',
+            },
+        }
+
+        # 12v * 100Ah * 0.8 = 960Wh. 960W load drains 1% in 36 seconds
+        self.tpl_batt_id = 'bat1'
+        self.tpl_config_battery: dict[str, str] = {
+            'type': 'lifepo', 'vnom': '12', 'capacity_ah': '100',
+        }
+
+
+    ########################################
+    def _make_class(self, saved_stats: dict | None = None) -> KBattLiFePO:
+        """A helper to get all things pre-initialized for the majority of tests"""
+        conf_init = copy.deepcopy(self.tpl_config)
+        conf_init['battery.' + self.tpl_batt_id] = self.tpl_config_battery
+        conf = ConfigParser()
+        conf.read_dict(conf_init)
+        return KBattLiFePO(self.tpl_batt_id, make_commons(self.tpl_dev_id), conf, saved_stats)
+
+
+    ########################################
+    @staticmethod
+    def _feed(kb: KBattLiFePO, v: float, load: int = 960, on_battery: bool = True, dt: float = 36.0,
+              count: int = 1) -> None:
+        """Processes count samples, each one dt seconds after the previous"""
+        kb.commons.last_load = load
+        kb.commons.on_battery = on_battery
+        if kb._last_ts == 0.0:  # as if there was a previous sample
+            kb._last_ts = kb.commons.clock.now
+        for _ in range(count):
+            kb.commons.clock.advance(dt)
+            kb.process_upsc_data({'battery_voltage': str(v), 'ups_load': str(load)})
+
+
+    ########################################
+    def test_init(self):
+        """Default setup and bad voltage levels"""
+        kb = self._make_class()
+        self.assertFalse( kb.invalid, kb.messages )
+        self.assertEqual( 1, kb._pack_size )
+        self.assertEqual( 960, kb.capacity_wh )
+        self.assertEqual( 120, kb.charging_speed_wh )
+
+        self.tpl_config_battery['v_full'] = '11.0'
+        kb = self._make_class()
+        self.assertTrue( kb.invalid )
+        self.assertIn( 'v_cutoff', kb.messages[0] )
+
+        self.tpl_config_battery['v_full'] = 'oops'
+        kb = self._make_class()
+        self.assertTrue( kb.invalid )
+
+
+    ########################################
+    def test_coulomb_counting(self):
+        """Charge follows the energy drained over the real time passed, not the voltage"""
+        kb = self._make_class()
+        self._feed(kb, 13.2, count=10)
+        self.assertAlmostEqual( 90.0, kb.charge, 1 )
+        self.assertFalse( kb.is_steady() )
+
+        self._feed(kb, 13.2, dt=1000.0)  # long gap - daemon was not running. Not counted
+        self.assertAlmostEqual( 90.0, kb.charge, 1 )
+
+        self._feed(kb, 13.2, load=480, count=10)  # half the load - half the speed
+        self.assertAlmostEqual( 85.0, kb.charge, 1 )
+
+        # charging with 120W * 0.95 for an hour
+        self._feed(kb, 13.3, on_battery=False, dt=120.0, count=30)
+        self.assertAlmostEqual( 85.0 + 114.0 / 9.6, kb.charge, 0 )
+
+        # same with the device's own report
+        self.tpl_config_battery['calc_charge_data'] = 'no'
+        kb = self._make_class()
+        kb.commons.on_battery = True
+        kb.process_upsc_data({'battery_voltage': '13.2', 'battery_charge': '42.42', 'ups_load': '960'})
+        self.assertEqual( 42.4, kb.charge )
+        self.assertTrue( kb.is_steady() )
+
+
+    ########################################
+    def test_anchors_and_learning(self):
+        """Counter is reset at full and empty voltages. A clean full to empty run measures usable energy"""
+        kb = self._make_class()
+        self._feed(kb, 13.2, count=10)
+        self._feed(kb, 13.7, on_battery=False, dt=1.0)  # full
+        self.assertEqual( 100.0, kb.charge )
+        self.assertTrue( kb.is_steady() )
+
+        self._feed(kb, 13.1, count=50)
+        self.assertAlmostEqual( 50.0, kb.charge, 1 )
+        self._feed(kb, 11.5)  # empty already: the battery is smaller than we thought
+        self.assertEqual( 0.0, kb.charge )
+        self.assertAlmostEqual( 489.6, kb._usable_wh, 1 )
+
+        self._feed(kb, 13.7, on_battery=False, dt=1.0)
+        self.assertEqual( 100.0, kb.charge )
+        self._feed(kb, 13.1, count=24)  # 9.6Wh per sample on the smaller scale
+        self.assertAlmostEqual( 100.0 * (489.6 - 24 * 9.6) / 489.6, kb.charge, 1 )
+
+        # run interrupted by charging is not a measurement
+        self._feed(kb, 13.3, on_battery=False)
+        self._feed(kb, 11.5, count=2)
+        self.assertEqual( 0.0, kb.charge )
+        self.assertAlmostEqual( 489.6, kb._usable_wh, 1 )
+
+
+    ########################################
+    def test_usable_energy_saved(self):
+        """Learned usable energy survives the restart, so the counter does not go back to the nominal capacity"""
+        kb = self._make_class()
+        self.assertEqual( 0.0, kb.get_permastats()[self.tpl_batt_id]['usable_wh'] )
+        self._feed(kb, 13.7, on_battery=False, dt=1.0)
+        self._feed(kb, 13.1, count=50)
+        self._feed(kb, 11.5)
+        self.assertAlmostEqual( 489.6, kb._usable_wh, 1 )
+
+        def saved() -> dict:
+            pd = json.loads(json.dumps(kb.get_permastats(), default=lambda o: o.to_json()))
+            pd[self.tpl_batt_id]['registered'][0] -= 60  # as if it was saved a while ago
+            return pd
+
+        kb2 = self._make_class(saved())
+        self.assertFalse( kb2.invalid, kb2.messages )
+        self.assertAlmostEqual( 489.6, kb2._usable_wh, 1 )
+        self.assertAlmostEqual( 489.6, kb2._energy_wh, 1 )  # starts full on the learned scale
+
+        # loaded later: saved value is used, unless there is a fresher one
+        kb3 = self._make_class()
+        kb3.merge_saved_stats(saved())
+        self.assertAlmostEqual( 489.6, kb3._usable_wh, 1 )
+
+        kb3 = self._make_class()
+        kb3._usable_wh = kb3._pdata['usable_wh'] = 700.0
+        kb3.merge_saved_stats(saved())
+        self.assertEqual( 700.0, kb3._usable_wh )
+        self.assertEqual( 700.0, kb3.get_permastats()[self.tpl_batt_id]['usable_wh'] )
+
+
+    ########################################
+    def test_sector_stats(self):
+        """Sector speeds are collected the same way as for lead-acid"""
+        kb = self._make_class()
+        self._feed(kb, 13.7, on_battery=False, dt=1.0)
+        self._feed(kb, 13.1, count=40)
+
+        speeds = kb._pdata['weekly']['discharge_speed'][0]
+        filled = [cs for cs in range(kpu.CHARGE_STEPS) if speeds[cs].count > 0]
+        self.assertGreaterEqual( len(filled), 6 )
+        for cs in filled:
+            self.assertAlmostEqual( kb._ideal_sector_speed, speeds[cs].mean, delta=kb._ideal_sector_speed * 0.25 )
+
+        self._feed(kb, 13.3, on_battery=False)  # back on mains: discharge cycle is counted
+        self.assertEqual( 1, sum(kb.get_battery_health()['cycles']) )
+
+
+########################################
+if __name__ == '__main__':
+    unittest.main()
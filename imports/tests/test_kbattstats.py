@@ -97,10 +97,8 @@ class TestKBattStats(unittest.TestCase):
                 'wellness': 100,
             },
             'weekly': {
-                'charge_speed_avg': [],
-                'charge_speed_samples': [],
-                'discharge_speed_avg': [],
-                'discharge_speed_samples': [],
+                'charge_speed': [],
+                'discharge_speed': [],
                 'start_ts': [],
             }
         }
@@ -119,14 +117,10 @@ class TestKBattStats(unittest.TestCase):
             self.assertEqual( len(w[key]), weeks_count )
 
         for name in ['discharge_speed', 'charge_speed']:
-            key = name + '_avg'
-            self.assertIsInstance( w[key][0], list )
-            self.assertEqual( kpu.CHARGE_STEPS, len(w[key][0]) )
-            self.assertIsInstance( w[key][0][0], float )  # weekly->key->week->sector
-            key = name + '_samples'
-            self.assertIsInstance( w[key][0], list )
-            self.assertEqual( kpu.CHARGE_STEPS, len(w[key][0]) )
-            self.assertIsInstance( w[key][0][0], int )
+            self.assertIsInstance( w[name][0], list )
+            self.assertEqual( kpu.CHARGE_STEPS, len(w[name][0]) )
+            self.assertIsInstance( w[name][0][0].mean, float )  # weekly->key->week->sector
+            self.assertIsInstance( w[name][0][0].count, float )
 
         # Check the timestamp that was inserted
         self.assertIsInstance( w['start_ts'][0], int )
@@ -190,10 +184,8 @@ class TestKBattStats(unittest.TestCase):
                 },
                 'weekly': {
                     'start_ts': [123],
-                    'discharge_speed_avg': [[0.5] * kpu.CHARGE_STEPS],
-                    'discharge_speed_samples': [[1] * kpu.CHARGE_STEPS],
-                    'charge_speed_avg': [[1.0] * kpu.CHARGE_STEPS],
-                    'charge_speed_samples': [[1] * kpu.CHARGE_STEPS],
+                    'discharge_speed': [[[0.5, 0.0, 1]] * kpu.CHARGE_STEPS],
+                    'charge_speed': [[[1.0, 0.0, 1]] * kpu.CHARGE_STEPS],
                 },
             },
         }
@@ -239,10 +231,8 @@ class TestKBattStats(unittest.TestCase):
                 },
                 'weekly': {
                     'start_ts': [123],
-                    'discharge_speed_avg': [[0.5] * kpu.CHARGE_STEPS],
-                    'discharge_speed_samples': [[1] * kpu.CHARGE_STEPS],
-                    'charge_speed_avg': [[1.0] * kpu.CHARGE_STEPS],
-                    'charge_speed_samples': [[1] * kpu.CHARGE_STEPS],
+                    'discharge_speed': [[[0.5, 0.0, 1]] * kpu.CHARGE_STEPS],
+                    'charge_speed': [[[1.0, 0.0, 1]] * kpu.CHARGE_STEPS],
                 },
             },
         }
@@ -289,7 +279,7 @@ class TestKBattStats(unittest.TestCase):
 
         # 3.1 weekly series length - extra element
         saved = copy.deepcopy(saved_tpl)
-        saved[self.tpl_batt_id]['weekly']['discharge_speed_avg'].append(123)
+        saved[self.tpl_batt_id]['weekly']['discharge_speed'].append(123)
         kb = KBattStats( self.tpl_batt_id, comm, conf, saved )
 
         self.assertFalse( kb.invalid )
@@ -376,19 +366,116 @@ class TestKBattStats(unittest.TestCase):
         sector = 5
         # Start with known average and samples
         w = kb._pdata['weekly']
-        w['discharge_speed_avg'][0][sector] = 0.0
-        w['discharge_speed_samples'][0][sector] = 0
+        self.assertEqual(0.0, w['discharge_speed'][0][sector].count)
 
         # Add a single value
         kb._weekly_avg_add('discharge_speed', 10.0, sector)
-        self.assertEqual(w['discharge_speed_samples'][0][sector], 1)
-        self.assertAlmostEqual(w['discharge_speed_avg'][0][sector], 10.0)
+        self.assertEqual(w['discharge_speed'][0][sector].count, 1)
+        self.assertAlmostEqual(w['discharge_speed'][0][sector].mean, 10.0)
 
         # Add a second value
         kb._weekly_avg_add('discharge_speed', 20.0, sector)
-        self.assertEqual(w['discharge_speed_samples'][0][sector], 2)
+        self.assertEqual(w['discharge_speed'][0][sector].count, 2)
         # Average should now be 15.0
-        self.assertAlmostEqual(w['discharge_speed_avg'][0][sector], 15.0)
+        self.assertAlmostEqual(w['discharge_speed'][0][sector].mean, 15.0)
+        self.assertAlmostEqual(w['discharge_speed'][0][sector].variance, 25.0)
+
+
+    ################################################
+    def test_energy_table(self):
+        """Sector energy table is learned from discharge speeds, favoring recent weeks, and rebuilt on changes only"""
+        conf_init = copy.deepcopy( self.tpl_config )
+        conf_init['battery.' + self.tpl_batt_id] = copy.deepcopy( self.tpl_config_battery )
+
+        conf = ConfigParser()
+        conf.read_dict( conf_init )
+        comm = make_commons( self.tpl_dev_id )
+
+        kb = KBattStats( self.tpl_batt_id, comm, conf, None )
+        share = kb.capacity_wh / (kpu.CHARGE_STEPS - 1)
+
+        # no data: linear
+        self.assertEqual( kb.capacity_wh, kb.get_remaining_wh() )
+        kb.charge = 50.0
+        self.assertAlmostEqual( kb.capacity_wh / 2, kb.get_energy_at(50.0), 6 )
+        self.assertAlmostEqual( kb.capacity_wh * 0.4, kb.get_energy_to(10.0), 6 )
+        self.assertAlmostEqual( -kb.capacity_wh * 0.3, kb.get_energy_to(80.0), 6 )
+        self.assertEqual( int(kb.capacity_wh * 0.4 * 3600 / 500), kb.get_seconds_to(10.0, 500) )
+        self.assertEqual( -1, kb.get_seconds_to(10.0, 0) )
+        table = kb._energy_table()
+        self.assertIs( table, kb._energy_table() )  # cached
+
+        # low sectors give less energy, like at the end of discharge under a heavy load
+        for cs in range(4):
+            kb._weekly_avg_add('discharge_speed', share * 3600 / 2, cs)
+        self.assertIsNot( table, kb._energy_table() )
+        self.assertAlmostEqual( share * 2, kb.get_energy_at(20.0), 6 )
+        self.assertAlmostEqual( share * 1.25, kb.get_energy_at(12.5), 6 )  # half of the 3rd sector
+        kb.charge = 100.0
+        self.assertAlmostEqual( kb.capacity_wh - share * 4, kb.get_energy_to(20.0), 6 )
+        self.assertEqual( round(kb.capacity_wh - share * 2), kb.get_remaining_wh() )
+
+        # older week has the same weight as a recent one only if it has 2^(age/half-life) more samples
+        w = kb._pdata['weekly']
+        w['start_ts'][0] -= kpu.SECONDS_IN_A_WEEK + 1
+        kb._weekly_shift()
+        kb._weekly_avg_add('discharge_speed', share * 3600 * 2, 0)
+        self.assertAlmostEqual( share * (0.5 + (2 + 0.5 * 0.5 ** 0.25) / (1 + 0.5 ** 0.25)), kb.get_energy_at(10.0), 6 )
+
+        # capacity change affects sectors without data
+        kb.capacity_wh //= 2
+        self.assertAlmostEqual( kb.get_energy_at(20.0) + kb.capacity_wh / (kpu.CHARGE_STEPS - 1) * 16,
+                                kb.get_energy_at(100.0), 6 )
+
+
+    ################################################
+    def test_merge_saved_stats(self):
+        """Saved stats loaded later become the base and fresh week 0 data is added on top"""
+        t = int(time.time())
+        conf_init = copy.deepcopy( self.tpl_config )
+        conf_init['battery.' + self.tpl_batt_id] = copy.deepcopy( self.tpl_config_battery )
+
+        conf = ConfigParser()
+        conf.read_dict( conf_init )
+        comm = make_commons( self.tpl_dev_id )
+
+        kb = KBattStats( self.tpl_batt_id, comm, conf, None )
+        kb._pdata['health']['cycles'][0] = 2
+        kb._weekly_avg_add('discharge_speed', 3.0, 1)
+
+        saved = {
+            self.tpl_batt_id: {
+                'type': str(kpu.bt_from_str( self.tpl_config_battery['type'] )),
+                'vnom': int(self.tpl_config_battery['vnom']),
+                'capacity_ah': int(self.tpl_config_battery['capacity_ah']),
+                'messages': [],
+                'registered': [t - kpu.SECONDS_IN_A_WEEK, 'Once upon a time'],
+                'health': {
+                    'cycles': [5, 1, 0],
+                    'status': "OK",
+                    'tbf': -1,
+                    'wellness': 100,
+                },
+                'weekly': {
+                    'start_ts': [t - 60],  # same week
+                    'discharge_speed': [[[1.0, 0.0, 3]] * kpu.CHARGE_STEPS],
+                    'charge_speed': [[[1.0, 0.0, 1]] * kpu.CHARGE_STEPS],
+                },
+            },
+        }
+
+        kb.merge_saved_stats( saved )
+        self.assertFalse( kb.invalid, kb.messages )
+        self.assertNotIn( self.tpl_batt_id, saved )
+        self._validate_pdata_structure( kb, 1 )
+        self.assertEqual( [7, 1, 0], kb._pdata['health']['cycles'] )
+
+        w = kb._pdata['weekly']
+        self.assertEqual( 4, w['discharge_speed'][0][1].count )
+        self.assertAlmostEqual( 1.5, w['discharge_speed'][0][1].mean )  # (3 * 1.0 + 3.0) / 4
+        self.assertAlmostEqual( 0.75, w['discharge_speed'][0][1].variance )  # 2.0 ** 2 * 3 * 1 / 4 / 4
+        self.assertEqual( 3, w['discharge_speed'][0][0].count )
+        self.assertAlmostEqual( 1.0, w['discharge_speed'][0][0].mean )
 
 
 if __name__ == '__main__':
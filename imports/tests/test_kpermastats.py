@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""Unit tests for kpermastats.py"""
+import unittest
+import imports.kpermastats as kperma
+
+
+class TestKPermaStats(unittest.TestCase):
+    """Test the stats schema migrations."""
+
+    ################################################
+    def test_current_version_untouched(self):
+        """Data of the current version is not changed"""
+        stats = {'schema_version': kperma.SCHEMA_VERSION, 'dev_id': 'x'}
+        self.assertEqual( (kperma.SCHEMA_VERSION, []), kperma.migrate(stats) )
+        self.assertEqual( {'schema_version': kperma.SCHEMA_VERSION, 'dev_id': 'x'}, stats )
+
+
+    ################################################
+    def test_impossible_migrations(self):
+        """Invalid or unknown versions are reported as failures"""
+        for ver in ['1', -5, kperma.SCHEMA_VERSION + 1]:
+            from_ver, m = kperma.migrate({'schema_version': ver}, 'test')
+            self.assertEqual( -1, from_ver )
+            self.assertEqual( 1, len(m) )
+            self.assertTrue( m[0].startswith('WARNING: test ') )
+
+
+    ################################################
+    def test_migrate_from_0(self):
+        """Pre-versioning data gets the renamed battery items and the missing defaults"""
+        stats = {
+            'ts': 100,
+            'hourly_load_avg': [10] * 24,
+            'hourly_load_samples': [2] * 24,
+            'batteries': {
+                'b1': {
+                    'batt_type': 'bt_lead', 'batt_vnom': 24, 'batt_cap': 9,
+                    'weekly': {
+                        'start_ts': [100, 50],
+                        'discharge_speed_avg': [[0.5] * 3, [0.25] * 3],
+                        'discharge_speed_samples': [[1] * 3, [4] * 3],
+                        'charge_speed_avg': [[1.0] * 3, [1.0] * 3],
+                        'charge_speed_samples': [[1] * 3, [1] * 3],
+                    },
+                },
+            },
+        }
+
+        from_ver, m = kperma.migrate(stats)
+        self.assertEqual( 0, from_ver )
+        self.assertEqual( [], m )
+        self.assertEqual( kperma.SCHEMA_VERSION, stats['schema_version'] )
+        self.assertEqual( 100, stats['started'] )
+        self.assertEqual( {}, stats['ups'] )
+
+        b1 = stats['batteries']['b1']
+        self.assertEqual( ('bt_lead', 24, 9), (b1['type'], b1['vnom'], b1['capacity_ah']) )
+        self.assertNotIn( 'batt_type', b1 )
+        self.assertIn( 'health', b1 )
+
+        # v1 -> v2: accumulators
+        self.assertNotIn( 'hourly_load_avg', stats )
+        self.assertEqual( [[10.0, 0.0, 2.0]] * 24, stats['hourly_load'] )
+        self.assertEqual( ['charge_speed', 'discharge_speed', 'start_ts'], sorted(b1['weekly'].keys()) )
+        self.assertEqual( [[0.25, 0.0, 4.0]] * 3, b1['weekly']['discharge_speed'][1] )
+
+        # v2 -> v3: LiFePO4 usable energy
+        self.assertNotIn( 'usable_wh', b1 )
+        stats = {'schema_version': 2, 'batteries': {'b1': {'type': 'Bt_Lead'}, 'b2': {'type': 'Bt_Lifepo'},
+                                                    'b3': {'type': 'Bt_Lifepo', 'usable_wh': 42.0}}}
+        self.assertEqual( (2, []), kperma.migrate(stats) )
+        self.assertEqual( {'b1': {'type': 'Bt_Lead'}, 'b2': {'type': 'Bt_Lifepo', 'usable_wh': 0.0},
+                           'b3': {'type': 'Bt_Lifepo', 'usable_wh': 42.0}}, stats['batteries'] )
+
+        from_ver, m = kperma.migrate({'batteries': []})
+        self.assertEqual( -1, from_ver )
+        self.assertTrue( m[0].startswith('ERROR') )
+
+
+########################################
+if __name__ == '__main__':
+    unittest.main()
@@ -8,6 +8,7 @@ import tempfile
 import time
 import unittest
 from configparser import ConfigParser
+import imports.kpermastats as kperma
 import imports.kpowerutils as kpu
 from imports.kpowerdevice import KPowerDevice
 
@@ -174,22 +175,79 @@ class TestKPowerDevice(unittest.TestCase):
         conf_dict = copy.deepcopy(self.tpl_config)
         conf.read_dict(conf_dict)
 
-        dev = KPowerDevice('lead', conf )
+        clock = kpu.KSimClock(time.mktime((2026, 3, 2, 10, 59, 59, 0, 0, -1)))
+        dev = KPowerDevice('lead', conf, clock=clock)
         pd = dev._pdata
-        t = time.localtime()
-        if t.tm_min == 59 and t.tm_sec == 59:  # wait a bit so we won't get cpu hogged and miss the right number
-            time.sleep(2)
-
-        hour = time.localtime().tm_hour
+        hour = 10
         load = 123
         dev._update_hourly_load( load )
-        self.assertEqual( 123, pd['hourly_load_avg'][hour] )  # initials are zero
-        self.assertEqual( 1, pd['hourly_load_samples'][hour] )
+        self.assertEqual( 123, pd['hourly_load'][hour].mean )  # initials are zero
+        self.assertEqual( 1, pd['hourly_load'][hour].count )
 
         load = 64
         dev._update_hourly_load(load)
-        self.assertEqual( 93, pd['hourly_load_avg'][hour] )  # 123 + 64 / 2
-        self.assertEqual( 2, pd['hourly_load_samples'][hour] )
+        # 123 + 64 / 2 with a slight fading of the 1st sample
+        self.assertAlmostEqual( 93.5, pd['hourly_load'][hour].mean, 2 )
+        self.assertAlmostEqual( 2, pd['hourly_load'][hour].count, 2 )
+        self.assertAlmostEqual( 29.5 ** 2, pd['hourly_load'][hour].variance, 0 )
+
+
+    ########################################
+    def test_battery_runtime_prediction(self):
+        """Test of get_battery_runtime() with a steady load and no hourly profile beyond the current hour"""
+        conf = ConfigParser()
+        conf.read_dict(copy.deepcopy(self.tpl_config))
+        dev = KPowerDevice('lead', conf)
+
+        rt = dev.get_battery_runtime()  # no load at all yet
+        self.assertEqual(7, len(rt))
+        self.assertEqual(12 * 3600, rt[3])
+        self.assertEqual(0, rt[4])  # already full
+
+        for _ in range(10):
+            dev.process_upsc_data({'ups_load': '100', 'ups_status': 'OL'})  # 1600W
+
+        self.assertEqual(1600.0, dev.load_ewma)
+        self.assertEqual(0.0, dev.load_ewvar)
+
+        rem_wh, s80, s50, s10, s100, s10_lo, s10_hi = dev.get_battery_runtime()
+        cap = dev.batteries.get_remaining_power()[2]
+        self.assertEqual(cap, rem_wh)
+        self.assertAlmostEqual(cap * 0.2 * 3600 / 1600, s80, delta=1)
+        self.assertAlmostEqual(cap * 0.5 * 3600 / 1600, s50, delta=1)
+        self.assertAlmostEqual(cap * 0.9 * 3600 / 1600, s10, delta=1)
+        self.assertEqual(s10, s10_lo)  # no variance - no band
+        self.assertEqual(s10, s10_hi)
+
+        # below the level: negative seconds to recharge the missing energy
+        bat = dev.batteries[self.tpl_batt_id]
+        bat.charge = 40.0
+        dev.batteries._invalidate()
+        chrg_spd_wh = dev.batteries.get_remaining_power()[3]
+        self.assertGreater(chrg_spd_wh, 0)
+        rt = dev.get_battery_runtime()
+        self.assertEqual(int(dev.batteries.get_energy_to(80) * 3600 // chrg_spd_wh), rt[1])
+        self.assertEqual(int(dev.batteries.get_energy_to(100) * 3600 // chrg_spd_wh), rt[4])
+        self.assertLess(rt[4], rt[1])
+        self.assertLess(rt[1], rt[2])
+        self.assertLess(rt[2], 0)
+        self.assertGreater(rt[3], 0)
+
+        bat.charging_speed_wh = 0  # not charging: the level is not reached in time, instead of a crash
+        dev.batteries._invalidate()
+        rt = dev.get_battery_runtime()
+        self.assertEqual((-12 * 3600, -12 * 3600, -12 * 3600), (rt[1], rt[2], rt[4]))
+        bat.charge = 100.0
+        dev.batteries._invalidate()
+
+        # now make some noise
+        for load in ['50', '150', '50', '150']:
+            dev.process_upsc_data({'ups_load': load, 'ups_status': 'OL'})
+
+        rt = dev.get_battery_runtime()
+        self.assertGreater(dev.load_ewvar, 0.0)
+        self.assertLess(rt[5], rt[3])
+        self.assertGreater(rt[6], rt[3])
 
 
     ################################################
@@ -220,18 +278,19 @@ class TestKPowerDevice(unittest.TestCase):
         if 'batteries' in expect_keys:
             expect_keys.remove('batteries')
 
-        for key in ['dev_id', 'hourly_load_avg', 'hourly_load_samples',
-                    'messages', 'started', 'ts', 'weekly', 'ups']:
+        for key in ['dev_id', 'hourly_load', 'messages', 'schema_version', 'started', 'ts', 'weekly', 'ups']:
             self.assertIn( key, pd )
             expect_keys.remove( key )
 
         self.assertEqual( 0, len(expect_keys), 'Extra pdata keys: ' + ', '.join(expect_keys) )
 
-        for key in ['hourly_load_avg', 'hourly_load_samples']:
-            self.assertIsInstance( pd[key], list )
-            self.assertEqual( 24, len(pd[key]) )
-            self.assertIsInstance( pd[key][0], int )
-            self.assertEqual( 0, pd[key][0] )
+        self.assertIsInstance( pd['hourly_load'], list )
+        self.assertEqual( 24, len(pd['hourly_load']) )
+        for acc in pd['hourly_load']:  # both saved and live forms are OK
+            if isinstance(acc, list):
+                self.assertEqual( [0.0, 0.0, 0.0], acc )
+            else:
+                self.assertEqual( 0.0, acc.count )
 
         # The weekly structure must contain all keys
         wdict = pd['weekly']
@@ -305,6 +364,7 @@ class TestKPowerDevice(unittest.TestCase):
         """If a matching file exists it is loaded correctly."""
         # Create a matching file. Here we prepare what it should be like previously saved data
         saved = {
+            'schema_version': kperma.SCHEMA_VERSION,
             'dev_id': self.tpl_dev_id,
             'ts': 1_000_000,
             'started': 1_000_000,
@@ -324,15 +384,12 @@ class TestKPowerDevice(unittest.TestCase):
                     },
                     'weekly': {
                         'start_ts': [123],
-                        'discharge_speed_avg': [[0.5] * kpu.CHARGE_STEPS],
-                        'discharge_speed_samples': [[1] * kpu.CHARGE_STEPS],
-                        'charge_speed_avg': [[1.0] * kpu.CHARGE_STEPS],
-                        'charge_speed_samples': [[1] * kpu.CHARGE_STEPS],
+                        'discharge_speed': [[[0.5, 0.0, 1]] * kpu.CHARGE_STEPS],
+                        'charge_speed': [[[1.0, 0.0, 1]] * kpu.CHARGE_STEPS],
                     },
                 }
             },
-            'hourly_load_avg': [0] * 24,
-            'hourly_load_samples': [0] * 24,
+            'hourly_load': [[0.0, 0.0, 0.0]] * 24,
             'weekly': {
                 'start_ts': [123],
                 'blackouts_count': [5],
@@ -359,6 +416,72 @@ class TestKPowerDevice(unittest.TestCase):
         self._validate_pdata_structure( kpd._pdata, 2 )
 
 
+    ################################################
+    def test_init_with_legacy_file_migrates(self):
+        """A file made before schema versioning is converted, loaded and rewritten once in the new format"""
+        t = int(time.time())
+        legacy = {
+            'dev_id': self.tpl_dev_id,
+            'ts': t - 3600,
+            'hourly_load_avg': [0] * 24,
+            'hourly_load_samples': [0] * 24,
+            'batteries': {
+                self.tpl_batt_id: {
+                    'registered': [t - 3600, 'Somewhere in time'],
+                    'batt_type': 'bt_lead',
+                    'batt_vnom': 48,
+                    'batt_cap': 100,
+                    'weekly': {
+                        'start_ts': [t - 60],
+                        'discharge_speed_avg': [[0.5] * kpu.CHARGE_STEPS],
+                        'discharge_speed_samples': [[1] * kpu.CHARGE_STEPS],
+                        'charge_speed_avg': [[1.0] * kpu.CHARGE_STEPS],
+                        'charge_speed_samples': [[1] * kpu.CHARGE_STEPS],
+                    },
+                }
+            },
+            'weekly': {
+                'start_ts': [t - 60],
+                'blackouts_count': [5],
+                'blackouts_time': [2.5],
+            },
+        }
+
+        with open(self.file_name, 'w', encoding='utf-8') as fh:
+            json.dump(legacy, fh)
+
+        conf = ConfigParser()
+        conf.read_dict( self.tpl_config )
+        kpd = KPowerDevice( self.tpl_dev_id, conf )
+
+        self.assertEqual( 0, kpd.init_errors, kpd.collect_messages() )
+        self.assertEqual( 0, kpd.init_warnings, kpd.collect_messages() )
+        self.assertIn( 'migrated', kpd._messages[0] )
+        self.assertEqual( 5, kpd._pdata['weekly']['blackouts_count'][0] )
+        self.assertEqual( t - 3600, kpd._pdata['started'] )
+        self.assertFalse( kpd._stats_migrated )
+
+        # it is rewritten with the original kept as a backup
+        self.assertTrue( os.path.exists(self.file_name + '.bak') )
+        with open(self.file_name, 'r', encoding='utf-8') as fh:
+            fdata = json.load(fh)
+
+        self.assertEqual( kperma.SCHEMA_VERSION, fdata['schema_version'] )
+        self.assertEqual( 100, fdata['batteries'][self.tpl_batt_id]['capacity_ah'] )
+        self.assertNotIn( 'batt_cap', fdata['batteries'][self.tpl_batt_id] )
+        self.assertEqual( 1, len(fdata['batteries'][self.tpl_batt_id]['weekly']['start_ts']) )
+
+        # newer files than we can handle are not touched
+        fdata['schema_version'] = kperma.SCHEMA_VERSION + 1
+        with open(self.file_name, 'w', encoding='utf-8') as fh:
+            json.dump(fdata, fh)
+
+        kpd = KPowerDevice( self.tpl_dev_id, conf )
+        self.assertEqual( 1, kpd.init_warnings, kpd._messages )
+        self.assertIn( 'newer', kpd._messages[0] )
+        self._validate_pdata_structure( kpd._pdata, 1 )
+
+
     ################################################
     def test_init_with_invalid_file_sets_stub(self):
         """If the file has a different dev_id or battery definition, it is discarded."""
@@ -427,6 +550,150 @@ class TestKPowerDevice(unittest.TestCase):
         self.assertEqual( 42, kpd2._pdata['weekly']['blackouts_count'][0] )
 
 
+    ################################################
+    def test_fast_forward(self):
+        """fast_forward(n) gives the same state as n more process_upsc_data() calls with the same sample"""
+        conf = ConfigParser()
+        conf.read_dict(copy.deepcopy(self.tpl_config))
+        t = time.localtime()
+        if t.tm_min == 59 and t.tm_sec >= 55:  # both devices should put samples into the same hour
+            time.sleep(6)
+
+        sample = {'ups_load': '30', 'ups_status': 'OB', 'battery_voltage': '50.4'}
+        devs = [KPowerDevice('lead', conf), KPowerDevice('lead', conf)]
+        for dev in devs:
+            self.assertFalse(dev.fast_forward(5))  # nothing to repeat yet
+            for load in ['10', '20', '10']:
+                dev.process_upsc_data({'ups_load': load, 'ups_status': 'OL', 'battery_voltage': '54.0'})
+            dev.process_upsc_data(sample)
+
+        for _ in range(200):
+            devs[0].process_upsc_data(sample)
+        self.assertTrue(devs[1].fast_forward(200))
+
+        seq, ff = devs
+        self.assertAlmostEqual(seq.load_ewma, ff.load_ewma, 6)
+        self.assertAlmostEqual(seq.load_ewvar, ff.load_ewvar, 6)
+        self.assertEqual(seq.load_samples, ff.load_samples)
+        for k in ['blackouts_count', 'blackouts_time']:
+            self.assertEqual(seq._pdata['weekly'][k], ff._pdata['weekly'][k])
+
+        hour = time.localtime().tm_hour
+        acc_seq, acc_ff = seq._pdata['hourly_load'][hour], ff._pdata['hourly_load'][hour]
+        self.assertAlmostEqual(acc_seq.mean, acc_ff.mean, 6)
+        self.assertAlmostEqual(acc_seq.count, acc_ff.count, 6)
+
+        b_seq, b_ff = seq.batteries._batteries[0], ff.batteries._batteries[0]
+        for attr in ['_charge_sector', '_time_in_charge_sector', '_state_samples']:
+            self.assertEqual(getattr(b_seq, attr), getattr(b_ff, attr), attr)
+        self.assertAlmostEqual(b_seq._load_avg, b_ff._load_avg, 6)
+
+
+    ################################################
+    def test_process_samples(self):
+        """Batch processing ends up in the same state as the samples processed one by one"""
+        conf = ConfigParser()
+        conf.read_dict(copy.deepcopy(self.tpl_config))
+        start = time.mktime((2026, 3, 2, 10, 30, 0, 0, 0, -1))
+
+        # steady hour crossing on mains, a blackout with the voltage going down, then recharging
+        batch: dict[str, list] = {'ts': [], 'ups_load': [], 'ups_status': [], 'battery_voltage': []}
+        for i in range(200):
+            on_battery = 100 <= i < 140
+            batch['ts'].append(start + i * 30)
+            batch['ups_load'].append(30 if on_battery else 20)
+            batch['ups_status'].append('OB' if on_battery else 'OL')
+            batch['battery_voltage'].append(f'{50.4 - (i - 100) // 8 * 0.1:.1f}' if on_battery else '54.0')
+
+        seq, ff, fast_forwarded = self._process_both_ways(conf, start, batch)
+        self.assertGreater(fast_forwarded, 100)
+        self.assertAlmostEqual(60.0, ff._pdata['hourly_load'][10].count, 1)  # 10:30 to 11:00, slightly faded
+
+        with self.assertRaises(ValueError):
+            ff.process_samples({'ts': [1.0, 2.0], 'ups_load': [1]})
+
+        # a steady blackout that straddles the week shift in the middle of an hour:
+        # the run is split, so each week gets its own part of the blackout time
+        week_end = start + kpu.SECONDS_IN_A_WEEK
+        batch = {'ts': [week_end - 600 + i * 30 for i in range(40)], 'ups_load': [30] * 40,
+                 'ups_status': ['OB'] * 40, 'battery_voltage': ['50.4'] * 40}
+        seq, ff, fast_forwarded = self._process_both_ways(conf, start, batch)
+        self.assertGreater(fast_forwarded, 30)
+        self.assertEqual(2, len(ff._pdata['weekly']['start_ts']))
+        self.assertGreaterEqual(ff._pdata['weekly']['start_ts'][0], week_end)
+        self.assertEqual(40 * 30, sum(ff._pdata['weekly']['blackouts_time']))
+        self.assertGreater(min(ff._pdata['weekly']['blackouts_time']), 0)
+
+
+    ################################################
+    def _process_both_ways(self, conf: ConfigParser, start: float, batch: dict[str, list]) \
+            -> tuple[KPowerDevice, KPowerDevice, int]:
+        """Feeds the batch sample by sample and with process_samples(), then checks that the states are the same.
+        :return: tuple(sequential device, batch device, process_samples() result)"""
+        seq = KPowerDevice('lead', conf, clock=kpu.KSimClock(start))
+        for i, ts in enumerate(batch['ts']):
+            seq.process_upsc_data({k: batch[k][i] for k in batch if k != 'ts'}, ts)
+
+        ff = KPowerDevice('lead', conf, clock=kpu.KSimClock(start))
+        fast_forwarded = ff.process_samples(batch)
+
+        self.assertEqual(seq.commons.clock.now, ff.commons.clock.now)
+        self.assertAlmostEqual(seq.load_ewma, ff.load_ewma, 6)
+        self.assertAlmostEqual(seq.load_ewvar, ff.load_ewvar, 6)
+        self.assertEqual(seq.load_samples, ff.load_samples)
+        for k in ['start_ts', 'blackouts_count', 'blackouts_time']:
+            self.assertEqual(seq._pdata['weekly'][k], ff._pdata['weekly'][k])
+
+        for acc_seq, acc_ff in zip(seq._pdata['hourly_load'], ff._pdata['hourly_load']):
+            self.assertAlmostEqual(acc_seq.mean, acc_ff.mean, 6)
+            self.assertAlmostEqual(acc_seq.count, acc_ff.count, 6)
+
+        b_seq, b_ff = seq.batteries._batteries[0], ff.batteries._batteries[0]
+        self.assertEqual(json.dumps(b_seq.get_permastats(), default=lambda o: o.to_json()),
+                         json.dumps(b_ff.get_permastats(), default=lambda o: o.to_json()))
+        return seq, ff, fast_forwarded
+
+
+    ################################################
+    def test_lazy_stats_load_merges(self):
+        """With lazy_stats the file is loaded in background and merged with the data collected meanwhile"""
+        conf = ConfigParser()
+        conf.read_dict(self.tpl_config)
+        kpd1 = KPowerDevice( self.tpl_dev_id, conf )
+        kpd1._pdata['weekly']['blackouts_count'][0] = 42
+        kpd1._pdata['weekly']['start_ts'].insert(0, kpd1._pdata['weekly']['start_ts'][0])  # 2 weeks
+        kpd1._pdata['weekly']['blackouts_count'].insert(0, 42)
+        kpd1._pdata['weekly']['blackouts_time'].insert(0, 0.0)
+        for acc in kpd1._pdata['hourly_load']:
+            acc.mean, acc.count = 10.0, 10.0
+        self.assertTrue( kpd1.stats_file_save(), kpd1._messages )
+
+        kpd2 = KPowerDevice( self.tpl_dev_id, conf, lazy_stats=True )
+        self.assertEqual( 0, kpd2.init_errors, kpd2.collect_messages() )
+        self._validate_pdata_structure( kpd2._pdata, 1 )  # fresh data to start with
+
+        kpd2.process_upsc_data({'ups_load': '10', 'ups_status': 'OB'})
+        if kpd2._stats_loader is not None:  # loader may be fast enough to be merged already
+            kpd2._stats_loader.join()
+        kpd2.process_upsc_data({'ups_load': '10', 'ups_status': 'OL'})  # merge happens here at the latest
+        self.assertIsNone( kpd2._stats_loader )
+        self.assertEqual( 0, kpd2.init_warnings, kpd2.collect_messages() )
+        for lst in kpd2._pdata['weekly'].values():
+            self.assertEqual( 2, len(lst) )
+        self.assertEqual( 43, kpd2._pdata['weekly']['blackouts_count'][0] )
+        self.assertEqual( 42, kpd2._pdata['weekly']['blackouts_count'][1] )
+        self.assertEqual( 30, kpd2._pdata['weekly']['blackouts_time'][0] )
+        hour = time.localtime().tm_hour
+        self.assertAlmostEqual( 12, kpd2._pdata['hourly_load'][hour].count, 2 )
+        self.assertEqual( 10.0, kpd2._pdata['hourly_load'][hour - 1].mean )
+        self.assertNotIn( 'batteries', kpd2._pdata )
+
+        # saving before the loader is done must not lose the old data
+        kpd3 = KPowerDevice( self.tpl_dev_id, conf, lazy_stats=True )
+        self.assertTrue( kpd3.stats_file_save(), kpd3._messages )
+        self.assertEqual( 42, kpd3._pdata['weekly']['blackouts_count'][1] )
+
+
 ########################################
 if __name__ == '__main__':
     unittest.main()
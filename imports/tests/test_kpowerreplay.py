@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Unit tests for kpowerreplay.py"""
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from configparser import ConfigParser
+from imports.kpowerreplay import KPowerReplay
+
+
+class TestKPowerReplay(unittest.TestCase):
+    """Test the KPowerReplay class."""
+
+    def setUp(self):
+        # Create a temporary directory to act as the save path
+        self.tmpdir = tempfile.mkdtemp()
+        self.tpl_config = {
+            'DEFAULT': {
+                'sample_interval': '30',
+                'perma_storage': '/nonexistent',
+                'calc_charge_data': 'yes',
+                'load_reported_as': 'p',
+                'power_factor': '0.8',
+            },
+            'power.ups': {
+                'batteries': 'b1',
+                'power_rating': '2000,va',
+            },
+            'battery.b1': {'type': 'pb', 'vnom': '48', 'capacity_ah': '100'},
+        }
+        self.conf = ConfigParser()
+        self.conf.read_dict(self.tpl_config)
+        self.start = time.mktime((2026, 3, 2, 10, 0, 0, 0, 0, -1))
+
+
+    ################################################
+    def tearDown(self):
+        # Remove the temporary directory
+        shutil.rmtree(self.tmpdir)
+
+
+    ################################################
+    def _log(self, seconds: int, status: str, load: int = 500, volts: str = '54.0') -> str:
+        ts = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start + seconds))
+        return (ts + '{ "battery_voltage": "' + volts + '", "runtimes": [ 1, 2 ], "ups_load": ' + str(load)
+                + ', "ups_status": "' + status + '" }\n')
+
+
+    ################################################
+    def test_parse_line(self):
+        """Both bulk report and log_items lines are understood. Garbage is not"""
+        replay = KPowerReplay('ups', self.conf, self.tmpdir)
+        self.assertEqual('w', self.conf['power.ups']['load_reported_as'])  # log has Watts already
+        self.assertEqual(self.tmpdir, self.conf['power.ups']['perma_storage'])
+
+        ts, hour, data = replay.parse_line(self._log(90, 'OL'))
+        self.assertEqual(self.start + 90, ts)
+        self.assertEqual(time.strftime('%Y-%m-%d %H', time.localtime(self.start)), hour)
+        self.assertEqual({'battery_voltage': '54.0', 'ups_load': '500', 'ups_status': 'OL'}, data)
+
+        short = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start)) + '{"ups_load":"12","ups_status":"OB DISCHRG"}'
+        self.assertEqual({'ups_load': '12', 'ups_status': 'OB DISCHRG'}, replay.parse_line(short)[2])
+
+        self.assertIsNone(replay.parse_line(''))
+        self.assertIsNone(replay.parse_line('2026-13-45 99:00:00{"ups_load": 1, "ups_status": "OL"}'))
+        self.assertIsNone(replay.parse_line(self._log(0, 'OL').replace('ups_load', 'ups_lead')))
+
+
+    ################################################
+    def test_replay(self):
+        """Blackouts are rebuilt, repeated samples are fast-forwarded, order and garbage are checked"""
+        lines = [self._log(i * 30, 'OL') for i in range(100)]
+        lines += [self._log(i * 30, 'OB', 600, '50.0') for i in range(100, 140)]  # 20 minutes blackout
+        lines += [self._log(i * 30, 'OL', 500, '53.0') for i in range(140, 150)]
+        lines.append(self._log(0, 'OL'))  # out of order
+        lines.append('garbage\n')
+
+        path = os.path.join(self.tmpdir, 'log.gz')
+        with gzip.open(path, 'wt') as f:
+            f.writelines(lines[:120])
+
+        replay = KPowerReplay('ups', self.conf, self.tmpdir)
+        self.assertFalse(os.path.exists(replay.stats_file))
+        replay.feed_file(path)
+        replay.feed(lines[120:])
+        self.assertTrue(replay.finish(), replay.messages)
+
+        self.assertEqual(len(lines), replay.lines)
+        self.assertEqual(2, replay.skipped)
+        self.assertEqual(150, replay.processed + replay.fast_forwarded)
+        self.assertGreater(replay.fast_forwarded, 100)
+
+        with open(replay.stats_file, encoding='utf-8') as f:
+            stats = json.load(f)
+
+        self.assertEqual(self.start + 149 * 30, stats['ts'])
+        self.assertEqual(self.start, stats['started'])
+        self.assertEqual(1, stats['weekly']['blackouts_count'][0])
+        self.assertEqual(40 * 30, stats['weekly']['blackouts_time'][0])
+        hour = time.localtime(self.start).tm_hour
+        self.assertEqual(150, round(sum(a[2] for a in stats['hourly_load'][hour:hour + 2])))
+
+
+    ################################################
+    def test_empty(self):
+        """No usable samples - no stats file"""
+        replay = KPowerReplay('ups', self.conf, self.tmpdir)
+        replay.feed(['nothing here\n'])
+        self.assertFalse(replay.finish())
+        self.assertTrue(replay.messages[0].startswith('ERROR'))
+        self.assertFalse(os.path.exists(replay.stats_file))
+
+
+########################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""Unit tests for kpowersite.py"""
+import shutil
+import tempfile
+import unittest
+from configparser import ConfigParser
+from imports.kpowerdevice import KPowerDevice
+from imports.kpowersite import KPowerSite
+
+
+class TestKPowerSite(unittest.TestCase):
+    """Test the KPowerSite class."""
+
+    def setUp(self):
+        # Create a temporary directory to act as the save path
+        self.tmpdir = tempfile.mkdtemp()
+        self.tpl_config = {
+            'DEFAULT': {
+                'sample_interval': '30',
+                'perma_storage': self.tmpdir,
+                'calc_charge_data': 'yes',
+                'load_reported_as': 'w',
+                'power_factor': '0.8',
+            },
+            'power.ups1': {
+                'batteries': 'b1',
+                'power_rating': '2000,va',
+            },
+            'power.ups2': {
+                'batteries': 'b2',
+                'power_rating': '1000,va',
+            },
+            'battery.b1': {'type': 'pb', 'vnom': '48', 'capacity_ah': '100'},
+            'battery.b2': {'type': 'pb', 'vnom': '24', 'capacity_ah': '100'},
+            'site.rack': {
+                'members': 'ups1, ups2',
+            },
+        }
+
+        conf = ConfigParser()
+        conf.read_dict(self.tpl_config)
+        self.conf = conf
+        self.dev1 = KPowerDevice('ups1', conf)
+        self.dev2 = KPowerDevice('ups2', conf)
+
+
+    ################################################
+    def tearDown(self):
+        # Remove the temporary directory
+        shutil.rmtree(self.tmpdir)
+
+
+    ################################################
+    def _feed(self, dev: KPowerDevice, load: int, status: str = 'OL') -> tuple:
+        dev.process_upsc_data({'ups_load': str(load), 'ups_status': status})
+        return dev.get_battery_runtime()
+
+
+    ################################################
+    def test_no_members(self):
+        """Site without members is an error"""
+        self.conf['site.empty'] = {}
+        site = KPowerSite('empty', self.conf)
+        self.assertEqual(1, len(site.messages))
+        self.assertEqual(([], []), site.get_runtimes())
+
+
+    ################################################
+    def test_incremental_totals(self):
+        """Repeated member updates replace its contribution instead of adding up"""
+        site = KPowerSite('rack', self.conf)
+        self.assertEqual(['ups1', 'ups2'], site.members)
+        self.assertFalse(site.updated)
+
+        rt1 = self._feed(self.dev1, 400)
+        site.update_member(self.dev1, rt1)
+        self.assertTrue(site.updated)
+        self.assertEqual(400, site.load)
+        self.assertEqual(rt1[0], site.remaining_wh)
+
+        rt2 = self._feed(self.dev2, 200)
+        site.update_member(self.dev2, rt2)
+        rt1 = self._feed(self.dev1, 600, 'OB')
+        site.update_member(self.dev1, rt1)
+
+        self.assertEqual(800, site.load)
+        self.assertEqual(1, site.on_battery)
+        self.assertEqual(rt1[0] + rt2[0], site.remaining_wh)
+        cap = self.dev1.batteries.get_remaining_power()[2] + self.dev2.batteries.get_remaining_power()[2]
+        self.assertEqual(cap, site.capacity_wh)
+
+        rep = site.get_report()
+        self.assertFalse(site.updated)
+        self.assertEqual(2, rep['reporting'])
+        self.assertEqual(100.0, rep['battery_charge'])
+
+        pooled, worst = rep['runtimes'], rep['runtimes_worst']
+        self.assertEqual(len(rt1), len(pooled))
+        for i in range(1, len(rt1)):
+            self.assertEqual(min(rt1[i], rt2[i]), worst[i])
+
+        # members predict with their load forecasts, while the pooled one is for the current total load
+        energy = self.dev1.batteries.get_energy_to(10) + self.dev2.batteries.get_energy_to(10)
+        self.assertEqual(int(energy * 3600 // 800), pooled[3])
+
+        site.remove_member('ups1')
+        self.assertEqual(200, site.load)
+        self.assertEqual(0, site.on_battery)
+        self.assertEqual(rt2[0], site.remaining_wh)
+
+
+    ################################################
+    def test_idle_member_energy(self):
+        """Idle member's battery counts for the pooled runtime with all of its energy"""
+        site = KPowerSite('rack', self.conf)
+        rt1 = self._feed(self.dev1, 800)
+        rt2 = self._feed(self.dev2, 0)
+        site.update_member(self.dev1, rt1)
+        site.update_member(self.dev2, rt2)
+        self.assertEqual(800, site.load)
+
+        pooled, worst = site.get_runtimes()
+        for i, level in [(1, 80), (2, 50), (3, 10)]:
+            energy = self.dev1.batteries.get_energy_to(level) + self.dev2.batteries.get_energy_to(level)
+            self.assertEqual(int(energy * 3600 // 800), pooled[i])
+            self.assertGreater(pooled[i], rt1[i])  # ups2's battery takes a share
+
+        self.assertEqual(len(rt1), len(pooled))
+        self.assertLessEqual(pooled[5], pooled[3])
+        self.assertGreaterEqual(pooled[6], pooled[3])
+
+        # a tiny load: the site is cut at the members' prediction horizon too
+        site.update_member(self.dev1, self._feed(self.dev1, 5))
+        self.assertEqual(5, site.load)
+        pooled, worst = site.get_runtimes()
+        self.assertEqual([12 * 3600] * 4, [pooled[i] for i in (1, 2, 3, 6)])
+        self.assertLessEqual(pooled[5], pooled[3])
+        self.assertLessEqual(max(worst[1:]), 12 * 3600)
+
+
+    ################################################
+    def test_non_member_ignored(self):
+        """Updates from the devices that are not site members are skipped"""
+        self.conf['site.half'] = {'members': 'ups2'}
+        site = KPowerSite('half', self.conf)
+        site.update_member(self.dev1, self._feed(self.dev1, 400))
+        self.assertFalse(site.updated)
+        self.assertEqual(0, site.load)
+
+
+########################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""Unit tests for kpowerutils.py"""
+import json
+import time
+import unittest
+import imports.kpowerutils as kpu
+
+
+class TestKAccumulator(unittest.TestCase):
+    """Test the KAccumulator class."""
+
+    ################################################
+    def test_add_and_merge(self):
+        """Streaming results match the two-pass ones, merge is the same as adding sequentially"""
+        data = [1e9 + x for x in [4.0, 7.0, 13.0, 16.0, 1.0, 2.5]]  # large offset to expose precision loss
+        mean = sum(data) / len(data)
+        var = sum((x - mean) ** 2 for x in data) / len(data)
+
+        acc = kpu.KAccumulator()
+        for x in data:
+            acc.add(x)
+
+        self.assertEqual( len(data), acc.count )
+        self.assertAlmostEqual( mean, acc.mean, 4 )
+        self.assertAlmostEqual( var, acc.variance, 4 )
+
+        a = kpu.KAccumulator()
+        b = kpu.KAccumulator()
+        for x in data[:2]:
+            a.add(x)
+        for x in data[2:]:
+            b.add(x)
+
+        a.merge(b)
+        a.merge(kpu.KAccumulator())  # empty one changes nothing
+        self.assertEqual( acc.count, a.count )
+        self.assertAlmostEqual( acc.mean, a.mean, 4 )
+        self.assertAlmostEqual( acc.variance, a.variance, 4 )
+
+
+    ################################################
+    def test_decay(self):
+        """Old samples weight is halved after half_life of new samples"""
+        acc = kpu.KAccumulator(half_life=10)
+        for _ in range(10):
+            acc.add(0.0)
+        for _ in range(10):
+            acc.add(100.0)
+
+        self.assertLess( acc.count, 20.0 )
+        self.assertAlmostEqual( 100.0 * 2 / 3, acc.mean, 0 )  # 100 has twice the weight of 0 now
+
+
+    ################################################
+    def test_json(self):
+        """Accumulators are saved as lists and restored back"""
+        acc = kpu.KAccumulator()
+        acc.add(1.0)
+        acc.add(3.0)
+
+        saved = json.loads(json.dumps({'a': [acc]}, default=kpu.json_default))
+        self.assertEqual( [2.0, 2.0, 2.0], saved['a'][0] )
+
+        restored = kpu.KAccumulator.from_json(saved['a'][0], 5.0)
+        self.assertEqual( (2.0, 1.0, 2.0, 5.0), (restored.mean, restored.variance, restored.count, restored.half_life) )
+
+        for bad in [None, [1.0, 2.0], [1.0, -1.0, 1.0], [1.0, 1.0, -1], ['1', 0, 0]]:
+            with self.assertRaises(ValueError):
+                kpu.KAccumulator.from_json(bad)
+
+        with self.assertRaises(TypeError):
+            json.dumps(object(), default=kpu.json_default)
+
+
+class TestKLinearTrend(unittest.TestCase):
+    """Test the KLinearTrend class."""
+
+    ################################################
+    def test_fit_and_window(self):
+        """Running sums give the exact fit. Old points leave the window"""
+        trend = kpu.KLinearTrend(4)
+        self.assertEqual( 0.0, trend.slope )
+        self.assertIsNone( trend.x_at(1.0) )
+
+        trend.add(0.0, 100.0)  # will be pushed out by the line below
+        for x in range(1, 5):
+            trend.add(float(x), 1.0 - 0.1 * x)
+
+        self.assertEqual( 4, len(trend) )
+        self.assertAlmostEqual( -0.1, trend.slope, 9 )
+        self.assertAlmostEqual( 1.0, trend.intercept, 9 )
+        self.assertAlmostEqual( 0.5, trend.value_at(5.0), 9 )
+        self.assertAlmostEqual( 8.0, trend.x_at(0.2), 9 )
+
+        rebuilt = kpu.KLinearTrend(4)
+        rebuilt.reset([(0.0, 100.0)] + [(float(x), 1.0 - 0.1 * x) for x in range(1, 5)])
+        self.assertEqual( 4, len(rebuilt) )
+        self.assertAlmostEqual( trend.slope, rebuilt.slope, 9 )
+        self.assertAlmostEqual( trend.intercept, rebuilt.intercept, 9 )
+
+        flat = kpu.KLinearTrend(3)
+        for y in [1.0, 2.0, 3.0]:
+            flat.add(7.0, y)  # no x spread - no trend
+        self.assertEqual( 0.0, flat.slope )
+        self.assertAlmostEqual( 2.0, flat.intercept, 9 )
+
+
+class TestKClock(unittest.TestCase):
+    """Test the KClock and KSimClock classes."""
+
+    ################################################
+    def test_real(self):
+        """Real clock changes .now only on tick"""
+        clock = kpu.KClock()
+        now = clock.now
+        self.assertAlmostEqual(time.time(), now, 0)
+        self.assertEqual(now, clock.now)
+        self.assertGreaterEqual(clock.tick(), now)
+        self.assertEqual(time.localtime(clock.now).tm_hour, clock.hour)
+
+
+    ################################################
+    def test_sim(self):
+        """Simulated clock moves only when told. Local hour is followed across the boundaries"""
+        start = time.mktime((2026, 3, 2, 10, 59, 30, 0, 0, -1))
+        clock = kpu.KSimClock(start)
+        self.assertEqual(start, clock.now)
+        self.assertEqual(start, clock.time())
+        self.assertEqual(10, clock.hour)
+        self.assertEqual(30.0, clock.to_hour_end)
+        self.assertTrue(clock.asctime().startswith('Mon Mar  2 10:59:30'))
+
+        clock.advance(29.5)
+        self.assertEqual(10, clock.hour)
+        self.assertEqual(0.5, clock.to_hour_end)
+        clock.advance(0.5)
+        self.assertEqual(11, clock.hour)
+        self.assertEqual(3600.0, clock.to_hour_end)
+
+        clock.set(start - 86400)  # backwards too
+        self.assertEqual(10, clock.hour)
+
+        commons = kpu.KPowerDeviceCommons('dev', clock=clock)
+        self.assertIs(clock, commons.clock)
+        self.assertIsNot(kpu.KPowerDeviceCommons('a').clock, kpu.KPowerDeviceCommons('b').clock)
+
+
+########################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""Unit tests for ksmarthistory.py"""
+import os
+import tempfile
+import unittest
+import imports.ksmarthistory as ksh
+from imports.ksmarthistory import KSmartHistory, HOUR, DAY
+
+T0 = 1_700_006_400  # a midnight UTC, so the buckets start at round numbers
+
+
+class TestKSmartHistory(unittest.TestCase):
+    """Test the attributes history and growth checks."""
+
+    def setUp(self):
+        self.h = KSmartHistory(':memory:', hours=48, days=30)
+
+
+    def tearDown(self):
+        self.h.close()
+
+
+    ################################################
+    def test_windows(self):
+        """Time windows parsing"""
+        self.assertEqual( 90, ksh.parse_window('90') )
+        self.assertEqual( 2 * HOUR, ksh.parse_window('120m') )
+        self.assertEqual( DAY, ksh.parse_window(' 1D ') )
+        self.assertEqual( 14 * DAY, ksh.parse_window('2w') )
+        for bad in ['', 'd', '0d', '1y', '-1d', '1.5h']:
+            with self.assertRaises(ValueError, msg=bad):
+                ksh.parse_window(bad)
+
+        self.assertEqual( '1d', ksh.window_to_str(DAY) )
+        self.assertEqual( '36h', ksh.window_to_str(36 * HOUR) )
+        self.assertEqual( '61s', ksh.window_to_str(61) )
+
+
+    ################################################
+    def test_rules(self):
+        """Growth rules parsing"""
+        self.assertEqual( [('5', 8.0, DAY), ('media_errors', 1.0, 7 * DAY), ('5', 50.0, 30 * DAY)],
+                          ksh.parse_growth_rules('5: 8/1d, media_errors:1/7d,\n 5 : 50 / 30d,') )
+        self.assertEqual( [], ksh.parse_growth_rules('') )
+        for bad in ['5 8/1d', '5: 0/1d', '5: 8', '5: 8/x']:
+            with self.assertRaises(ValueError, msg=bad):
+                ksh.parse_growth_rules(bad)
+
+        with self.assertRaises(ValueError):
+            KSmartHistory(':memory:', hours=0)
+
+
+    ################################################
+    def test_downsampling(self):
+        """Readings within the bucket are folded into first/last/min/max"""
+        for i, v in enumerate([3, 1, 7, 5]):
+            self.h.append('d1', {'5': v, '197': 0}, T0 + i * 600)
+        self.h.append('d1', {'5': 6}, T0 + HOUR)
+
+        now = T0 + HOUR + 1
+        self.assertEqual( [(T0, 3, 5, 1, 7), (T0 + HOUR, 6, 6, 6, 6)], self.h.series('d1', '5', HOUR, now) )
+        self.assertEqual( [(T0, 3, 6, 1, 7)], self.h.series('d1', '5', DAY, now) )
+        self.assertEqual( [(T0, 0, 0, 0, 0)], self.h.series('d1', '197', HOUR, now) )
+        self.assertEqual( [], self.h.series('d2', '5', HOUR, now) )
+        with self.assertRaises(ValueError):
+            self.h.series('d1', '5', 60, now)
+
+
+    ################################################
+    def test_ring(self):
+        """Old buckets are overwritten, so the size stays the same"""
+        for i in range(100):
+            self.h.append('d1', {'5': i}, T0 + i * HOUR)
+
+        now = T0 + 99 * HOUR
+        rows = self.h.series('d1', '5', HOUR, now)
+        self.assertEqual( 48, len(rows) )
+        self.assertEqual( (T0 + 52 * HOUR, 52, 52, 52, 52), rows[0] )
+        self.assertEqual( 99, rows[-1][2] )
+
+        count = self.h._db.execute('SELECT count(*) FROM history WHERE period = ?', (HOUR,)).fetchone()[0]
+        self.assertEqual( 48, count )
+
+        # the drive went away for a long time: stale buckets do not count
+        self.assertEqual( [], self.h.series('d1', '5', HOUR, now + 48 * HOUR) )
+        self.assertEqual( 5, len(self.h.series('d1', '5', DAY, now + 48 * HOUR)) )
+
+
+    ################################################
+    def test_growth(self):
+        """Growth over windows, hourly or daily buckets depending on the window length"""
+        self.assertIsNone( self.h.growth('d1', '5', DAY, T0) )
+
+        # 10 days of a steady 4 a day growth, every 2 hours
+        for i in range(10 * 12):
+            self.h.append('d1', {'5': i // 3, '9': 1}, T0 + i * 2 * HOUR)
+
+        now = T0 + 10 * DAY - 2 * HOUR + 1
+        self.assertEqual( (4, DAY + HOUR + 1), self.h.growth('d1', '5', DAY, now) )
+        self.assertEqual( (0, 7 * HOUR + 1), self.h.growth('d1', '9', 6 * HOUR, now) )
+        # daily ones are rougher: the base is the end of the day before the window
+        self.assertEqual( (32, 7 * DAY + 22 * HOUR + 1), self.h.growth('d1', '5', 7 * DAY, now) )
+
+        # a young history: the first value is the base
+        change, covered = self.h.growth('d1', '5', 30 * DAY, now)
+        self.assertEqual( 39, change )
+        self.assertAlmostEqual( 10 * DAY, covered, delta=2 * HOUR )
+
+        rules = ksh.parse_growth_rules('5: 4/1d, 5: 33/7d, 5: 39/60d, 9: 1/1d')
+        self.assertEqual( ['Attribute 5 grew by 4 in 1d (limit: 4/1d)',
+                           'Attribute 5 grew by 39 in 238h (limit: 39/60d)'], self.h.check_growth('d1', rules, now) )
+        self.assertEqual( [], self.h.check_growth('d2', rules, now) )
+
+        self.assertEqual( {'5': {'1d': 4, '1w': 32}, '9': {'1d': 0, '1w': 0}},
+                          self.h.trends('d1', ['5', '9', '197'], [DAY, 7 * DAY], now) )
+
+
+    ################################################
+    def test_file(self):
+        """History survives the reopening, and the unknown formats are not touched"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'h.sqlite')
+            h = KSmartHistory(path)
+            h.append('d1', {'5': 1}, T0)
+            h.close()
+
+            h = KSmartHistory(path)
+            self.assertEqual( [(T0, 1, 1, 1, 1)], h.series('d1', '5', HOUR, T0) )
+            h._db.execute('PRAGMA user_version = 99')
+            h._db.commit()
+            h.close()
+
+            with self.assertRaises(ValueError):
+                KSmartHistory(path)
+
+
+########################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""Unit tests for kupssim.py"""
+import json
+import random
+import shutil
+import tempfile
+import time
+import unittest
+from configparser import ConfigParser
+from imports.kpowerreplay import KPowerReplay
+from imports.kupssim import KSimBattery, KSimBlackouts, KSimLoad, KUPSSim, format_upsc, nut_command
+
+
+class TestKUPSSim(unittest.TestCase):
+    """Test the UPS simulator."""
+
+    def setUp(self):
+        self.start = time.mktime((2026, 3, 2, 10, 0, 0, 0, 0, -1))
+        conf = ConfigParser()
+        conf.read_dict({'ups.sim': {
+            'power_rating_w': '2000', 'type': 'pb', 'vnom': '48', 'capacity_ah': '100',
+            'load_w': '960', 'blackouts': '1:600', 'seed': '1',
+        }})
+        self.sim_conf = conf['ups.sim']
+
+
+    ################################################
+    def test_battery(self):
+        """Discharge drains the charge, sags the voltage and counts cycles. Charging brings it back"""
+        with self.assertRaises(ValueError):
+            KSimBattery('nicd')
+
+        b = KSimBattery('pb', 48, 100.0)
+        v_rest = b.element_voltage(0.0, True)
+        self.assertAlmostEqual(12.85, v_rest)
+        self.assertLess(b.element_voltage(2000.0, True), v_rest)
+
+        b.step(1800, 2400.0, True, 10.0)  # 1200Wh of 4800
+        self.assertAlmostEqual(0.75, b.soc)
+        self.assertAlmostEqual(0.25, b.cycles)
+        self.assertFalse(b.is_empty(2400.0))
+
+        b.step(3 * 3600, 2400.0, True, 10.0)
+        self.assertEqual(0.0, b.soc)
+        self.assertTrue(b.is_empty(2400.0))
+
+        b.step(3600, 2400.0, False, 10.0, False)  # shut down in a blackout: no drain, no charge
+        self.assertEqual(0.0, b.soc)
+
+        b.step(3600, 0.0, False, 10.0)
+        self.assertAlmostEqual(480.0 * 0.9 / b.capacity_wh, b.soc, places=5)  # it has aged a bit meanwhile
+        self.assertGreater(b.element_voltage(0.0, False), 13.0)
+
+        b = KSimBattery('lifepo', 24, 100.0, age_years=2.0, fade_per_year=0.1)
+        self.assertAlmostEqual(0.8, b.health)
+        self.assertAlmostEqual(1920.0, b.capacity_wh)
+
+
+    ################################################
+    def test_load_and_blackouts(self):
+        """Load follows the daily swing. Fixed and random blackouts are both there"""
+        load = KSimLoad(500.0, 100.0, peak_hour=20.0)
+        peak = time.mktime((2026, 3, 2, 20, 0, 0, 0, 0, -1))
+        self.assertAlmostEqual(600.0, load.at(peak))
+        self.assertAlmostEqual(400.0, load.at(peak + 12 * 3600))
+
+        bo = KSimBlackouts([(self.start + 100, 50)])
+        self.assertFalse(bo.is_on(self.start))
+        self.assertTrue(bo.is_on(self.start + 120))
+        self.assertFalse(bo.is_on(self.start + 150))
+
+        bo = KSimBlackouts(per_month=30.0, mean_minutes=10.0, start=self.start, rng=random.Random(1))
+        on = sum(bo.is_on(self.start + i * 60) for i in range(30 * 24 * 60))
+        self.assertGreater(on, 30 * 2)
+        self.assertLess(on, 30 * 30)
+
+
+    ################################################
+    def test_ups(self):
+        """UPS goes on battery, shuts down when it is empty and comes back with the mains"""
+        sim = KUPSSim.from_config('sim', self.sim_conf, self.start)
+        rep = sim.report()
+        self.assertEqual('OL', rep['ups.status'])
+        self.assertEqual('48', rep['ups.load'])
+        self.assertTrue(format_upsc(rep).startswith('battery.charge: 100\n'))
+
+        sim.advance(3600 + 60)
+        rep = sim.report()
+        self.assertTrue(rep['ups.status'].startswith('OB'))
+        self.assertEqual('0.0', rep['input.voltage'])
+
+        sim.advance(5 * 3600)  # 4800Wh at 960W is 5 hours at most
+        self.assertTrue(sim.off)
+        self.assertIsNone(sim.report())
+
+        # shut down: the battery stays empty till the end of the blackout
+        for _ in range(4):
+            sim.advance(3600)
+            self.assertTrue(sim.off)
+            self.assertLess(sim.battery.soc, 0.05)
+
+        sim.advance(2 * 3600)  # 600 minutes blackout is over
+        self.assertFalse(sim.off)
+        self.assertEqual('OL CHRG', sim.report()['ups.status'])
+
+
+    ################################################
+    def test_nut_protocol(self):
+        """Fake upsd answers the way upsc expects"""
+        sims = {'sim': KUPSSim.from_config('sim', self.sim_conf, self.start)}
+        self.assertEqual(('BEGIN LIST UPS\nUPS sim "Simulated UPS"\nEND LIST UPS\n', False),
+                         nut_command(sims, 'LIST UPS'))
+
+        reply, close = nut_command(sims, 'LIST VAR sim')
+        lines = reply.splitlines()
+        self.assertEqual('BEGIN LIST VAR sim', lines[0])
+        self.assertEqual('END LIST VAR sim', lines[-1])
+        self.assertIn('VAR sim ups.status "OL"', lines)
+
+        self.assertEqual('VAR sim ups.load "48"\n', nut_command(sims, 'GET VAR sim ups.load')[0])
+        self.assertEqual('ERR VAR-NOT-SUPPORTED\n', nut_command(sims, 'GET VAR sim nope')[0])
+        self.assertEqual('ERR UNKNOWN-UPS\n', nut_command(sims, 'LIST VAR nope')[0])
+        self.assertEqual('ERR UNKNOWN-COMMAND\n', nut_command(sims, 'FSD sim')[0])
+        self.assertEqual(('OK Goodbye\n', True), nut_command(sims, 'LOGOUT'))
+
+
+    ################################################
+    def test_run_through_stats(self):
+        """Simulated days make their way into the device's stats"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            conf = ConfigParser()
+            conf.read_dict({
+                'DEFAULT': {'sample_interval': '30', 'calc_charge_data': 'yes', 'power_factor': '0.8'},
+                'power.sim': {'batteries': 'b1', 'power_rating': '2000,w'},
+                'battery.b1': {'type': 'pb', 'vnom': '48', 'capacity_ah': '100'},
+            })
+            sim = KUPSSim.from_config('sim', self.sim_conf, self.start)
+            replay = KPowerReplay('sim', conf, tmpdir)
+            replay.feed_samples(sim.samples(30, 3 * 86400))
+            self.assertTrue(replay.finish(), replay.messages)
+
+            # no samples while UPS was off
+            self.assertLess(replay.processed + replay.fast_forwarded, 3 * 86400 // 30)
+            self.assertGreater(replay.fast_forwarded, 0)
+
+            with open(replay.stats_file) as f:
+                stats = json.load(f)
+            self.assertEqual(1, stats['weekly']['blackouts_count'][0])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+########################################
+if __name__ == '__main__':
+    unittest.main()
@@ -95,15 +95,16 @@ function install_mikrotik() {
 }
 
 function install_power() {
-    install_deps kbatteries.py kbattstats.py kbattlead.py kpowerutils.py kpowerdevice.py
+    install_deps kbatteries.py kbattstats.py kbattlead.py kbattlifepo.py kpowerutils.py kpowerdevice.py kpowersite.py kpermastats.py kpowerreplay.py
     srcd="hardware/power"
     $INST $EXEOPT "${srcd}/mqtt-power" "$BINDIR"
+    $INST $EXEOPT "${srcd}/mqtt-power-replay" "$BINDIR"
     install_to_dir_w_check "${srcd}/mqtt-power.service.sample" "${SYSTEMD}" "mqtt-power.service" "$SVCOPT"
     install_to_dir_w_check "${srcd}/mqtt-power.sample.ini" "$CONFDIR" "mqtt-power.ini" "$INIOPT"
 }
 
 function install_storage() {
-    install_deps
+    install_deps ksmarthistory.py
     srcd="hardware/storage"
     $INST $EXEOPT "${srcd}/mqtt-storage-sd-reports" "$BINDIR"
     install_to_dir_w_check "${srcd}/mqtt-storage-sd-reports.service.sample" "${SYSTEMD}" "mqtt-storage-sd-reports.service" "$SVCOPT"